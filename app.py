@@ -1,9 +1,14 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response
-from flask_mail import Mail, Message
-import os, re, uuid, mimetypes
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, g, has_app_context, has_request_context
+from flask import before_render_template, template_rendered, Response
+from flask_mail import Mail, Message, BadHeaderError, Connection as MailConnection
+import os, re, uuid, mimetypes, threading, select, hashlib, smtplib, json, hmac, heapq
+from collections import OrderedDict
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from functools import wraps
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from psycopg2.pool import PoolError
+from time import monotonic, sleep, perf_counter
+from functools import wraps, lru_cache
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone, time
 TZ = timezone(timedelta(hours=8))  # Asia/Taipei
@@ -19,7 +24,16 @@ from werkzeug.utils import secure_filename
 from flask import send_file, abort
 import flask as _flask
 from pathlib import Path
+from urllib.parse import quote
+from markupsafe import Markup, escape
 from PIL import Image  # requirements.txt 記得加 Pillow>=10.0
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing, posixpath, tempfile
+from werkzeug.exceptions import RequestEntityTooLarge
+from image_derivatives import build_derivatives, build_variant
+from exports import EXPORT_FORMATS, export_filename, parse_export_filters, stream_export
+from init_db import run_migrations, RENT_OVERLAP_CONSTRAINT, rent_overlap_constraint_name, ensure_rent_overlap_constraints
 
 
 import random
@@ -81,9 +95,12 @@ UPLOAD_DIR = Path(os.environ.get("UPLOAD_DIR", "uploads")).resolve()
 REVIEW_UPLOAD_SUBDIR = "reviews"
 ALLOWED_IMAGE_EXTS = {"jpg", "jpeg", "png", "webp"}
 MAX_FILE_MB = 12
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", 256))   # 單一 request 總上限（多檔上傳）
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
 THUMB_SIZES = [480, 960]
 WEBP_QUALITY = 82
 JPEG_QUALITY = 85
+WEBP_METHOD = int(os.environ.get("WEBP_METHOD", 4))   # 0~6，6 最慢；4 之後檔案大小幾乎不再變小
 
 # 檔名處理/縮圖工具
 _slugify_re = re.compile(r"[^fuqian-z0-9\-]+")
@@ -101,33 +118,6 @@ def unique_path(dirpath: Path, stem: str, ext: str) -> Path:
 def _guess_mime(p: Path) -> str:
     return mimetypes.guess_type(str(p))[0] or "application/octet-stream"
 
-def resize_fit_width(img: Image.Image, width: int) -> Image.Image:
-    if img.width <= width:
-        return img.copy()
-    ratio = width / float(img.width)
-    new_h = max(1, int(img.height * ratio))
-    return img.resize((width, new_h), Image.LANCZOS)
-
-def ensure_banners_table():
-    conn = get_db_connection()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS banners (
-                    id SERIAL PRIMARY KEY,
-                    img TEXT NOT NULL,
-                    title TEXT,
-                    subtitle TEXT,
-                    link TEXT,
-                    badge TEXT,
-                    sort_order INTEGER NOT NULL DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_banners_sort ON banners(sort_order, id);")
-    conn.close()
-
-
 # ===== flash 自動判斷類別（避免忘了帶 category）======
 if not hasattr(_flask, "_original_flash"):
     _flask._original_flash = _flask.flash  # 保存原始 flash 函式
@@ -151,9 +141,477 @@ def flash(message, category=None):
 def allowed_news_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_NEWS_EXTS
 
-# 建立 PostgreSQL 資料庫連線
+# ===== 效能量測（/metrics）=====
+# METRICS_ENABLED=1 才會啟用；關閉時連線不換 factory、hook 一進來就 return，幾乎沒有成本。
+#   - 每個 endpoint 的延遲直方圖 / 請求數（依狀態碼）
+#   - 每個請求的 SQL 次數與耗時：連線改用 _InstrumentedConnection，所有 cursor（含 RealDictCursor）都會計時
+#   - 模板渲染時間（Flask 的 before_render_template / template_rendered 訊號）
+#   - Pillow 影像處理時間（上傳讀檔頭、/u/ 變體、背景縮圖）
+# 以 Prometheus 文字格式輸出在 /metrics；慢請求 / 慢查詢寫成一行 JSON 的 warning log；
+# 回應帶 Server-Timing（瀏覽器 DevTools 可直接看 db / tpl / app 各花多少）。
+# gunicorn 多個 worker 時設 METRICS_DIR：各 process 定期把快照（JSON）寫進去，/metrics 合併所有快照。
+# 沒設 METRICS_TOKEN 時 /metrics 只給本機直連（127.0.0.1 / ::1、沒有經過 proxy）的請求看。
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")          # 有設就要帶 Authorization: Bearer <token>
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", 5))
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 1000))
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+class _Metrics:
+    """極簡的 Prometheus registry：histogram / counter，label 值以 tuple 為 key。"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._meta = {}     # name -> (type, help, labelnames, buckets)
+        self._data = {}     # name -> {labels: [各 bucket 次數..., sum, count]} 或 {labels: 值}
+        self._dumped_at = 0.0
+
+    def histogram(self, name, help_text, labelnames, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help_text, tuple(labelnames), tuple(buckets))
+        self._data[name] = {}
+
+    def counter(self, name, help_text, labelnames):
+        self._meta[name] = ("counter", help_text, tuple(labelnames), ())
+        self._data[name] = {}
+
+    def observe(self, name, labels: tuple, value: float):
+        buckets = self._meta[name][3]
+        with self._lock:
+            row = self._data[name].get(labels)
+            if row is None:
+                row = self._data[name][labels] = [0] * (len(buckets) + 2)
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    row[i] += 1   # 先存不累計的次數，輸出時再累加
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    def inc(self, name, labels: tuple, value=1):
+        with self._lock:
+            self._data[name][labels] = self._data[name].get(labels, 0) + value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {name: {k: (list(v) if isinstance(v, list) else v) for k, v in rows.items()}
+                    for name, rows in self._data.items()}
+
+    def maybe_dump(self, force=False):
+        if not METRICS_DIR or (not force and monotonic() - self._dumped_at < METRICS_DUMP_INTERVAL):
+            return
+        self._dumped_at = monotonic()
+        path = Path(METRICS_DIR) / f"metrics-{self.pid}.json"
+        # label 是 tuple，JSON 的 key 只能是字串：每個 metric 存成 [[labels, 值], ...]
+        data = {name: [[list(k), v] for k, v in rows.items()] for name, rows in self.snapshot().items()}
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(data, fh)
+            os.replace(tmp, path)
+        except OSError as e:
+            app.logger.warning("metrics dump failed: %s", e)
+
+    def _merged(self) -> dict:
+        merged = self.snapshot()
+        if not METRICS_DIR:
+            return merged
+        for p in Path(METRICS_DIR).glob("metrics-*.json"):
+            if p.name == f"metrics-{self.pid}.json":
+                continue
+            try:
+                with open(p, encoding="utf-8") as fh:
+                    other = json.load(fh)
+            except (OSError, ValueError):
+                continue
+            for name, rows in other.items():
+                if name not in self._meta:
+                    continue
+                target = merged.setdefault(name, {})
+                for labels, v in rows:
+                    labels = tuple(labels)
+                    if isinstance(v, list):
+                        cur = target.setdefault(labels, [0] * len(v))
+                        target[labels] = [a + b for a, b in zip(cur, v)]
+                    else:
+                        target[labels] = target.get(labels, 0) + v
+        return merged
+
+    def render(self) -> str:
+        def fmt_labels(names, values, extra=None):
+            pairs = [(n, v) for n, v in zip(names, values)] + ([extra] if extra else [])
+            if not pairs:
+                return ""
+            esc = lambda s: str(s).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{n}="{esc(v)}"' for n, v in pairs) + "}"
+
+        data = self._merged()
+        out = []
+        for name, (kind, help_text, labelnames, buckets) in self._meta.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, v in sorted(data.get(name, {}).items()):
+                if kind == "counter":
+                    out.append(f"{name}{fmt_labels(labelnames, labels)} {v}")
+                    continue
+                cumulative = 0
+                for le, n in zip(buckets, v):
+                    cumulative += n
+                    out.append(f"{name}_bucket{fmt_labels(labelnames, labels, ('le', le))} {cumulative}")
+                out.append(f"{name}_bucket{fmt_labels(labelnames, labels, ('le', '+Inf'))} {v[-1]}")
+                out.append(f"{name}_sum{fmt_labels(labelnames, labels)} {v[-2]:.6f}")
+                out.append(f"{name}_count{fmt_labels(labelnames, labels)} {v[-1]}")
+        return "\n".join(out) + "\n"
+
+def _new_metrics() -> _Metrics:
+    m = _Metrics()
+    m.histogram("http_request_duration_seconds", "Request latency by endpoint", ("endpoint", "method"))
+    m.counter("http_requests_total", "Requests by endpoint and status", ("endpoint", "method", "status"))
+    m.histogram("db_queries_per_request", "SQL statements per request", ("endpoint",), QUERY_COUNT_BUCKETS)
+    m.histogram("db_query_duration_seconds", "SQL statement latency", ("endpoint",))
+    m.histogram("template_render_duration_seconds", "Template render time", ("template",))
+    m.histogram("image_processing_duration_seconds", "Pillow processing time", ("op",))
+    return m
+
+_metrics = None
+
+def get_metrics() -> _Metrics:
+    """本 process 的 registry（fork 後依 pid 重建，跟連線池一樣）。"""
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        _metrics = _new_metrics()
+    return _metrics
+
+def _metrics_endpoint() -> str:
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return "background"
+
+def _slow_log(event: str, **fields):
+    app.logger.warning(json.dumps({"event": event, **fields}, ensure_ascii=False, default=str))
+
+def record_query(seconds: float, query):
+    endpoint = _metrics_endpoint()
+    get_metrics().observe("db_query_duration_seconds", (endpoint,), seconds)
+    stats = g.get("_req_stats") if has_request_context() else None
+    if stats is not None:
+        stats["db_n"] += 1
+        stats["db_t"] += seconds
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        if isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+        # 只記 SQL 本文（不含參數，避免個資進 log）
+        _slow_log("slow_query", endpoint=endpoint, ms=round(seconds * 1000, 1),
+                  sql=" ".join(str(query).split())[:500])
+
+def record_image_op(op: str, seconds: float):
+    if METRICS_ENABLED:
+        get_metrics().observe("image_processing_duration_seconds", (op,), seconds)
+
+class _InstrumentedCursorMixin:
+    def execute(self, query, vars=None):
+        started = perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(perf_counter() - started, query)
+
+    def executemany(self, query, vars_list):
+        started = perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(perf_counter() - started, query)
+
+_instrumented_cursor_classes = {}
+
+def _instrumented_cursor_class(base):
+    cls = _instrumented_cursor_classes.get(base)
+    if cls is None:
+        cls = _instrumented_cursor_classes[base] = type(
+            f"Instrumented{base.__name__}", (_InstrumentedCursorMixin, base), {})
+    return cls
+
+class _InstrumentedConnection(psycopg2.extensions.connection):
+    """cursor() 不論指定哪種 cursor_factory，都換成會計時的子類別。"""
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _instrumented_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+@app.before_request
+def start_request_metrics():
+    if METRICS_ENABLED:
+        g._req_stats = {"t0": perf_counter(), "db_n": 0, "db_t": 0.0, "tpl_t": 0.0, "done": False}
+
+def _finish_request_metrics(status: int, resp=None):
+    stats = g.get("_req_stats")
+    if stats is None or stats["done"]:
+        return
+    stats["done"] = True
+    elapsed = perf_counter() - stats["t0"]
+    endpoint, method = request.endpoint or "unknown", request.method
+    m = get_metrics()
+    m.observe("http_request_duration_seconds", (endpoint, method), elapsed)
+    m.inc("http_requests_total", (endpoint, method, str(status)))
+    m.observe("db_queries_per_request", (endpoint,), stats["db_n"])
+    m.maybe_dump()
+    if resp is not None:
+        resp.headers["Server-Timing"] = ", ".join([
+            f'db;dur={stats["db_t"] * 1000:.1f};desc="{stats["db_n"]} queries"',
+            f'tpl;dur={stats["tpl_t"] * 1000:.1f}',
+            f'app;dur={elapsed * 1000:.1f}',
+        ])
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        _slow_log("slow_request", endpoint=endpoint, method=method, path=request.path, status=status,
+                  ms=round(elapsed * 1000, 1), db_queries=stats["db_n"],
+                  db_ms=round(stats["db_t"] * 1000, 1), template_ms=round(stats["tpl_t"] * 1000, 1))
+
+@app.after_request
+def finish_request_metrics(resp):
+    # 最早註冊的 after_request 最後執行，量到的時間包含其他 after_request
+    if METRICS_ENABLED:
+        _finish_request_metrics(resp.status_code, resp)
+    return resp
+
+@app.teardown_request
+def finish_failed_request_metrics(exc):
+    if METRICS_ENABLED and exc is not None:
+        _finish_request_metrics(500)
+
+def _template_render_started(sender, template, context, **extra):
+    g.setdefault("_tpl_started", []).append(perf_counter())
+
+def _template_rendered(sender, template, context, **extra):
+    started = g.get("_tpl_started")
+    if not started:
+        return
+    elapsed = perf_counter() - started.pop()
+    get_metrics().observe("template_render_duration_seconds", (template.name or "?",), elapsed)
+    stats = g.get("_req_stats")
+    if stats is not None and not started:   # 巢狀 render_template 只算最外層
+        stats["tpl_t"] += elapsed
+
+if METRICS_ENABLED:
+    before_render_template.connect(_template_render_started, app)
+    template_rendered.connect(_template_rendered, app)
+
+@app.route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        abort(404)
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}"):
+            abort(403)
+    elif request.remote_addr not in ("127.0.0.1", "::1") or "X-Forwarded-For" in request.headers:
+        abort(403)
+    m = get_metrics()
+    m.maybe_dump(force=True)
+    resp = make_response(m.render())
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+# ===== PostgreSQL 連線池 =====
+# 每個 process 各自一個池（gunicorn fork 後依 pid 重建，不共用父程序的 socket）；
+# 同一個 request 內所有 get_db_connection() 共用同一條連線（view + context processor）。
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))             # 預先建立的連線數
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 5))             # 每個 process 最多連線數
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))  # 池滿時最多等幾秒
+DB_POOL_PING_AFTER = float(os.environ.get("DB_POOL_PING_AFTER", 30))  # 閒置超過幾秒，取出時先 SELECT 1
+
+class _ConnectionPool:
+    """執行緒安全的連線池：取出時做健康檢查，歸還時把交易清乾淨。"""
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int):
+        self.dsn = dsn
+        self.pid = os.getpid()
+        self.maxconn = max(1, maxconn)
+        self._idle = []              # [(conn, last_used)]
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        for _ in range(min(max(0, minconn), self.maxconn)):
+            self._idle.append((self._connect(), monotonic()))
+
+    def _connect(self):
+        if METRICS_ENABLED:
+            return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor,
+                                    connection_factory=_InstrumentedConnection)
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+
+    def _healthy(self, conn, last_used: float) -> bool:
+        if conn.closed or conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if monotonic() - last_used < DB_POOL_PING_AFTER:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise PoolError(f"資料庫連線池已滿（{self.maxconn} 條），等待逾時")
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._connect()
+                conn, last_used = item
+                if self._healthy(conn, last_used):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn)
+            if conn.closed or conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, monotonic()))
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> _ConnectionPool:
+    """取得本 process 的連線池（第一次使用才建立；fork 後自動換新）。"""
+    global _db_pool
+    pool = _db_pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool.pid != os.getpid():
+            # fork 進來的舊池直接丟掉：那些 socket 屬於父程序，不能在這裡 close
+            _db_pool = _ConnectionPool(os.environ["DATABASE_URL"], DB_POOL_MIN, DB_POOL_MAX)
+        return _db_pool
+
+class _SharedConnection:
+    """一條從池借出的連線 + 目前有幾個 handle 在用。"""
+
+    def __init__(self, pool: _ConnectionPool):
+        self.pool = pool
+        self.raw = pool.getconn()
+        self.handles = 0
+
+    def release(self):
+        raw, self.raw = self.raw, None
+        if raw is not None:
+            self.pool.putconn(raw)
+
+class PooledConnection:
+    """
+    get_db_connection() 回傳的連線代理，用法與 psycopg2 connection 相同：
+      - close()：沒有其他 handle 在用時，把未提交的交易 rollback（與原本關連線的語意一致），
+        request 內連線留給後續的 get_db_connection()；request 外則直接還回池。
+      - with conn: 成功 commit、例外 rollback（與 psycopg2 相同）。
+    """
+
+    def __init__(self, shared: _SharedConnection, request_scoped: bool):
+        self._shared = shared
+        self._request_scoped = request_scoped
+        self._closed = False
+        shared.handles += 1
+
+    def _raw(self):
+        if self._closed or self._shared.raw is None:
+            raise psycopg2.InterfaceError("connection already closed")
+        return self._shared.raw
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._raw(), name)
+
+    @property
+    def closed(self):
+        return 1 if self._closed or self._shared.raw is None else self._shared.raw.closed
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        shared = self._shared
+        shared.handles -= 1
+        if shared.handles > 0 or shared.raw is None:
+            return
+        if self._request_scoped:
+            raw = shared.raw
+            if not raw.closed and raw.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                try:
+                    raw.rollback()
+                except psycopg2.Error:
+                    pass
+        else:
+            shared.release()
+
+    def __enter__(self):
+        self._raw()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        raw = self._raw()
+        if exc_type is None:
+            raw.commit()
+        else:
+            raw.rollback()
+        return False
+
+    def __del__(self):
+        # 忘了 close 的 request 外連線，至少在回收時還回池
+        if not getattr(self, "_closed", True) and not self._request_scoped:
+            try:
+                self.close()
+            except Exception:
+                pass
+
+# 建立 PostgreSQL 資料庫連線（從連線池借；同一個 request 內共用一條）
 def get_db_connection():
-    return psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
+    if has_app_context():
+        shared = g.get("_db_shared")
+        if shared is None or shared.raw is None or shared.raw.closed:
+            if shared is not None:
+                shared.release()
+            shared = g._db_shared = _SharedConnection(get_db_pool())
+        return PooledConnection(shared, request_scoped=True)
+    return PooledConnection(_SharedConnection(get_db_pool()), request_scoped=False)
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    shared = g.pop("_db_shared", None)
+    if shared is not None:
+        shared.release()
 
 # 上傳資料夾 & 允許副檔名（課程DM）
 UPLOAD_FOLDER_COURSES = os.path.join(BASE_DIR, "uploads", "courses")
@@ -169,25 +627,6 @@ def norm_upload_relpath(p: str) -> str:
         p = p[len("static/uploads/"):]
     return p
 
-def ensure_courses_table():
-    conn = get_db_connection()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS courses (
-                    id SERIAL PRIMARY KEY,
-                    title TEXT NOT NULL,
-                    description TEXT,
-                    dm_file TEXT,
-                    signup_link TEXT,
-                    pinned BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_courses_created_at ON courses(created_at DESC);")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_courses_pinned ON courses(pinned);")
-    conn.close()
-
 LOCATION_ALBUMS = {
     "府前教室": "rent/fuqian",
     "西門教室": "rent/ximen",
@@ -209,16 +648,17 @@ def allowed_course_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_COURSE_EXTS
 
 def save_course_dm(file_storage):
+    """存 DM 檔，回傳 (相對路徑, 內容 SHA-256)；沒有檔案或副檔名不符回 (None, None)。"""
     if not file_storage or not file_storage.filename.strip():
-        return None
+        return None, None
     fn = secure_filename(file_storage.filename)
     ext = fn.rsplit(".", 1)[-1].lower() if "." in fn else ""
     if ext not in ALLOWED_COURSE_EXTS:
-        return None
+        return None, None
     uniq = f"{uuid.uuid4().hex}.{ext}"
     abs_path = os.path.join(UPLOAD_FOLDER_COURSES, uniq)
     file_storage.save(abs_path)
-    return f"courses/{uniq}"
+    return f"courses/{uniq}", file_sha256(abs_path)
 
 def delete_course_dm_if_exists(relpath: str):
     if not relpath or not relpath.startswith("courses/"):
@@ -232,22 +672,106 @@ def delete_course_dm_if_exists(relpath: str):
 FILES_DIR = os.path.join(app.root_path, "static", "files")
 os.makedirs(FILES_DIR, exist_ok=True)
 
-def ensure_downloads_table():
-    conn = get_db_connection()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS downloads (
-                    id SERIAL PRIMARY KEY,
-                    filename TEXT NOT NULL,
-                    title TEXT NOT NULL,
-                    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-    conn.close()
+# ===== 快取版本號（cache_versions 表 + LISTEN/NOTIFY）=====
+# 資料表異動時 trigger 會遞增 cache_versions 並 pg_notify('cache_versions', 'name:version')；
+# 每個 process 有一條 LISTEN 連線即時收版本號，所以讀版本號通常不用查 DB。
+# LISTEN 斷線或關閉（CACHE_LISTEN=0）時退回查表，版本號最多沿用 CACHE_VERSION_TTL 秒。
+CACHE_LISTEN = os.environ.get("CACHE_LISTEN", "1") == "1"
+CACHE_VERSION_TTL = float(os.environ.get("CACHE_VERSION_TTL", 5))
+
+class _CacheVersions:
+    def __init__(self):
+        self.pid = os.getpid()
+        self._versions = {}          # name -> (version, fetched_at)
+        self._lock = threading.Lock()
+        self._listening = threading.Event()
+        self._thread = None
+
+    def get(self, name: str) -> int:
+        self._start_listener()
+        with self._lock:
+            item = self._versions.get(name)
+        if item is not None:
+            version, fetched_at = item
+            if self._listening.is_set() or monotonic() - fetched_at < CACHE_VERSION_TTL:
+                return version
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT version FROM cache_versions WHERE name = %s", (name,))
+                row = cur.fetchone()
+        finally:
+            conn.close()
+        return self._store(name, int(row["version"]) if row else 0)
+
+    def _store(self, name: str, version: int) -> int:
+        # 版本號只會往上加：LISTEN 先收到的新版本不能被較慢的查詢結果蓋回去
+        with self._lock:
+            current = self._versions.get(name)
+            if current is not None and current[0] > version:
+                version = current[0]
+            self._versions[name] = (version, monotonic())
+        return version
+
+    def _start_listener(self):
+        if not CACHE_LISTEN or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="cache-versions-listener", daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(os.environ["DATABASE_URL"])
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("LISTEN cache_versions;")
+                # 斷線期間可能漏掉通知：清掉本地版本號，下次讀取重新查表
+                with self._lock:
+                    self._versions.clear()
+                self._listening.set()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1;")  # keepalive
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        name, _, version = conn.notifies.pop(0).payload.rpartition(":")
+                        if name and version.isdigit():
+                            self._store(name, int(version))
+            except Exception as e:
+                self._listening.clear()
+                app.logger.warning("cache_versions listener error: %s", e)
+                sleep(5)
+            finally:
+                if conn is not None:
+                    try: conn.close()
+                    except Exception: pass
+
+_cache_versions = None
+
+def get_cache_version(name: str) -> int:
+    """目前 cache_versions 裡 name 的版本號（不存在時為 0）。"""
+    global _cache_versions
+    if _cache_versions is None or _cache_versions.pid != os.getpid():
+        _cache_versions = _CacheVersions()
+    return _cache_versions.get(name)
+
+# 從資料庫載入商品資料（整個 process 共用一份，products 版本號變了才重讀）
+# 回傳的 dict 是共用的快取，呼叫端不要修改
+_catalog_cache = {"version": None, "products": {}}
 
-# 從資料庫載入商品資料
 def load_products_from_db():
+    global _catalog_cache
+    version = get_cache_version("products")
+    cached = _catalog_cache
+    if cached["version"] == version:
+        return cached["products"]
+
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     cursor.execute("""
@@ -257,14 +781,15 @@ def load_products_from_db():
     """)
     rows = cursor.fetchall()
     conn.close()
-    return {
+    products = {
         row["pid"]: {
             "name": row["name"],
             "price": int(row["price"])
         }
         for row in rows
     }
-
+    _catalog_cache = {"version": version, "products": products}
+    return products
 
 # ✅ 自動刷新 session
 @app.before_request
@@ -283,20 +808,6 @@ def nocache(view):
         return resp
     return _wrapped
 
-def ensure_about_row(conn):
-    with conn.cursor() as cur:
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS about_page (
-            id SERIAL PRIMARY KEY,
-            content TEXT NOT NULL DEFAULT ''
-        );
-        """)
-        cur.execute("SELECT id FROM about_page WHERE id = 1;")
-        row = cur.fetchone()
-        if not row:
-            cur.execute("INSERT INTO about_page (id, content) VALUES (1, '');")
-        conn.commit()
-
 # ===== 時段常數（統一使用這一份）=====
 # 格式: (value, start_hm, end_hm)
 TIME_SLOTS = [
@@ -319,32 +830,267 @@ def get_booked_slots(conn, y, m, d, location):
         rows = cur.fetchall()
     return {(r["time_slot"] or "").replace("–", "-").strip() for r in rows}
 
-def delete_expired_rent_requests():
+# ===== 背景維護排程 =====
+# 每個 process 一條排程執行緒，但只有拿到 PostgreSQL advisory lock 的那一個（leader）會執行工作；
+# leader 掛掉時連線斷開、lock 自動釋放，其他 worker 下一輪就會接手。
+# 用 @maintenance_job(name, interval_seconds) 註冊工作；工作在 app context 內執行。
+MAINTENANCE_ENABLED = os.environ.get("MAINTENANCE_SCHEDULER", "1") == "1"
+MAINTENANCE_LOCK_KEY = 717_0002
+MAINTENANCE_TICK = float(os.environ.get("MAINTENANCE_TICK", 15))   # 幾秒檢查一次
+
+_maintenance_jobs = []   # [(name, interval_seconds, fn)]
+
+def maintenance_job(name: str, interval_seconds: float):
+    def decorator(fn):
+        _maintenance_jobs.append((name, interval_seconds, fn))
+        return fn
+    return decorator
+
+class _MaintenanceScheduler(threading.Thread):
+    def __init__(self):
+        super().__init__(name="maintenance-scheduler", daemon=True)
+        self.pid = os.getpid()
+        self.stopped = threading.Event()
+        self.is_leader = False
+
+    def run(self):
+        lock_conn = None
+        next_run = {}
+        while not self.stopped.is_set():
+            try:
+                if lock_conn is None or lock_conn.closed:
+                    lock_conn = psycopg2.connect(os.environ["DATABASE_URL"])
+                    lock_conn.autocommit = True
+                    self.is_leader = False
+                with lock_conn.cursor() as cur:
+                    if self.is_leader:
+                        cur.execute("SELECT 1;")  # lock 綁在這條連線上，確認它還活著
+                    else:
+                        cur.execute("SELECT pg_try_advisory_lock(%s);", (MAINTENANCE_LOCK_KEY,))
+                        self.is_leader = bool(cur.fetchone()[0])
+                if self.is_leader:
+                    for name, interval, fn in list(_maintenance_jobs):
+                        if monotonic() < next_run.get(name, 0):
+                            continue
+                        next_run[name] = monotonic() + interval
+                        self._run_job(name, fn)
+            except Exception as e:
+                app.logger.warning("maintenance scheduler error: %s", e)
+                self.is_leader = False
+                if lock_conn is not None:
+                    try: lock_conn.close()
+                    except Exception: pass
+                lock_conn = None
+            self.stopped.wait(MAINTENANCE_TICK)
+        if lock_conn is not None:
+            lock_conn.close()
+
+    @staticmethod
+    def _run_job(name, fn):
+        started = monotonic()
+        try:
+            with app.app_context():
+                result = fn()
+            app.logger.info("maintenance job %s done in %.2fs: %s", name, monotonic() - started, result)
+        except Exception:
+            app.logger.exception("maintenance job %s failed", name)
+
+_maintenance_scheduler = None
+_maintenance_scheduler_lock = threading.Lock()
+
+def start_maintenance_scheduler():
+    """
+    啟動本 process 的排程執行緒（重複呼叫無副作用）。gunicorn 由 gunicorn.conf.py 在 worker 啟動時呼叫；
+    flask run / uWSGI / waitress 等其他伺服器則在第一個 request 時由 ensure_maintenance_scheduler 啟動。
+    """
+    global _maintenance_scheduler
+    if not MAINTENANCE_ENABLED:
+        return None
+    with _maintenance_scheduler_lock:
+        if _maintenance_scheduler is None or _maintenance_scheduler.pid != os.getpid():
+            _maintenance_scheduler = _MaintenanceScheduler()
+            _maintenance_scheduler.start()
+    return _maintenance_scheduler
+
+@app.before_request
+def ensure_maintenance_scheduler():
+    # 已經在跑就只是一次比較；多個 process 各起一條也沒關係，只有拿到 advisory lock 的會執行工作
+    s = _maintenance_scheduler
+    if MAINTENANCE_ENABLED and (s is None or s.pid != os.getpid()):
+        start_maintenance_scheduler()
+
+RENT_ARCHIVE_BATCH = int(os.environ.get("RENT_ARCHIVE_BATCH", 500))
+
+@maintenance_job("archive_past_rent_requests", interval_seconds=300)
+def archive_past_rent_requests():
     """
-    刪除已過去的核准租借：
+    把已結束的租借申請分批搬到 rent_requests_archive：
       - 日期小於今天；或
-      - 同日且 end_time（或 time_slot 的結束）已過
+      - 同日且 end_time 已過
+    過期仍未審核（pending）的在封存時標記為 expired。
+    封存表已有同 id 時以線上這筆覆蓋，避免 DELETE 之後資料兩邊都不見。
     """
     now = datetime.now(TZ)
+    total = 0
+    while True:
+        conn = get_db_connection()
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH moved AS (
+                        DELETE FROM rent_requests
+                        WHERE id IN (
+                            SELECT id FROM rent_requests
+                            WHERE date < %(today)s
+                               OR (date = %(today)s AND end_time <= %(now)s::time)
+                            ORDER BY date, id
+                            LIMIT %(batch)s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING *
+                    )
+                    INSERT INTO rent_requests_archive
+                      (id, location, date, time_slot, start_time, end_time,
+                       name, phone, email, note, submitted_at, status)
+                    SELECT id, location, date, time_slot, start_time, end_time,
+                           name, phone, email, note, submitted_at,
+                           CASE WHEN status = 'pending' THEN 'expired' ELSE status END
+                    FROM moved
+                    ON CONFLICT (id) DO UPDATE SET
+                      location = EXCLUDED.location, date = EXCLUDED.date,
+                      time_slot = EXCLUDED.time_slot, start_time = EXCLUDED.start_time,
+                      end_time = EXCLUDED.end_time, name = EXCLUDED.name,
+                      phone = EXCLUDED.phone, email = EXCLUDED.email, note = EXCLUDED.note,
+                      submitted_at = EXCLUDED.submitted_at, status = EXCLUDED.status
+                """, {"today": now.date(), "now": now.strftime("%H:%M"), "batch": RENT_ARCHIVE_BATCH})
+                moved = cur.rowcount
+        conn.close()
+        total += moved
+        if moved < RENT_ARCHIVE_BATCH:
+            return total
+
+# ===== 場地可借時段（每個場地、每天一個 15 分鐘 bitmap）=====
+# BUSINESS_OPEN～BUSINESS_CLOSE 切成 SLOT_COUNT 格，第 i 個 bit = 第 i 個 15 分鐘已被佔用
+# （pending / approved 都算佔用）。bitmap 依場地快取在 process 內，以 "rent:<場地>" 版本號失效
+# （rent_requests 的 trigger 會在新增/核准/駁回/刪除時遞增），所以查詢通常不用碰 DB，
+# 需要時也只用 idx_rent_active_loc_date 做一次範圍查詢。
+OPEN_MINUTES = BUSINESS_OPEN.hour * 60 + BUSINESS_OPEN.minute
+SLOT_COUNT = (BUSINESS_CLOSE.hour * 60 + BUSINESS_CLOSE.minute - OPEN_MINUTES) // STEP_MINUTES
+FULL_MASK = (1 << SLOT_COUNT) - 1
+RENT_LOOKAHEAD_DAYS = int(os.environ.get("RENT_LOOKAHEAD_DAYS", 92))   # 未指定期間時查未來幾天
+RENT_MAX_WINDOW_DAYS = 400                                            # 單次最多查幾天
+
+def slot_index(t: time) -> int:
+    """時間 → 第幾格（可能 <0 或 >SLOT_COUNT，呼叫端自行夾住）。"""
+    return (t.hour * 60 + t.minute - OPEN_MINUTES) // STEP_MINUTES
+
+def slot_time(i: int) -> time:
+    minutes = OPEN_MINUTES + i * STEP_MINUTES
+    return time(minutes // 60, minutes % 60)
+
+def range_mask(s: time, e: time) -> int:
+    """[s, e) 對應的 bitmap；結束時間不在格線上時往後進位（整格都算佔用）。"""
+    si = max(0, slot_index(s))
+    end_minutes = e.hour * 60 + e.minute - OPEN_MINUTES
+    ei = min(SLOT_COUNT, -(-end_minutes // STEP_MINUTES))
+    if ei <= si:
+        return 0
+    return ((1 << (ei - si)) - 1) << si
+
+def past_mask(d, now=None) -> int:
+    """今天已經過去（開始時間 <= 現在）的格子；過去的日期整天都算。"""
+    now = now or datetime.now(TZ)
     today = now.date()
-    now_hm = now.strftime("%H:%M")
+    if d < today:
+        return FULL_MASK
+    if d > today:
+        return 0
+    passed = (now.hour * 60 + now.minute - OPEN_MINUTES) // STEP_MINUTES + 1
+    passed = max(0, min(SLOT_COUNT, passed))
+    return (1 << passed) - 1
+
+def free_ranges(mask: int) -> list:
+    """bitmap 中連續的空格 → [(start_time, end_time), ...]。"""
+    out, i = [], 0
+    while i < SLOT_COUNT:
+        if mask >> i & 1:
+            i += 1
+            continue
+        j = i
+        while j < SLOT_COUNT and not (mask >> j & 1):
+            j += 1
+        out.append((slot_time(i), slot_time(j)))
+        i = j
+    return out
+
+def load_booked_masks(cur, location, d_from, d_to) -> dict:
+    """一次範圍查詢，回傳 {date: mask}（沒有申請的日期不會出現）。"""
+    cur.execute("""
+        SELECT date, start_time, end_time
+        FROM rent_requests
+        WHERE location=%s AND date BETWEEN %s AND %s
+          AND status IN ('pending','approved')
+          AND start_time IS NOT NULL AND end_time IS NOT NULL
+    """, (location, d_from, d_to))
+    masks = {}
+    for r in cur.fetchall():
+        masks[r["date"]] = masks.get(r["date"], 0) | range_mask(r["start_time"], r["end_time"])
+    return masks
+
+class _AvailabilityIndex:
+    MAX_DAYS_PER_LOCATION = 2000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locations = {}     # location -> {"version": v, "days": {date: mask}}
+
+    def masks(self, location, d_from, d_to) -> dict:
+        """{date: mask}，涵蓋 d_from～d_to 的每一天（未被佔用的日期為 0）。"""
+        version = get_cache_version(f"rent:{location}")
+        with self._lock:
+            entry = self._locations.get(location)
+            if entry is None or entry["version"] != version or len(entry["days"]) > self.MAX_DAYS_PER_LOCATION:
+                entry = {"version": version, "days": {}}
+                self._locations[location] = entry
+            days = entry["days"]
+            missing = [d for d in _iter_dates(d_from, d_to) if d not in days]
+
+        if missing:
+            conn = get_db_connection()
+            try:
+                with conn.cursor() as cur:
+                    loaded = load_booked_masks(cur, location, missing[0], missing[-1])
+            finally:
+                conn.close()
+            with self._lock:
+                for d in _iter_dates(missing[0], missing[-1]):
+                    days[d] = loaded.get(d, 0)
 
-    conn = get_db_connection()
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                DELETE FROM rent_requests
-                WHERE status='approved' AND date < %s
-            """, (today,))
-            cur.execute("""
-                DELETE FROM rent_requests
-                WHERE status='approved' AND date = %s
-                  AND COALESCE(end_time,
-                               split_part(replace(time_slot,'–','-'), '-', 2)::time
-                      ) <= %s::time
-            """, (today, now_hm))
-    conn.close()
+        return {d: days.get(d, 0) for d in _iter_dates(d_from, d_to)}
+
+rent_availability = _AvailabilityIndex()
 
+def _iter_dates(d_from, d_to):
+    d = d_from
+    while d <= d_to:
+        yield d
+        d += timedelta(days=1)
+
+def parse_rent_window(args):
+    """從 query string 取查詢期間：month=YYYY-MM，或 from/to=YYYY-MM-DD；都沒有就從今天起 RENT_LOOKAHEAD_DAYS 天。"""
+    today = datetime.now(TZ).date()
+    month = (args.get("month") or "").strip()
+    if month:
+        first = datetime.strptime(month, "%Y-%m").date()
+        nxt = (first.replace(day=28) + timedelta(days=4)).replace(day=1)
+        d_from, d_to = first, nxt - timedelta(days=1)
+    else:
+        f, t = (args.get("from") or "").strip(), (args.get("to") or "").strip()
+        d_from = datetime.strptime(f, "%Y-%m-%d").date() if f else today
+        d_to = datetime.strptime(t, "%Y-%m-%d").date() if t else d_from + timedelta(days=RENT_LOOKAHEAD_DAYS)
+    if d_to < d_from or (d_to - d_from).days > RENT_MAX_WINDOW_DAYS:
+        raise ValueError("bad window")
+    return d_from, d_to
 
 # 管理員權限驗證
 def admin_required(f):
@@ -356,11 +1102,168 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# ===== 公開頁面快取（未登入訪客）=====
+# 首頁、關於、課程、回顧這幾頁幾乎不變，未登入訪客看到的 HTML 都一樣：
+# 以「host + 路徑 + 這頁認得的 query 參數 + 相關資料的版本號」為 key 快取整頁（不看 cookie），
+# 帶了其他參數（?x=亂數、追蹤碼…）的 request 直接不走快取，免得 key 被灌爆。
+# 後台改資料時 DB trigger 會遞增 cache_versions（見 migration 8），key 自然換掉。
+# 登入中、有待顯示的 flash 訊息、或這次 request 動到 session 時一律不走快取。
+#   PAGE_CACHE_BACKEND = memory（每個 process 一份 LRU，預設）| disk（多個 worker 共用）| off
+# 回應帶 ETag / Last-Modified 與 "public, no-cache"：瀏覽器 / CDN 每次都回來驗證，沒變就 304。
+PAGE_CACHE_BACKEND = (os.environ.get("PAGE_CACHE_BACKEND") or "memory").strip().lower()
+PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", 600))            # 秒；版本號之外的保險
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get("PAGE_CACHE_MAX_ENTRIES", 512))
+PAGE_CACHE_DIR = Path(os.environ.get("PAGE_CACHE_DIR") or Path(BASE_DIR) / "cache" / "pages").resolve()
+
+class _MemoryPageCache:
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if monotonic() - entry["stored_at"] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        entry = dict(entry, stored_at=monotonic())
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class _DiskPageCache:
+    """每頁一個檔案：第一行是 JSON 標頭（mimetype / etag / last_modified），其後是原始 body。"""
+    def __init__(self, root: Path, ttl: int, max_entries: int):
+        self.root = root
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def _path(self, key) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key):
+        p = self._path(key)
+        try:
+            if datetime.now().timestamp() - p.stat().st_mtime > self.ttl:
+                return None
+            with open(p, "rb") as f:
+                head = json.loads(f.readline())
+                body = f.read()
+            return {"body": body, "mimetype": head["mimetype"], "etag": head["etag"],
+                    "last_modified": datetime.fromisoformat(head["last_modified"])}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def set(self, key, entry):
+        p = self._path(key)
+        ensure_dir(p.parent)
+        tmp = p.with_name(f".{p.name}.{uuid.uuid4().hex[:8]}.tmp")
+        head = {"mimetype": entry["mimetype"], "etag": entry["etag"],
+                "last_modified": entry["last_modified"].isoformat()}
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(head).encode() + b"\n")
+            f.write(entry["body"])
+        os.replace(tmp, p)
+
+    def sweep(self) -> int:
+        """清掉過期的檔案；剩下的超過 max_entries 時再從最舊的開始刪。"""
+        cutoff = datetime.now().timestamp() - self.ttl
+        removed, kept = 0, []
+        for p in self.root.glob("*/*"):
+            try:
+                mtime = p.stat().st_mtime
+                if mtime < cutoff:
+                    p.unlink(); removed += 1
+                else:
+                    kept.append((mtime, p))
+            except OSError:
+                pass
+        if len(kept) > self.max_entries:
+            kept.sort()
+            for _mtime, p in kept[:len(kept) - self.max_entries]:
+                try:
+                    p.unlink(); removed += 1
+                except OSError:
+                    pass
+        return removed
+
+if PAGE_CACHE_BACKEND == "disk":
+    _page_cache = _DiskPageCache(PAGE_CACHE_DIR, PAGE_CACHE_TTL, PAGE_CACHE_MAX_ENTRIES)
+elif PAGE_CACHE_BACKEND == "off":
+    _page_cache = None
+else:
+    _page_cache = _MemoryPageCache(PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_TTL)
+
+def is_anonymous_page_request() -> bool:
+    return (request.method in ("GET", "HEAD")
+            and not session.get("username")
+            and not session.get("role")
+            and not session.get("_flashes"))
+
+def page_cache(*version_names, args=()):
+    """
+    公開頁面快取：version_names 是這頁內容依賴的 cache_versions 名稱，
+    args 是會改變內容的 query 參數；出現其他參數時這次 request 不走快取。
+    """
+    known = frozenset(args)
+    def decorator(view):
+        @wraps(view)
+        def _wrapped(*a, **kwargs):
+            if (_page_cache is None or not is_anonymous_page_request()
+                    or not known.issuperset(request.args.keys())):
+                return view(*a, **kwargs)
+
+            versions = ",".join(f"{n}={get_cache_version(n)}" for n in version_names)
+            query = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+            key = hashlib.sha1(f"{request.host}{request.path}?{query}|{versions}".encode()).hexdigest()
+
+            entry = _page_cache.get(key)
+            status = "HIT"
+            if entry is None:
+                resp = make_response(view(*a, **kwargs))
+                if resp.status_code != 200 or resp.direct_passthrough or session.modified:
+                    return resp
+                body = resp.get_data()
+                entry = {
+                    "body": body,
+                    "mimetype": resp.mimetype,
+                    "etag": hashlib.sha1(body).hexdigest(),
+                    "last_modified": datetime.now(timezone.utc).replace(microsecond=0),
+                }
+                _page_cache.set(key, entry)
+                status = "MISS"
+
+            resp = app.response_class(entry["body"], mimetype=entry["mimetype"])
+            resp.set_etag(entry["etag"])
+            resp.last_modified = entry["last_modified"]
+            resp.headers["Cache-Control"] = "public, no-cache"
+            resp.headers["X-Page-Cache"] = status
+            g._page_cached = True
+            return resp.make_conditional(request)
+        return _wrapped
+    return decorator
+
+@maintenance_job("sweep_page_cache", interval_seconds=3600)
+def sweep_page_cache():
+    """磁碟版頁面快取：清掉過期的檔案（版本號換掉的舊頁面也在這裡回收）。"""
+    if isinstance(_page_cache, _DiskPageCache):
+        return _page_cache.sweep()
+    return 0
+
 # ================= 頁面 =================
 @app.route("/")
-@nocache
+@page_cache("banners")
 def index():
-    ensure_banners_table()
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     cur.execute("""
@@ -373,9 +1276,9 @@ def index():
     return render_template("index.html", banners=banners)
 
 @app.route("/about")
+@page_cache("about")
 def about():
     conn = get_db_connection()
-    ensure_about_row(conn)
     cur = conn.cursor(cursor_factory=RealDictCursor)
     cur.execute("SELECT content FROM about_page WHERE id = 1;")
     result = cur.fetchone()
@@ -387,7 +1290,6 @@ def about():
 @admin_required
 def edit_about():
     conn = get_db_connection()
-    ensure_about_row(conn)
     if request.method == "POST":
         new_content = request.form.get("content", "").strip()
         with conn.cursor() as cur:
@@ -407,6 +1309,182 @@ def edit_about():
     content = (result or {}).get("content", "")
     return render_template("edit_about.html", content=content)
 
+# ===== 寄信佇列（mail_outbox）=====
+# 請求執行緒不直接連 SMTP：enqueue_mail() 只把信寫進 mail_outbox（跟留言 / 審核結果同一個交易），
+# 由排程的 mail_outbox 工作認領一批、共用同一條 SMTP 連線寄出。
+#   - 暫時性錯誤（連不上、斷線、4xx）：指數退避後重試，MAIL_MAX_ATTEMPTS 次後進 dead
+#   - 永久性錯誤（5xx、收件人全被拒、標頭不合法）：直接進 dead
+#   - 寄到一半 process 被砍：sending 超過 MAIL_CLAIM_TIMEOUT 會被重新認領（至少寄一次）
+# 本機測試可以開個假 SMTP（例如 python -m aiosmtpd -n -l localhost:1025），
+# 再設 MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_TLS=False。
+MAIL_BATCH = int(os.environ.get("MAIL_BATCH", 50))
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", 8))
+MAIL_RETRY_BASE = float(os.environ.get("MAIL_RETRY_BASE", 30))           # 第一次重試等幾秒，之後每次加倍
+MAIL_RETRY_MAX = float(os.environ.get("MAIL_RETRY_MAX", 6 * 3600))
+MAIL_TIMEOUT = float(os.environ.get("MAIL_TIMEOUT", 20))                  # SMTP 連線 / 讀寫逾時（秒）
+MAIL_CLAIM_TIMEOUT = int(os.environ.get("MAIL_CLAIM_TIMEOUT", 600))
+MAIL_RUN_BUDGET = float(os.environ.get("MAIL_RUN_BUDGET", 60))
+MAIL_OUTBOX_KEEP_DAYS = int(os.environ.get("MAIL_OUTBOX_KEEP_DAYS", 30))
+
+def enqueue_mail(cur, recipients, subject, body, kind="", reply_to=None):
+    """把一封信排進 mail_outbox，回傳 id；沒有有效收件人回傳 None。不 commit，跟著呼叫端的交易走。"""
+    recipients = [r.strip() for r in (recipients or []) if r and r.strip()]
+    if not recipients:
+        return None
+    cur.execute("""
+        INSERT INTO mail_outbox (kind, recipients, subject, body, reply_to)
+        VALUES (%s, %s, %s, %s, %s)
+        RETURNING id
+    """, (kind, recipients, subject, body, reply_to))
+    return cur.fetchone()["id"]
+
+def enqueue_mails(cur, mails) -> int:
+    """一次排入多封信（一條 INSERT）；mails 是 enqueue_mail 參數組成的 dict。回傳排入封數。"""
+    rows = []
+    for m in mails:
+        recipients = [r.strip() for r in (m.get("recipients") or []) if r and r.strip()]
+        if recipients:
+            rows.append((m.get("kind", ""), recipients, m["subject"], m["body"], m.get("reply_to")))
+    if rows:
+        execute_values(cur, """
+            INSERT INTO mail_outbox (kind, recipients, subject, body, reply_to) VALUES %s
+        """, rows)
+    return len(rows)
+
+class _OutboxSMTPConnection(MailConnection):
+    """Flask-Mail 的 Connection，多了連線 / 讀寫逾時（原版沒有，SMTP 卡住會一直等）。"""
+    def configure_host(self):
+        m = self.mail
+        if m.use_ssl:
+            host = smtplib.SMTP_SSL(m.server, m.port, timeout=MAIL_TIMEOUT)
+        else:
+            host = smtplib.SMTP(m.server, m.port, timeout=MAIL_TIMEOUT)
+        host.set_debuglevel(int(m.debug))
+        if m.use_tls:
+            host.starttls()
+        if m.username and m.password:
+            host.login(m.username, m.password)
+        return host
+
+def _mail_error_is_permanent(e) -> bool:
+    if isinstance(e, (smtplib.SMTPRecipientsRefused, BadHeaderError, AssertionError)):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 500 <= e.smtp_code < 600
+    return False
+
+def _mail_retry_delay(attempts: int) -> float:
+    delay = min(MAIL_RETRY_MAX, MAIL_RETRY_BASE * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.8, 1.2)   # 加點抖動，同一批失敗的信不會同時再打過去
+
+def claim_mail_batch(limit: int) -> list:
+    """認領到期的信（含逾時的 sending），立即 commit。"""
+    conn = get_db_connection()
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE mail_outbox
+                SET status = 'sending', claimed_at = NOW(), attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM mail_outbox
+                    WHERE (status = 'pending' AND next_attempt_at <= NOW())
+                       OR (status = 'sending' AND claimed_at < NOW() - make_interval(secs => %s))
+                    ORDER BY next_attempt_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, recipients, subject, body, reply_to, attempts
+            """, (MAIL_CLAIM_TIMEOUT, limit))
+            rows = cur.fetchall()
+    conn.close()
+    return sorted(rows, key=lambda r: r["id"])
+
+def finish_mail_batch(results: list):
+    """results: [(id, outcome, error, attempts)]；outcome = sent / retry / dead / release（沒寄到，原樣放回）。"""
+    if not results:
+        return
+    rows = []
+    for mid, outcome, error, attempts in results:
+        if outcome == "retry" and attempts >= MAIL_MAX_ATTEMPTS:
+            outcome = "dead"
+        delay = _mail_retry_delay(attempts) if outcome == "retry" else 0
+        rows.append((mid, outcome, (error or "")[:500] or None, delay))
+    conn = get_db_connection()
+    with conn:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                UPDATE mail_outbox m SET
+                    status = CASE v.outcome WHEN 'sent' THEN 'sent' WHEN 'dead' THEN 'dead' ELSE 'pending' END,
+                    attempts = m.attempts - (v.outcome = 'release')::int,
+                    sent_at = CASE WHEN v.outcome = 'sent' THEN NOW() END,
+                    last_error = COALESCE(v.error, m.last_error),
+                    next_attempt_at = NOW() + make_interval(secs => v.delay),
+                    claimed_at = NULL
+                FROM (VALUES %s) AS v(id, outcome, error, delay)
+                WHERE m.id = v.id AND m.status = 'sending'
+            """, rows, template="(%s::bigint, %s, %s::text, %s::float8)")
+    conn.close()
+    for mid, outcome, error, _ in rows:
+        if outcome == "dead":
+            app.logger.warning("mail_outbox %s dead-lettered: %s", mid, error)
+
+def send_mail_batch(jobs: list) -> list:
+    """用一條 SMTP 連線依序寄出；連線層出錯就停，這封記重試、後面的原樣放回。"""
+    results = []
+    sender = app.config.get("MAIL_DEFAULT_SENDER")
+    smtp = _OutboxSMTPConnection(mail)
+    try:
+        smtp.__enter__()   # 連線 + STARTTLS + 登入；不用 with，才分得出是連線失敗還是寄信失敗
+    except Exception as e:
+        return [(j["id"], "retry", f"connect: {e}", j["attempts"]) for j in jobs]
+    try:
+        for i, job in enumerate(jobs):
+            msg = Message(subject=job["subject"], recipients=list(job["recipients"]),
+                          body=job["body"], sender=sender, reply_to=job["reply_to"])
+            try:
+                smtp.send(msg)
+                results.append((job["id"], "sent", None, job["attempts"]))
+            except Exception as e:
+                if _mail_error_is_permanent(e):
+                    results.append((job["id"], "dead", f"{type(e).__name__}: {e}", job["attempts"]))
+                    continue
+                results.append((job["id"], "retry", f"{type(e).__name__}: {e}", job["attempts"]))
+                if isinstance(e, (smtplib.SMTPServerDisconnected, OSError)):
+                    results += [(j["id"], "release", None, j["attempts"]) for j in jobs[i + 1:]]
+                    break
+    finally:
+        try: smtp.__exit__(None, None, None)
+        except Exception: pass
+    return results
+
+@maintenance_job("mail_outbox", interval_seconds=5)
+def deliver_mail_outbox():
+    """一批一批寄，直到佇列清空、SMTP 出問題或超過本輪時間預算。回傳寄出的封數。"""
+    if not app.config.get("MAIL_SERVER"):
+        return 0
+    started = monotonic()
+    sent = 0
+    while monotonic() - started < MAIL_RUN_BUDGET:
+        jobs = claim_mail_batch(MAIL_BATCH)
+        if not jobs:
+            break
+        results = send_mail_batch(jobs)
+        finish_mail_batch(results)
+        sent += sum(1 for r in results if r[1] == "sent")
+        if any(r[1] == "release" for r in results) or not any(r[1] == "sent" for r in results):
+            break   # SMTP 那端有狀況，等下一輪
+    return sent
+
+@maintenance_job("prune_mail_outbox", interval_seconds=3600)
+def prune_mail_outbox():
+    """寄出超過 MAIL_OUTBOX_KEEP_DAYS 天的信刪掉（dead 保留待人工處理）。"""
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            DELETE FROM mail_outbox
+            WHERE status = 'sent' AND sent_at < NOW() - make_interval(days => %s)
+        """, (MAIL_OUTBOX_KEEP_DAYS,))
+        return cur.rowcount
+
 @app.route("/contact", methods=["GET", "POST"])
 def contact():
     if request.method == "POST":
@@ -421,7 +1499,9 @@ def contact():
             flash("⚠️ 驗證碼錯誤，請再試一次", "danger"); return redirect(url_for("contact"))
         if not EMAIL_RE.match(email or ""):
             flash("❌ Email 格式不正確，請重新輸入", "danger"); return redirect(url_for("contact"))
+        # 留言與通知信同一個交易寫入；信由背景的 mail_outbox 工作寄出，不佔用這個請求
         try:
+            receiver = os.environ.get("CONTACT_TO") or os.environ.get("MAIL_RECEIVER")
             conn = get_db_connection()
             with conn:
                 with conn.cursor() as cur:
@@ -429,32 +1509,161 @@ def contact():
                         "INSERT INTO contact_messages (name, email, message) VALUES (%s, %s, %s)",
                         (name, email, message)
                     )
+                    enqueue_mail(
+                        cur, [receiver],
+                        subject="🔔 聯絡表單留言",
+                        body=f"📩 姓名：{name}\n📧 Email：{email}\n📝 留言內容：\n{message}\n",
+                        kind="contact", reply_to=email,
+                    )
             conn.close()
         except Exception as e:
             flash("⚠️ 儲存留言失敗：" + str(e), "danger"); return redirect(url_for("contact"))
 
-        try:
-            receiver = os.environ.get("CONTACT_TO") or os.environ.get("MAIL_RECEIVER")
-            msg = Message(
-                subject="🔔 聯絡表單留言",
-                recipients=[receiver],
-                body=f"📩 姓名：{name}\n📧 Email：{email}\n📝 留言內容：\n{message}\n"
-            )
-            mail.send(msg)
-            flash("✅ 留言已送出，我們會盡快回覆您！", "success")
-        except Exception as e:
-            flash("⚠️ 寄送 email 失敗：" + str(e), "danger")
-
+        flash("✅ 留言已送出，我們會盡快回覆您！", "success")
         return redirect(url_for("contact"))
 
     a, b = random.randint(1, 9), random.randint(1, 9)
     session["captcha_answer"] = str(a + b)
     return render_template("contact.html", captcha_question=f"{a} + {b} = ?")
 
+# ===== 站內搜尋 =====
+# 課程回顧 / 課程 / 下載檔案的全文搜尋：PostgreSQL 的 search_tsv（GIN 索引，trigger 維護，見 migration 9），
+# 中文以兩字詞（bigram）斷詞；查詢先用索引取前 N 筆（只算 id 與排名），再回表拿標題與內文做摘要。
+SEARCH_MAX_RESULTS = 50
+SEARCH_MAX_QUERY = 100
+SEARCH_TYPES = {"review": "課程回顧", "course": "課程", "download": "下載"}
+_search_term_re = re.compile(r"[㐀-䶿一-鿿豈-﫿]+|[0-9a-z]+")
+
+def search_site(q: str, types=None, limit: int = 20) -> list:
+    """回傳 [{kind, id, title, body, rank}]，依相關度排序。"""
+    types = [t for t in (types or SEARCH_TYPES) if t in SEARCH_TYPES]
+    if not q or not types:
+        return []
+    conn = get_db_connection()
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH q AS (SELECT cjk_tsquery(%(q)s) AS tsq),
+                hits AS (
+                    SELECT 'review' AS kind, r.id, ts_rank_cd(r.search_tsv, q.tsq) AS rank
+                    FROM course_reviews r, q
+                    WHERE 'review' = ANY(%(types)s) AND r.search_tsv @@ q.tsq AND r.status = 'published'
+                    UNION ALL
+                    SELECT 'course', c.id, ts_rank_cd(c.search_tsv, q.tsq)
+                    FROM courses c, q
+                    WHERE 'course' = ANY(%(types)s) AND c.search_tsv @@ q.tsq
+                    UNION ALL
+                    SELECT 'download', d.id, ts_rank_cd(d.search_tsv, q.tsq)
+                    FROM downloads d, q
+                    WHERE 'download' = ANY(%(types)s) AND d.search_tsv @@ q.tsq
+                    ORDER BY rank DESC, id DESC
+                    LIMIT %(limit)s
+                )
+                SELECT h.kind, h.id, h.rank,
+                       COALESCE(r.title, c.title, d.title) AS title,
+                       CASE h.kind
+                         WHEN 'review' THEN left(concat_ws(' ', r.summary, strip_html(r.content_html)), 4000)
+                         WHEN 'course' THEN left(c.description, 4000)
+                         ELSE ''
+                       END AS body
+                FROM hits h
+                LEFT JOIN course_reviews r ON h.kind = 'review' AND r.id = h.id
+                LEFT JOIN courses c ON h.kind = 'course' AND c.id = h.id
+                LEFT JOIN downloads d ON h.kind = 'download' AND d.id = h.id
+                ORDER BY h.rank DESC, h.id DESC
+            """, {"q": q, "types": types, "limit": limit})
+            rows = cur.fetchall()
+    conn.close()
+    return rows
+
+def search_terms(q: str) -> list:
+    """和資料庫同一套斷詞：中文連續字切成兩字詞（單字保留），英數字整個字。"""
+    terms = set()
+    for tok in _search_term_re.findall((q or "").lower()):
+        if tok[0].isascii() or len(tok) == 1:
+            terms.add(tok)
+        else:
+            terms.update(tok[i:i + 2] for i in range(len(tok) - 1))
+    return sorted(terms, key=len, reverse=True)
+
+def highlight_snippet(text: str, terms: list, width: int = 120) -> Markup:
+    """取第一個命中附近 width 字，命中處包 <mark>（其餘內容一律跳脫）。"""
+    text = re.sub(r"\s+", " ", text or "").strip()
+    low = text.lower()
+    spans = []
+    for term in terms:
+        start = low.find(term)
+        while start != -1:
+            spans.append((start, start + len(term)))
+            start = low.find(term, start + 1)
+    merged = []
+    for s, e in sorted(spans):
+        if merged and s <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+
+    begin = max(0, merged[0][0] - width // 4) if merged else 0
+    end = min(len(text), begin + width)
+    out = [Markup("…")] if begin > 0 else []
+    pos = begin
+    for s, e in merged:
+        if e <= begin or s >= end:
+            continue
+        s, e = max(s, begin), min(e, end)
+        out.append(escape(text[pos:s]))
+        out.append(Markup("<mark>") + escape(text[s:e]) + Markup("</mark>"))
+        pos = e
+    out.append(escape(text[pos:end]))
+    if end < len(text):
+        out.append(Markup("…"))
+    return Markup("").join(out)
+
+def search_result_url(kind: str, rid: int) -> str:
+    if kind == "review":
+        return url_for("review_detail", rid=rid)
+    if kind == "course":
+        return url_for("courses", _anchor=f"course-{rid}")
+    return url_for("download_file", file_id=rid)
+
+def run_search(args):
+    """解析 q / type / limit，回傳 (q, type, results)。"""
+    q = (args.get("q") or "").strip()[:SEARCH_MAX_QUERY]
+    kind = args.get("type") or ""
+    try:
+        limit = min(max(int(args.get("limit", 20)), 1), SEARCH_MAX_RESULTS)
+    except (TypeError, ValueError):
+        limit = 20
+    rows = search_site(q, [kind] if kind in SEARCH_TYPES else None, limit)
+    terms = search_terms(q)
+    results = [{
+        "type": r["kind"],
+        "type_label": SEARCH_TYPES[r["kind"]],
+        "id": r["id"],
+        "title": r["title"],
+        "title_html": highlight_snippet(r["title"], terms, width=200),
+        "snippet_html": highlight_snippet(r["body"], terms) if r["body"] else Markup(""),
+        "url": search_result_url(r["kind"], r["id"]),
+        "rank": round(float(r["rank"]), 4),
+    } for r in rows]
+    return q, (kind if kind in SEARCH_TYPES else ""), results
+
+@app.route("/search")
+def search():
+    q, kind, results = run_search(request.args)
+    return render_template("search.html", q=q, kind=kind, results=results, search_types=SEARCH_TYPES)
+
+@app.route("/api/search")
+def api_search():
+    q, kind, results = run_search(request.args)
+    for r in results:
+        r["title_html"] = str(r["title_html"])
+        r["snippet_html"] = str(r["snippet_html"])
+    return jsonify({"q": q, "type": kind or None, "count": len(results), "results": results})
+
 # ===== 下載專區 =====
 @app.route("/download")
 def downloads():
-    ensure_downloads_table()
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     cur.execute("""
@@ -489,7 +1698,9 @@ def download_file(file_id):
     ext = os.path.splitext(filename)[1]
     download_name = f"{row['title']}{ext}"
     guessed = mimetypes.guess_type(filename)[0] or "application/octet-stream"
-    return send_file(file_path, as_attachment=True, download_name=download_name, mimetype=guessed)
+    # 檔名是上傳時產生的 uuid，內容不會變；快取一小時、之後靠 ETag 驗證（刪檔後最多晚一小時生效）
+    return send_file_offloaded(file_path, mimetype=guessed, cache_control="public, max-age=3600",
+                               as_attachment=True, download_name=download_name)
 
 @app.route("/download/delete/<int:file_id>", methods=["POST"])
 @admin_required
@@ -517,7 +1728,6 @@ def delete_download(file_id):
 @app.route("/upload_file", methods=["GET", "POST"])
 @admin_required
 def upload_file():
-    ensure_downloads_table()
     if request.method == "POST":
         file = request.files.get("file")
         title = (request.form.get("title") or "").strip()
@@ -552,6 +1762,302 @@ def news():
 
 # ===== 租借 =====
 # ===== 租借（自由起訖時間 + 舊 time_slot 仍寫入顯示字串）=====
+# ===== 租借寫入（排他約束）=====
+# 防重疊完全交給資料庫：rent_requests.during（tstzrange）上的 excl_rent_overlap 排他約束（migration 13），
+# 只管 pending / approved。寫入 / 改狀態都是「一條語句、一個交易」，違反約束時轉成給使用者看的 BookingError。
+# 兩筆重疊的申請同時檢查約束時，PostgreSQL 可能讓其中一筆以死鎖收場：這種暫時性錯誤小睡後重試，最多 RENT_BOOK_RETRIES 次。
+RENT_BOOK_RETRIES = int(os.environ.get("RENT_BOOK_RETRIES", 3))
+
+class BookingError(Exception):
+    """租借寫入失敗（時段被佔用、時間不合法…），訊息可以直接 flash 給使用者。"""
+
+_BOOKING_CHECK_MESSAGES = {
+    "chk_rent_time_step15": "時間需以 15 分鐘為單位",
+    "chk_rent_time_order": "結束時間需晚於開始時間",
+    "chk_rent_status": "申請狀態不正確",
+}
+
+def run_booking_statement(conn, fn):
+    """在自己的交易裡執行 fn(cur) 並提交，回傳 fn 的結果。"""
+    for attempt in range(RENT_BOOK_RETRIES + 1):
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    return fn(cur)
+        except (psycopg2.errors.DeadlockDetected, psycopg2.errors.SerializationFailure):
+            if attempt >= RENT_BOOK_RETRIES:
+                raise BookingError("目前申請的人很多，請稍後再試")
+            sleep(random.uniform(0.005, 0.02) * (2 ** attempt))
+        except psycopg2.errors.ExclusionViolation:
+            raise BookingError("這個時段已被其他申請佔用，請改時間")
+        except psycopg2.errors.CheckViolation as e:
+            raise BookingError(_BOOKING_CHECK_MESSAGES.get(e.diag.constraint_name, "時間設定不正確"))
+
+# 沒有 btree_gist 的資料庫，排他約束是每個場地各一條（migration 13）；場地沒有約束就不收會佔時段的寫入，
+# 免得重疊沒人擋。有約束的場地記在 process 內（約束只由 migration 加上），沒有的每次重查，補上後不必重啟。
+_rent_guarded_locations = set()
+
+def rent_overlap_guarded(cur, location) -> bool:
+    if location in _rent_guarded_locations:
+        return True
+    cur.execute("""
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'rent_requests'::regclass AND conname IN (%s, %s)
+    """, (RENT_OVERLAP_CONSTRAINT, rent_overlap_constraint_name(location)))
+    if cur.fetchone() is None:
+        app.logger.error("rent_requests 沒有場地「%s」的排他約束，重新啟動 app 或執行 flask --app app migrate", location)
+        return False
+    _rent_guarded_locations.add(location)
+    return True
+
+def require_rent_overlap_guard(cur, location):
+    if not rent_overlap_guarded(cur, location):
+        raise BookingError("這個場地暫時無法線上申請，請直接與我們聯繫")
+
+def book_rent(conn, location, d, s_t, e_t, name, phone, email, note="") -> int:
+    """新增一筆 pending 申請，回傳 id；時段衝突丟 BookingError。"""
+    label = f"{s_t.strftime('%H:%M')}–{e_t.strftime('%H:%M')}"  # 顯示用
+    def insert(cur):
+        require_rent_overlap_guard(cur, location)
+        cur.execute("""
+            INSERT INTO rent_requests
+              (location, date, time_slot, start_time, end_time,
+               name, phone, email, note, status, submitted_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending', NOW())
+            RETURNING id
+        """, (location, d, label, s_t, e_t, name, phone, email, note))
+        return cur.fetchone()["id"]
+    return run_booking_statement(conn, insert)
+
+def set_rent_status(conn, rent_id, new_status):
+    """
+    改申請狀態（核准 / 駁回），狀態真的有變才回傳該列、並在同一個交易排入通知信。
+    把已駁回的申請重新核准時，若時段已被別人佔走會被排他約束擋下（BookingError）。
+    """
+    def update(cur):
+        cur.execute("""
+            UPDATE rent_requests SET status = %s
+            WHERE id = %s AND status IS DISTINCT FROM %s
+            RETURNING name, email, location, date, time_slot, start_time, end_time, status
+        """, (new_status, rent_id, new_status))
+        rent = cur.fetchone()
+        if rent and rent["status"] in _RENT_ACTIVE:
+            require_rent_overlap_guard(cur, rent["location"])   # 丟 BookingError 時整個交易回滾
+        if rent and rent["email"]:
+            enqueue_rent_status_mail(cur, rent)
+        return rent
+    return run_booking_statement(conn, update)
+
+RENT_BULK_MAX = int(os.environ.get("RENT_BULK_MAX", 500))
+RENT_ACTIONS = {"approve": "approved", "reject": "rejected"}
+_RENT_ACTIVE = ("pending", "approved")   # 和排他約束的 WHERE 一致
+
+def apply_rent_statuses(conn, changes):
+    """
+    批次核准 / 駁回：changes 是 [(id, "approve" | "reject")]，全部在同一個交易裡處理，
+    回傳每一筆的結果 [{"id", "action", "result", "status", "message"}]，順序同 changes。
+    result：updated 已更新 / unchanged 本來就是這個狀態 / conflict 時段衝突未核准 / not_found / invalid。
+
+    會讓申請重新佔用時段的（已駁回 → 核准）先用一條查詢對照現有申請找衝突，
+    同一批彼此重疊的則依 changes 的順序先到先得；之後駁回、核准各一條 UPDATE … WHERE id = ANY(…)。
+    先駁回再核准，讓同一批裡「駁回 A、核准與 A 重疊的 B」不會被排他約束誤擋。
+    """
+    plan, results = {}, []
+    for rid, action in changes:
+        res = {"id": rid, "action": action, "result": "invalid", "status": None, "message": ""}
+        results.append(res)
+        if not isinstance(action, str) or action not in RENT_ACTIONS:
+            res["message"] = "不支援的操作"
+        elif rid in plan:
+            res["message"] = "同一筆申請重複出現"
+        else:
+            plan[rid] = res
+
+    def apply(cur):
+        for res in plan.values():
+            res.update(result="not_found", status=None, message="找不到這筆申請")
+        # 依 id 順序鎖列，兩個管理員同時批次處理時不會互相死鎖
+        cur.execute("""
+            SELECT id, status, location, date, start_time, end_time
+            FROM rent_requests WHERE id = ANY(%s)
+            ORDER BY id
+            FOR UPDATE
+        """, (list(plan),))
+        current = {r["id"]: r for r in cur.fetchall()}
+
+        targets = {}
+        for rid, res in plan.items():
+            row = current.get(rid)
+            if row is None:
+                continue
+            new_status = RENT_ACTIONS[res["action"]]
+            res.update(status=row["status"], message="")
+            if row["status"] == new_status:
+                res["result"] = "unchanged"
+            else:
+                targets[rid] = new_status
+        releasing = [rid for rid, st in targets.items()
+                     if st not in _RENT_ACTIVE and current[rid]["status"] in _RENT_ACTIVE]
+        claiming = [rid for rid, st in targets.items()
+                    if st in _RENT_ACTIVE and current[rid]["status"] not in _RENT_ACTIVE]
+
+        if claiming:
+            cur.execute("""
+                SELECT c.id, string_agg(r.time_slot || '（#' || r.id || '）', '、' ORDER BY r.start_time) AS taken
+                FROM rent_requests c
+                JOIN rent_requests r
+                  ON r.location = c.location AND r.date = c.date AND r.during && c.during
+                 AND r.status IN ('pending', 'approved') AND r.id <> ALL(%s)
+                WHERE c.id = ANY(%s)
+                GROUP BY c.id
+            """, (releasing, claiming))
+            taken = {r["id"]: r["taken"] for r in cur.fetchall()}
+            accepted = []
+            for rid in claiming:   # plan 保留 changes 的順序：同一批彼此重疊時先到先得
+                row = current[rid]
+                if not rent_overlap_guarded(cur, row["location"]):
+                    del targets[rid]
+                    plan[rid].update(result="conflict", message="這個場地缺少防重疊約束，暫時不能核准")
+                    continue
+                clash = taken.get(rid) or next((
+                    f"#{o['id']}" for o in accepted
+                    if o["location"] == row["location"] and o["date"] == row["date"]
+                    and row["start_time"] and o["start_time"]
+                    and row["start_time"] < o["end_time"] and o["start_time"] < row["end_time"]
+                ), None)
+                if clash:
+                    del targets[rid]
+                    plan[rid].update(result="conflict", message=f"時段與 {clash} 重疊")
+                else:
+                    accepted.append(row)
+
+        updated = []
+        for new_status in ("rejected", "approved"):
+            ids = [rid for rid, st in targets.items() if st == new_status]
+            if not ids:
+                continue
+            cur.execute("""
+                UPDATE rent_requests SET status = %s
+                WHERE id = ANY(%s)
+                RETURNING id, name, email, location, date, time_slot, start_time, end_time, status
+            """, (new_status, ids))
+            updated += cur.fetchall()
+        for row in updated:
+            plan[row["id"]].update(result="updated", status=row["status"])
+        enqueue_mails(cur, [rent_status_mail(r) for r in updated if r["email"]])
+        return results
+
+    if not plan:
+        return results
+    return run_booking_statement(conn, apply)
+
+# 重複預約（固定上課的老師）：每 N 週同一天直到某日，或指定多個日期；同一場地、同一時段。
+# 所有日期用一條查詢（generate_series / unnest 展開後對 during 做 &&）找出衝突，再用一條 INSERT … SELECT 寫入。
+RENT_SERIES_MAX = int(os.environ.get("RENT_SERIES_MAX", 104))
+RENT_SERIES_EVERY_MAX = 4
+
+_RENT_OCCURRENCES = {
+    "weekly": "SELECT g::date AS d FROM generate_series(%(first)s::date, %(until)s::date,"
+              " make_interval(weeks => %(every)s)) AS g",
+    "dates": "SELECT DISTINCT d FROM unnest(%(dates)s::date[]) AS d",
+}
+
+def parse_rent_series(first, form):
+    """讀 /rent 表單的重複設定；不重複回傳 None，設定不合理丟 ValueError（訊息可直接 flash）。"""
+    kind = (form.get("repeat") or "").strip()
+    if not kind:
+        return None
+    if kind == "weekly":
+        try:
+            every = int(form.get("repeat_every") or 1)
+        except ValueError:
+            raise ValueError("重複間隔不正確")
+        try:
+            until = datetime.strptime((form.get("repeat_until") or "").strip(), "%Y-%m-%d").date()
+        except ValueError:
+            raise ValueError("請選擇重複的截止日期")
+        if not 1 <= every <= RENT_SERIES_EVERY_MAX:
+            raise ValueError(f"重複間隔需為 1～{RENT_SERIES_EVERY_MAX} 週")
+        if until < first:
+            raise ValueError("截止日期不能早於第一次的日期")
+        count = (until - first).days // (7 * every) + 1
+        if count > RENT_SERIES_MAX:
+            raise ValueError(f"一次最多申請 {RENT_SERIES_MAX} 個日期")
+        dates = [first + timedelta(weeks=every * i) for i in range(count)]
+        spec = {"kind": kind, "first": first, "until": until, "every": every, "dates": None}
+    elif kind == "dates":
+        picked = {first}
+        for token in re.split(r"[\s,，、]+", form.get("repeat_dates") or ""):
+            if not token:
+                continue
+            try:
+                picked.add(datetime.strptime(token, "%Y-%m-%d").date())
+            except ValueError:
+                raise ValueError(f"日期格式錯誤：{token[:20]}（請用 YYYY-MM-DD）")
+            if len(picked) > RENT_SERIES_MAX:
+                break
+        if min(picked) < datetime.now(TZ).date():
+            raise ValueError("不能選擇今天以前的日期")
+        dates = sorted(picked)
+        spec = {"kind": kind, "first": first, "until": None, "every": None, "dates": dates}
+    else:
+        raise ValueError("重複方式不正確")
+    if len(dates) > RENT_SERIES_MAX:
+        raise ValueError(f"一次最多申請 {RENT_SERIES_MAX} 個日期")
+    spec["occurrences"] = dates
+    return spec
+
+def book_rent_series(conn, location, spec, s_t, e_t, name, phone, email, note="", skip_conflicts=False):
+    """
+    一次申請 spec（parse_rent_series 的結果）裡每個日期的同一時段。
+    回傳 (booked, conflicts)：booked 是寫入的日期，conflicts 是 [(日期, 該日已被佔用的時段)]。
+    有衝突時預設整批不寫（booked 為空）；skip_conflicts=True 則略過衝突日期、其餘照寫。
+    """
+    occurrences = _RENT_OCCURRENCES[spec["kind"]]
+    params = dict(spec, loc=location, s=s_t, e=e_t, name=name, phone=phone, email=email, note=note,
+                  label=f"{s_t.strftime('%H:%M')}–{e_t.strftime('%H:%M')}")
+    def book(cur):
+        require_rent_overlap_guard(cur, location)
+        # during 的算法要跟 migration 13 的生成欄位一致，才吃得到排他約束的 GiST 索引
+        cur.execute(f"""
+            WITH occ AS ({occurrences})
+            SELECT occ.d, string_agg(r.time_slot, '、' ORDER BY r.start_time) AS taken
+            FROM occ
+            JOIN rent_requests r
+              ON r.location = %(loc)s AND r.date = occ.d
+             AND r.status IN ('pending', 'approved')
+             AND r.during && tstzrange(timezone('Asia/Taipei', occ.d + %(s)s::time),
+                                       timezone('Asia/Taipei', occ.d + %(e)s::time), '[)')
+            GROUP BY occ.d
+            ORDER BY occ.d
+        """, params)
+        conflicts = [(r["d"], r["taken"]) for r in cur.fetchall()]
+        if conflicts and not skip_conflicts:
+            return [], conflicts
+
+        # 查完到寫入之間被搶走的日期由排他約束擋下，ON CONFLICT DO NOTHING 跳過、不讓整批失敗
+        cur.execute(f"""
+            WITH occ AS ({occurrences})
+            INSERT INTO rent_requests
+              (location, date, time_slot, start_time, end_time,
+               name, phone, email, note, status, submitted_at)
+            SELECT %(loc)s, occ.d, %(label)s, %(s)s, %(e)s,
+                   %(name)s, %(phone)s, %(email)s, %(note)s, 'pending', NOW()
+            FROM occ
+            WHERE occ.d <> ALL(%(skip)s::date[])
+            ORDER BY occ.d
+            ON CONFLICT DO NOTHING
+            RETURNING date
+        """, dict(params, skip=[d for d, _ in conflicts]))
+        booked = sorted(r["date"] for r in cur.fetchall())
+        raced = sorted(set(spec["occurrences"]) - set(booked) - {d for d, _ in conflicts})
+        if raced and not skip_conflicts:
+            raise BookingError("以下日期剛被其他申請佔用："
+                               + "、".join(d.isoformat() for d in raced) + "，請重新送出")
+        conflicts = sorted(conflicts + [(d, "（剛被其他申請佔用）") for d in raced])
+        return booked, conflicts
+    return run_booking_statement(conn, book)
+
 @app.route("/rent", methods=["GET", "POST"])
 def rent():
     if request.method == "POST":
@@ -566,6 +2072,8 @@ def rent():
 
         if not (location and date_str and start_hm and end_hm and name and phone):
             flash("❌ 必填欄位未填寫完整"); return redirect(url_for("rent"))
+        if location not in LOCATION_ALBUMS:
+            flash("❌ 沒有這個場地"); return redirect(url_for("rent"))
 
         # 日期檢查
         try:
@@ -609,51 +2117,24 @@ def rent():
         if s_t < BUSINESS_OPEN or e_t > BUSINESS_CLOSE:
             flash("❌ 租借時間需在 09:00～21:30 之間"); return redirect(url_for("rent"))
 
-        time_slot_label = f"{s_t.strftime('%H:%M')}–{e_t.strftime('%H:%M')}"  # 顯示用
-
-        # 寫入（有 GiST 排他約束防重疊）
         try:
-            conn = get_db_connection()
-            with conn:
-                with conn.cursor() as cur:
-                    # 應用層再檢查一次重疊（雙保險）
-                    cur.execute("""
-                        SELECT 1
-                        FROM rent_requests
-                        WHERE location=%s AND date=%s
-                          AND status IN ('pending','approved')
-                          AND start_time IS NOT NULL AND end_time IS NOT NULL
-                          AND tsrange((date + start_time)::timestamp,
-                                      (date + end_time)::timestamp, '[)')
-                              &&
-                              tsrange(%s::timestamp, %s::timestamp, '[)')
-                        LIMIT 1
-                    """, (location, d, datetime.combine(d, s_t), datetime.combine(d, e_t)))
-                    if cur.fetchone():
-                        conn.close()
-                        flash("❌ 這個時段已被其他申請佔用，請改時間"); return redirect(url_for("rent"))
+            series = parse_rent_series(d, request.form)
+        except ValueError as e:
+            flash(f"❌ {e}"); return redirect(url_for("rent"))
+        if series:
+            return _submit_rent_series(series, location, s_t, e_t, name, phone, email, note)
 
-                    cur.execute("""
-                        INSERT INTO rent_requests
-                          (location, date, time_slot, start_time, end_time,
-                           name, phone, email, note, status, submitted_at)
-                        VALUES
-                          (%s, %s, %s, %s, %s,
-                           %s, %s, %s, %s, 'pending', NOW())
-                    """, (location, d, time_slot_label, s_t, e_t,
-                          name, phone, email, note))
-            conn.close()
+        # 寫入：一條 INSERT，重疊由排他約束擋（不先查再寫，並發送出也不會重複預約）
+        conn = get_db_connection()
+        try:
+            book_rent(conn, location, d, s_t, e_t, name, phone, email, note)
+        except BookingError as e:
+            flash(f"❌ {e}"); return redirect(url_for("rent"))
         except Exception as e:
-            msg = str(e)
-            if "excl_rent_overlap" in msg:
-                flash("❌ 這個時段已被佔用，請改時間")
-            elif "chk_rent_time_step15" in msg:
-                flash("❌ 時間需以 15 分鐘為單位")
-            elif "chk_rent_time_order" in msg:
-                flash("❌ 結束時間需晚於開始時間")
-            else:
-                flash("❌ 送出失敗，請稍後再試")
+            print("租借申請寫入錯誤：", e); flash("❌ 送出失敗，請稍後再試")
             return redirect(url_for("rent"))
+        finally:
+            conn.close()
 
         flash("✅ 已送出申請，請等待審核")
         return redirect(url_for("rent"))
@@ -661,10 +2142,29 @@ def rent():
     # GET
     return render_template("rent.html", now=datetime.now(TZ).isoformat())
 
+def _submit_rent_series(series, location, s_t, e_t, name, phone, email, note):
+    """重複預約的送出：全部成功就照舊 flash；有衝突時直接回表單頁列出衝突日期（保留已填內容）。"""
+    conn = get_db_connection()
+    try:
+        booked, conflicts = book_rent_series(conn, location, series, s_t, e_t, name, phone, email, note,
+                                             skip_conflicts=request.form.get("repeat_skip") == "1")
+    except BookingError as e:
+        flash(f"❌ {e}"); return redirect(url_for("rent"))
+    except Exception as e:
+        print("重複租借申請寫入錯誤：", e); flash("❌ 送出失敗，請稍後再試")
+        return redirect(url_for("rent"))
+    finally:
+        conn.close()
+
+    if not conflicts:
+        flash(f"✅ 已送出 {len(booked)} 筆申請（{booked[0]:%m/%d}～{booked[-1]:%m/%d}），請等待審核")
+        return redirect(url_for("rent"))
+    return render_template("rent.html", now=datetime.now(TZ).isoformat(), form=request.form,
+                           series={"booked": booked, "conflicts": conflicts})
+
 @app.route("/admin/banners", methods=["GET", "POST"])
 @admin_required
 def admin_banners():
-    ensure_banners_table()
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
@@ -808,83 +2308,548 @@ def api_rent_disabled_dates():
     location = (request.args.get("location") or "").strip()
     if not location:
         return jsonify({"disabled_dates": []})
+    try:
+        d_from, d_to = parse_rent_window(request.args)
+    except ValueError:
+        return jsonify({"error": "bad date"}), 400
+
+    # 已額滿（含今天已過去的時段）的日期
+    now = datetime.now(TZ)
+    masks = rent_availability.masks(location, d_from, d_to)
+    disabled = [d.strftime("%Y-%m-%d") for d, mask in masks.items()
+                if (mask | past_mask(d, now)) == FULL_MASK]
+    return jsonify({"disabled_dates": disabled})
+
+@app.route("/api/rent/timeslots", methods=["GET"])
+def api_rent_timeslots():
+    location = (request.args.get("location") or "").strip()
+    date_str = (request.args.get("date") or "").strip()
+    if not location or not date_str:
+        return jsonify({"available": [], "free_ranges": []})
+
+    try:
+        d = datetime.strptime(date_str, "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"error": "bad date"}), 400
+
+    now = datetime.now(TZ)
+    if d < now.date():
+        return jsonify({"available": [], "free_ranges": []})
+
+    mask = rent_availability.masks(location, d, d)[d] | past_mask(d, now)
+
+    # available：固定時段（舊版前端）；free_ranges：所有可借的連續區間
+    available = []
+    for val, start_hm, end_hm in TIME_SLOTS:
+        s_t = datetime.strptime(start_hm, "%H:%M").time()
+        e_t = datetime.strptime(end_hm, "%H:%M").time()
+        if mask & range_mask(s_t, e_t): continue
+        available.append({"id": val, "label": val.replace("-", "–")})
+    ranges = [{"start": s_t.strftime("%H:%M"), "end": e_t.strftime("%H:%M"),
+               "label": f"{s_t.strftime('%H:%M')}–{e_t.strftime('%H:%M')}"}
+              for s_t, e_t in free_ranges(mask)]
+    return jsonify({"available": available, "free_ranges": ranges})
+
+# 月曆用：一次回傳整段期間每天的可借區間；ETag 由場地版本號決定，沒變就 304
+AVAILABILITY_CACHE_TTL = float(os.environ.get("AVAILABILITY_CACHE_TTL", 30))
+_availability_cache = {}   # (location, from, to, version, bucket) -> (expires_at, payload)
+_availability_cache_lock = threading.Lock()
+
+@app.route("/api/rent/availability", methods=["GET"])
+def api_rent_availability():
+    location = (request.args.get("location") or "").strip()
+    if not location:
+        return jsonify({"error": "location required"}), 400
+    try:
+        d_from, d_to = parse_rent_window(request.args)
+    except ValueError:
+        return jsonify({"error": "bad date"}), 400
+
+    now = datetime.now(TZ)
+    version = get_cache_version(f"rent:{location}")
+    # 今天「已過去的時段」每 15 分鐘變一次，也要算進 ETag / 快取鍵
+    bucket = f"{now.date().isoformat()}#{slot_index(now.time())}"
+    key = (location, d_from, d_to, version, bucket)
+    etag = hashlib.sha1("|".join(map(str, key)).encode("utf-8")).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        resp = make_response("", 304)
+    else:
+        with _availability_cache_lock:
+            cached = _availability_cache.get(key)
+        if cached and cached[0] > monotonic():
+            payload = cached[1]
+        else:
+            masks = rent_availability.masks(location, d_from, d_to)
+            days = {}
+            for d, mask in masks.items():
+                mask |= past_mask(d, now)
+                days[d.isoformat()] = {
+                    "full": mask == FULL_MASK,
+                    "free": [[s_t.strftime("%H:%M"), e_t.strftime("%H:%M")] for s_t, e_t in free_ranges(mask)],
+                }
+            payload = {"location": location, "from": d_from.isoformat(), "to": d_to.isoformat(),
+                       "version": version, "days": days}
+            with _availability_cache_lock:
+                if len(_availability_cache) > 256:
+                    expired = [k for k, (exp, _p) in _availability_cache.items() if exp <= monotonic()]
+                    for k in expired or list(_availability_cache)[:128]:
+                        _availability_cache.pop(k, None)
+                _availability_cache[key] = (monotonic() + AVAILABILITY_CACHE_TTL, payload)
+        resp = jsonify(payload)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "public, max-age=0, must-revalidate"
+    return resp
+
+MANAGE_RENTS_PAGE_SIZE = 50
+RENT_STATUSES = ("pending", "approved", "rejected")
+RENT_ARCHIVED_STATUSES = RENT_STATUSES + ("expired",)   # 封存時過期未審的改成 expired
+
+def _safe_next_url(value, fallback):
+    """只接受站內相對路徑，避免 open redirect。"""
+    value = (value or "").strip()
+    if value.startswith("/") and not value.startswith("//"):
+        return value
+    return fallback
+
+def rent_status_mail(rent) -> dict:
+    """租借申請核准 / 駁回的通知信內容（enqueue_mail 的參數）。"""
+    if rent["start_time"] and rent["end_time"]:
+        slot = f"{rent['start_time'].strftime('%H:%M')}–{rent['end_time'].strftime('%H:%M')}"
+    else:
+        slot = rent["time_slot"]
+    approved = rent["status"] == "approved"
+    result = "已核准" if approved else "未能核准"
+    body = (
+        f"{rent['name']} 您好：\n\n"
+        f"您申請的教室租借{result}。\n\n"
+        f"📍 場地：{rent['location']}\n"
+        f"📅 日期：{rent['date'].strftime('%Y-%m-%d')}\n"
+        f"🕘 時段：{slot}\n\n"
+        + ("請準時前往，如需取消請與我們聯繫。\n" if approved
+           else "該時段可能已有其他安排，歡迎改選其他時段或與我們聯繫。\n")
+    )
+    return {"recipients": [rent["email"]], "subject": f"教室租借申請{result}", "body": body,
+            "kind": f"rent_{rent['status']}"}
 
-    total_slots_per_day = 3
+def enqueue_rent_status_mail(cur, rent):
+    """租借申請核准 / 駁回通知申請人。"""
+    return enqueue_mail(cur, **rent_status_mail(rent))
+
+@app.route("/manage_rents", methods=["GET", "POST"])
+@admin_required
+def manage_rents():
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT date, COUNT(DISTINCT time_slot) AS cnt
-        FROM rent_requests
-        WHERE location=%s
-          AND status IN ('pending','approved')
-        GROUP BY date
-        HAVING COUNT(DISTINCT time_slot) >= %s
-        ORDER BY date
-    """, (location, total_slots_per_day))
-    rows = cur.fetchall()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    if request.method == "POST":
+        rent_id = request.form["id"]
+        action = request.form["action"]
+        new_status = {"approve": "approved", "reject": "rejected"}.get(action)
+        if new_status:
+            try:
+                set_rent_status(conn, rent_id, new_status)
+            except BookingError as e:
+                flash(f"❌ 無法{'核准' if new_status == 'approved' else '駁回'}：{e}")
+        conn.close()
+        return redirect(_safe_next_url(request.form.get("next"), url_for("manage_rents")))
+
+    # 篩選條件（場地 / 狀態 / 租借日期區間）
+    filters = {
+        "location": (request.args.get("location") or "").strip(),
+        "status": (request.args.get("status") or "").strip(),
+        "date_from": (request.args.get("date_from") or "").strip(),
+        "date_to": (request.args.get("date_to") or "").strip(),
+        "archived": "1" if request.args.get("archived") == "1" else "",   # 已結束、搬到封存表的申請（唯讀）
+    }
+    table = "rent_requests_archive" if filters["archived"] else "rent_requests"
+    where, params = ["TRUE"], []
+    if filters["location"]:
+        where.append("location = %s"); params.append(filters["location"])
+    for key, op in (("date_from", ">="), ("date_to", "<=")):
+        if filters[key]:
+            try:
+                params.append(datetime.strptime(filters[key], "%Y-%m-%d").date())
+                where.append(f"date {op} %s")
+            except ValueError:
+                filters[key] = ""
+    base_where, base_params = " AND ".join(where), list(params)
+    if filters["status"] in (RENT_ARCHIVED_STATUSES if filters["archived"] else RENT_STATUSES):
+        where.append("status = %s"); params.append(filters["status"])
+    else:
+        filters["status"] = ""
+
+    # keyset 分頁：before = "<submitted_at ISO>|<id>"（上一頁最後一筆）
+    before = (request.args.get("before") or "").strip()
+    if before:
+        try:
+            ts, rid = before.rsplit("|", 1)
+            where.append("(submitted_at, id) < (%s, %s)")
+            params += [datetime.fromisoformat(ts), int(rid)]
+        except ValueError:
+            before = ""
+
+    cur.execute(f"""
+        SELECT id, submitted_at, location, date, time_slot, start_time, end_time,
+               name, phone, email, note, status
+        FROM {table}
+        WHERE {" AND ".join(where)}
+        ORDER BY submitted_at DESC, id DESC
+        LIMIT %s
+    """, params + [MANAGE_RENTS_PAGE_SIZE + 1])
+    rents = cur.fetchall()
+    next_before = None
+    if len(rents) > MANAGE_RENTS_PAGE_SIZE:
+        rents = rents[:MANAGE_RENTS_PAGE_SIZE]
+        last = rents[-1]
+        next_before = f"{last['submitted_at'].isoformat()}|{last['id']}"
+
+    # 各狀態筆數（同樣的場地/日期篩選，一次 GROUP BY）
+    cur.execute(f"""
+        SELECT status, COUNT(*) AS n
+        FROM {table}
+        WHERE {base_where}
+        GROUP BY status
+    """, base_params)
+    status_counts = {r["status"]: r["n"] for r in cur.fetchall()}
+    conn.close()
+
+    active_filters = {k: v for k, v in filters.items() if v}
+    return render_template("manage_rents.html", rents=rents, filters=filters, bulk_max=RENT_BULK_MAX,
+                           active_filters=active_filters, status_counts=status_counts,
+                           locations=list(LOCATION_ALBUMS), before=before, next_before=next_before)
+
+@app.route("/manage_rents/bulk", methods=["POST"])
+@admin_required
+def manage_rents_bulk():
+    """
+    批次核准 / 駁回（apply_rent_statuses，一個交易）。
+    JSON：{"actions": [{"id": 1, "action": "approve"}, …]} 或 {"ids": [1, 2], "action": "reject"}，
+    回傳每一筆的結果 {"results": [...], "summary": {result: 筆數}}；
+    管理頁勾選後用表單送出（ids + action）則 flash 摘要後回到原頁。
+    """
+    as_json = request.is_json
+    back = _safe_next_url(request.form.get("next"), url_for("manage_rents"))
+
+    def fail(msg, code=400):
+        if as_json:
+            return jsonify({"error": msg}), code
+        flash(f"❌ {msg}"); return redirect(back)
+
+    if as_json:
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return fail("JSON 格式錯誤")
+        items = payload.get("actions")
+        if items is None:
+            items = [{"id": rid, "action": payload.get("action")} for rid in payload.get("ids") or []]
+    else:
+        items = [{"id": rid, "action": request.form.get("action")} for rid in request.form.getlist("ids")]
+    if not isinstance(items, list) or not items:
+        return fail("沒有選擇任何申請")
+    if len(items) > RENT_BULK_MAX:
+        return fail(f"一次最多處理 {RENT_BULK_MAX} 筆", 413)
+    changes = []
+    for item in items:
+        if not isinstance(item, dict) or isinstance(item.get("id"), (bool, list, dict)):
+            return fail("申請編號不正確")
+        try:
+            rid = int(item["id"])
+        except (TypeError, ValueError, KeyError):
+            return fail("申請編號不正確")
+        # action 不是字串（清單、物件…）一律當成不支援的操作，由 apply_rent_statuses 回報 invalid
+        action = item.get("action")
+        changes.append((rid, action if isinstance(action, str) else None))
+
+    conn = get_db_connection()
+    try:
+        results = apply_rent_statuses(conn, changes)
+    except BookingError as e:
+        return fail(f"整批未更新：{e}", 409)
+    finally:
+        conn.close()
+
+    summary = {}
+    for r in results:
+        summary[r["result"]] = summary.get(r["result"], 0) + 1
+    if as_json:
+        return jsonify({"results": results, "summary": summary})
+
+    msg = f"✅ 已更新 {summary.get('updated', 0)} 筆"
+    if summary.get("unchanged"):
+        msg += f"，{summary['unchanged']} 筆狀態本來就相同"
+    flash(msg)
+    problems = [r for r in results if r["result"] not in ("updated", "unchanged")]
+    if problems:
+        flash("⚠️ 未處理：" + "；".join(f"#{r['id']} {r['message']}" for r in problems[:20])
+              + (f"…等 {len(problems)} 筆" if len(problems) > 20 else ""), "warning")
+    return redirect(back)
+
+# ===== 場地行事曆（後台：日 / 週 / 月）=====
+# 可見範圍內的申請用一條範圍查詢撈回（進行中的走 idx_rent_active_loc_date，已封存的走 archive 的 (location, date)），
+# 每天各自做區間分割（interval partitioning）排成幾條 lane，重疊的申請並排顯示。
+# 排好的結果依「場地 + 範圍 + 是否含已駁回 + rent:<場地> 版本號」快取，申請有異動時版本號會變，key 自然換掉。
+CALENDAR_VIEWS = ("day", "week", "month")
+CALENDAR_MONTH_CELL_LIMIT = 6                 # 月檢視每格最多列幾筆，其餘顯示「+N 筆」
+_calendar_cache = _MemoryPageCache(int(os.environ.get("CALENDAR_CACHE_ENTRIES", 64)), PAGE_CACHE_TTL)
+
+def calendar_window(view, anchor):
+    """檢視範圍 (第一天, 最後一天, 上一頁錨點, 下一頁錨點)；週從星期一開始，月檢視補滿前後的整週。"""
+    if view == "day":
+        return anchor, anchor, anchor - timedelta(days=1), anchor + timedelta(days=1)
+    if view == "week":
+        start = anchor - timedelta(days=anchor.weekday())
+        return start, start + timedelta(days=6), start - timedelta(days=7), start + timedelta(days=7)
+    first = anchor.replace(day=1)
+    next_month = (first + timedelta(days=32)).replace(day=1)
+    start = first - timedelta(days=first.weekday())
+    last = next_month - timedelta(days=1)
+    end = last + timedelta(days=6 - last.weekday())
+    return start, end, (first - timedelta(days=1)).replace(day=1), next_month
+
+def pack_lanes(items) -> int:
+    """
+    區間分割：items 依開始時間排好，每筆放進最早空出來的 lane（以結束時間做 min-heap），
+    寫入 item["lane"]，回傳用到的 lane 數（= 同一時間最多幾筆重疊）。
+    """
+    ends, lanes = [], 0
+    for item in items:
+        if ends and ends[0][0] <= item["start"]:
+            lane = ends[0][1]
+            heapq.heapreplace(ends, (item["end"], lane))
+        else:
+            lane, lanes = lanes, lanes + 1
+            heapq.heappush(ends, (item["end"], lane))
+        item["lane"] = lane
+    return lanes
+
+def _hm(minutes: int) -> str:
+    """一天中的第幾分鐘 → "HH:MM"。"""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def load_rent_calendar(location, start, end, include_rejected=False) -> dict:
+    """{date: {"lanes": n, "items": [...]}}，只含有申請的日子；回傳的 dict 是共用的快取，呼叫端不要修改。"""
+    version = get_cache_version(f"rent:{location}")
+    key = (location, start, end, include_rejected, version)
+    cached = _calendar_cache.get(key)
+    if cached:
+        return cached["days"]
+
+    live = ("pending", "approved", "rejected") if include_rejected else _RENT_ACTIVE
+    archived = ("approved", "rejected") if include_rejected else ("approved",)
+    conn = get_db_connection()
+    # 一個月可能上千筆：用 tuple cursor，時間在 SQL 裡先換成分鐘數，Python 這邊只做加減
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute("""
+            SELECT id, date, EXTRACT(EPOCH FROM start_time)::int / 60, EXTRACT(EPOCH FROM end_time)::int / 60,
+                   name, status, archived
+            FROM (
+                SELECT id, date, start_time, end_time, name, status, FALSE AS archived
+                FROM rent_requests
+                WHERE location = %(loc)s AND date BETWEEN %(start)s AND %(end)s AND status IN %(live)s
+                UNION ALL
+                SELECT id, date, start_time, end_time, name, status, TRUE
+                FROM rent_requests_archive
+                WHERE location = %(loc)s AND date BETWEEN %(start)s AND %(end)s AND status IN %(archived)s
+            ) r
+            WHERE start_time IS NOT NULL AND end_time IS NOT NULL
+            ORDER BY date, start_time, end_time
+        """, {"loc": location, "start": start, "end": end, "live": live, "archived": archived})
+        rows = cur.fetchall()
     conn.close()
-    disabled = [r["date"].strftime("%Y-%m-%d") for r in rows]
-    return jsonify({"disabled_dates": disabled})
 
-@app.route("/api/rent/timeslots", methods=["GET"])
-def api_rent_timeslots():
+    open_min = OPEN_MINUTES
+    scale = 100 / (BUSINESS_CLOSE.hour * 60 + BUSINESS_CLOSE.minute - open_min)
+    days = {}
+    for rid, d, s_min, e_min, name, status, is_archived in rows:
+        day = days.get(d)
+        if day is None:
+            day = days[d] = {"items": []}
+        top = max(0, s_min - open_min) * scale
+        day["items"].append({
+            "id": rid, "start": s_min, "end": e_min, "label": f"{_hm(s_min)}–{_hm(e_min)}",
+            "name": name, "status": status, "archived": is_archived,
+            "top": round(top, 3),
+            "height": round(max(min(100, (e_min - open_min) * scale) - top, 0.5), 3),
+        })
+    for day in days.values():
+        day["lanes"] = pack_lanes(day["items"])
+    _calendar_cache.set(key, {"days": days})
+    return days
+
+@app.route("/manage_rents/calendar")
+@admin_required
+def manage_rents_calendar():
     location = (request.args.get("location") or "").strip()
-    date_str = (request.args.get("date") or "").strip()
-    if not location or not date_str:
-        return jsonify({"available": []})
-
+    if location not in LOCATION_ALBUMS:
+        location = next(iter(LOCATION_ALBUMS))
+    view = request.args.get("view") if request.args.get("view") in CALENDAR_VIEWS else "week"
     try:
-        d = datetime.strptime(date_str, "%Y-%m-%d").date()
+        anchor = datetime.strptime((request.args.get("date") or "").strip(), "%Y-%m-%d").date()
     except ValueError:
-        return jsonify({"error": "bad date"}), 400
+        anchor = datetime.now(TZ).date()
+    include_rejected = request.args.get("rejected") == "1"
+    start, end, prev_anchor, next_anchor = calendar_window(view, anchor)
 
+    # 同一個範圍、資料沒變就回 304（有待顯示的 flash 時照常產生頁面）；
+    # 頁面也會顯示 anchor（日期欄、切換檢視的連結）與 today（今天的標示），一起算進 ETag
     today = datetime.now(TZ).date()
-    now   = datetime.now(TZ)
-    if d < today:
-        return jsonify({"available": []})
+    version = get_cache_version(f"rent:{location}")
+    etag = hashlib.sha1(f"{location}|{view}|{start}|{anchor}|{today}|{include_rejected}|{version}"
+                        .encode("utf-8")).hexdigest()
+    if request.if_none_match.contains(etag) and not session.get("_flashes"):
+        resp = make_response("", 304)
+    else:
+        days = load_rent_calendar(location, start, end, include_rejected)
+        dates = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        resp = make_response(render_template(
+            "rent_calendar.html", location=location, locations=list(LOCATION_ALBUMS), view=view,
+            anchor=anchor, start=start, end=end, dates=dates, days=days,
+            prev_anchor=prev_anchor, next_anchor=next_anchor, today=today,
+            include_rejected=include_rejected, total=sum(len(d["items"]) for d in days.values()),
+            hours=[time(h) for h in range(BUSINESS_OPEN.hour, BUSINESS_CLOSE.hour + 1)],
+            open_minutes=OPEN_MINUTES, close_minutes=BUSINESS_CLOSE.hour * 60 + BUSINESS_CLOSE.minute,
+            cell_limit=CALENDAR_MONTH_CELL_LIMIT,
+        ))
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("""
-        SELECT time_slot
-        FROM rent_requests
-        WHERE location=%s AND date=%s
-          AND status IN ('pending','approved')
-    """, (location, date_str))
-    rows = cur.fetchall()
-    conn.close()
-    booked = {(r["time_slot"] or "").replace("–", "-").strip() for r in rows}
+# ===== 匯出（CSV / ICS 串流）=====
+# /admin/export/rents.csv、rents.ics、contacts.csv、orders.csv，篩選：date_from / date_to / location / status。
+# 內容由 exports.py 用具名 cursor 邊讀邊產生；回應是 generator，第一段（標題列）馬上送出、記憶體不隨筆數成長。
+# 串流在 view 回傳之後才跑（request 的連線已經還回池），所以 generator 自己從池借一條、跑完或中斷時歸還。
+@app.route("/admin/export/<kind>.<fmt>")
+@admin_required
+def admin_export(kind, fmt):
+    try:
+        filters = parse_export_filters(kind, fmt, request.args, locations=list(LOCATION_ALBUMS))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400 if kind in EXPORT_FORMATS else 404
 
-    available = []
-    for val, start_hm, end_hm in TIME_SLOTS:
-        if val in booked: continue
-        if d == today:
-            sh, sm = map(int, start_hm.split(":"))
-            start_dt = datetime(d.year, d.month, d.day, sh, sm, tzinfo=TZ)
-            if start_dt <= now: continue
-        available.append({"id": val, "label": val.replace("-", "–")})
-    return jsonify({"available": available})
+    uid_domain = request.host.split(":")[0] or "rent.invalid"
+    def generate():
+        conn = PooledConnection(_SharedConnection(get_db_pool()), request_scoped=False)
+        try:
+            yield from stream_export(conn, kind, fmt, filters, uid_domain=uid_domain)
+        finally:
+            conn.close()   # 還回池時會 rollback 掉匯出用的唯讀交易
 
-@app.route("/manage_rents", methods=["GET", "POST"])
-@admin_required
-def manage_rents():
-    delete_expired_rent_requests()
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    mimetype = "text/calendar" if fmt == "ics" else "text/csv"
+    resp = Response(generate(), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f"attachment; filename={export_filename(kind, fmt, filters)}"
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Accel-Buffering"] = "no"   # nginx 不要整份收完才轉送
+    return resp
 
-    if request.method == "POST":
-        rent_id = request.form["id"]
-        action = request.form["action"]
-        if action == "approve":
-            cur.execute("UPDATE rent_requests SET status='approved' WHERE id=%s", (rent_id,))
-        elif action == "reject":
-            cur.execute("UPDATE rent_requests SET status='rejected' WHERE id=%s", (rent_id,))
-        conn.commit()
+# ===== 購物車數量徽章（快取在 session；購物車異動時同步寫入）=====
+# 自己的購物車異動會即時更新；管理員刪除商品這類「別人動到我的購物車」會遞增 products 版本號，
+# 快取隨之失效。CART_COUNT_TTL 只是最後的保險。
+CART_COUNT_TTL = int(os.environ.get("CART_COUNT_TTL", 300))
 
-    cur.execute("SELECT * FROM rent_requests ORDER BY submitted_at DESC")
-    rents = cur.fetchall()
-    conn.close()
-    return render_template("manage_rents.html", rents=rents)
+def query_cart_count(cur, user_id) -> int:
+    cur.execute("SELECT COALESCE(SUM(quantity), 0) AS total FROM cart_items WHERE user_id = %s", (user_id,))
+    return int((cur.fetchone() or {}).get("total") or 0)
+
+def get_cached_cart_count(user_id):
+    """回傳 session 裡仍有效的購物車件數；沒有或過期回傳 None。"""
+    cached = session.get("cart_count")
+    if not isinstance(cached, dict) or cached.get("u") != user_id:
+        return None
+    if datetime.now(TZ).timestamp() - (cached.get("at") or 0) > CART_COUNT_TTL:
+        return None
+    if cached.get("pv") != get_cache_version("products"):
+        return None
+    return cached.get("n", 0)
+
+def set_cached_cart_count(user_id, total):
+    session["cart_count"] = {
+        "u": user_id, "n": int(total),
+        "pv": get_cache_version("products"),
+        "at": int(datetime.now(TZ).timestamp()),
+    }
+
+def invalidate_cached_cart_count():
+    session.pop("cart_count", None)
+
+# ===== 購物車服務 =====
+# 每個異動都是「一條 SQL、一次往返」，並在同一條語句裡算出異動後的購物車總件數，
+# 直接餵給 set_cached_cart_count，不必再多查一次 query_cart_count。
+# 註：同一語句裡的 CTE 看到的是異動前的快照，所以總數 = 未被動到的列（快照）+ RETURNING 回來的新值。
+_CART_TOTAL_AFTER = """
+    SELECT COALESCE(SUM(quantity), 0) AS total FROM (
+        SELECT quantity FROM cart_items
+        WHERE user_id = %(user_id)s AND product_id NOT IN (SELECT product_id FROM changed)
+        UNION ALL
+        SELECT quantity FROM changed
+    ) t
+"""
+
+def cart_add(cur, user_id, pid, qty):
+    """加入（或累加）一項商品；商品不存在回傳 None，否則回傳新的總件數。"""
+    cur.execute("""
+        WITH changed AS (
+            INSERT INTO cart_items (user_id, product_id, quantity)
+            SELECT %(user_id)s, pid, %(qty)s FROM products WHERE pid = %(pid)s
+            ON CONFLICT (user_id, product_id)
+            DO UPDATE SET quantity = cart_items.quantity + EXCLUDED.quantity
+            RETURNING product_id, quantity
+        )
+        SELECT (SELECT count(*) FROM changed) AS n, (""" + _CART_TOTAL_AFTER + """) AS total
+    """, {"user_id": user_id, "pid": pid, "qty": qty})
+    row = cur.fetchone()
+    return int(row["total"]) if row["n"] else None
+
+def cart_set_quantities(cur, user_id, lines) -> int:
+    """
+    批次設定數量：lines 為 [(pid, qty), ...]，整批用一條 UPDATE ... FROM unnest() 寫入。
+    同一個 pid 出現多次以最後一筆為準；不在購物車裡的 pid 直接略過。回傳新的總件數。
+    """
+    latest = {}
+    for pid, q in lines:
+        latest[pid] = q
+    cur.execute("""
+        WITH v(pid, qty) AS (
+            SELECT * FROM unnest(%(pids)s::text[], %(qtys)s::int[])
+        ), changed AS (
+            UPDATE cart_items c SET quantity = v.qty
+            FROM v
+            WHERE c.user_id = %(user_id)s AND c.product_id = v.pid
+            RETURNING c.product_id, c.quantity
+        )
+    """ + _CART_TOTAL_AFTER, {"user_id": user_id, "pids": list(latest), "qtys": list(latest.values())})
+    return int(cur.fetchone()["total"])
+
+def cart_remove(cur, user_id, pid) -> int:
+    """移除一項商品，回傳新的總件數。"""
+    cur.execute("""
+        WITH removed AS (
+            DELETE FROM cart_items WHERE user_id = %(user_id)s AND product_id = %(pid)s
+            RETURNING product_id
+        )
+        SELECT COALESCE(SUM(quantity), 0) AS total FROM cart_items
+        WHERE user_id = %(user_id)s AND product_id NOT IN (SELECT product_id FROM removed)
+    """, {"user_id": user_id, "pid": pid})
+    return int(cur.fetchone()["total"])
+
+def cart_clear(cur, user_id) -> int:
+    cur.execute("DELETE FROM cart_items WHERE user_id = %s", (user_id,))
+    return 0
+
+def cart_lines(cur, user_id, pids=None):
+    """購物車明細（連商品名稱、價格），一條 JOIN；pids 有給時只取這些商品。"""
+    cur.execute("""
+        SELECT p.pid, p.name, p.price, ci.quantity, (p.price * ci.quantity) AS subtotal
+        FROM cart_items ci
+        JOIN products p ON ci.product_id = p.pid
+        WHERE ci.user_id = %s AND (%s::text[] IS NULL OR ci.product_id = ANY(%s::text[]))
+        ORDER BY ci.id
+    """, (user_id, pids, pids))
+    return cur.fetchall()
+
+def parse_cart_qty(qty_str) -> int:
+    try: return max(1, int(qty_str))
+    except Exception: return 1
 
 # ===== 購物車/商品 =====
 @app.route("/shop")
@@ -912,13 +2877,12 @@ def add_to_cart(pid):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO cart_items (user_id, product_id, quantity)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id, product_id)
-            DO UPDATE SET quantity = cart_items.quantity + EXCLUDED.quantity
-        """, (user_id, pid, qty))
-        conn.commit(); flash(f"✅ 已加入購物車（{qty} 件）")
+        total = cart_add(cursor, user_id, pid, qty)
+        conn.commit()
+        if total is None:
+            flash("商品不存在"); return redirect(url_for("shop"))
+        flash(f"✅ 已加入購物車（{qty} 件）")
+        set_cached_cart_count(user_id, total)
     except Exception as e:
         print("加入購物車錯誤：", e); flash("❌ 加入購物車失敗，請稍後再試")
     finally:
@@ -934,15 +2898,11 @@ def cart():
 
     conn = get_db_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("""
-        SELECT p.pid, p.name, p.price, ximen.quantity, (p.price * ximen.quantity) AS subtotal
-        FROM cart_items ximen
-        JOIN products p ON ximen.product_id = p.pid
-        WHERE ximen.user_id = %s
-    """, (user_id,))
-    items = cursor.fetchall()
-    total = sum(item["subtotal"] for item in items)
+    items = cart_lines(cursor, user_id)
     conn.close()
+    total = sum(item["subtotal"] for item in items)
+    # 明細已經有每列數量，順手把徽章快取補上，context processor 就不必再查一次
+    set_cached_cart_count(user_id, sum(item["quantity"] for item in items))
     return render_template("cart.html", items=items, total=total)
 
 @app.route("/update_cart_qty", methods=["POST"])
@@ -958,27 +2918,17 @@ def update_cart_qty():
     try:
         cur = conn.cursor()
         if single_pid and single_qty:
-            try: q = max(1, int(single_qty))
-            except Exception: q = 1
-            cur.execute("""
-                UPDATE cart_items SET quantity = %s
-                WHERE user_id = %s AND product_id = %s
-            """, (q, user_id, single_pid))
-            conn.commit(); flash("✅ 數量已更新"); return redirect(url_for("cart"))
-
-        pids = request.form.getlist("pid[]")
-        qtys = request.form.getlist("qty[]")
-        if not pids or not qtys or len(pids) != len(qtys):
-            flash("❌ 更新失敗，資料不完整"); return redirect(url_for("cart"))
-
-        for pid, qty_str in zip(pids, qtys):
-            try: q = max(1, int(qty_str))
-            except Exception: q = 1
-            cur.execute("""
-                UPDATE cart_items SET quantity = %s
-                WHERE user_id = %s AND product_id = %s
-            """, (q, user_id, pid))
-        conn.commit(); flash("✅ 數量已更新")
+            lines = [(single_pid, parse_cart_qty(single_qty))]
+        else:
+            pids = request.form.getlist("pid[]")
+            qtys = request.form.getlist("qty[]")
+            if not pids or not qtys or len(pids) != len(qtys):
+                flash("❌ 更新失敗，資料不完整"); return redirect(url_for("cart"))
+            lines = [(pid, parse_cart_qty(q)) for pid, q in zip(pids, qtys)]
+
+        total = cart_set_quantities(cur, user_id, lines)
+        conn.commit(); set_cached_cart_count(user_id, total)
+        flash("✅ 數量已更新")
     except Exception as e:
         print("更新購物車數量錯誤：", e); flash("❌ 數量更新失敗，請稍後再試")
     finally:
@@ -995,8 +2945,9 @@ def remove_from_cart(pid):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM cart_items WHERE user_id = %s AND product_id = %s", (user_id, pid))
-        conn.commit(); flash("🗑️ 已從購物車移除")
+        total = cart_remove(cursor, user_id, pid)
+        conn.commit(); set_cached_cart_count(user_id, total)
+        flash("🗑️ 已從購物車移除")
     except Exception as e:
         print("刪除購物車項目錯誤：", e); flash("❌ 無法移除，請稍後再試")
     finally:
@@ -1019,8 +2970,8 @@ def manage_products():
         else:
             try:
                 cursor.execute(
-                    "INSERT INTO products (pid, name, price) VALUES (%s, %s, %s)",
-                    (pid, name, int(price))
+                    "INSERT INTO products (pid, name, price, stock) VALUES (%s, %s, %s, %s)",
+                    (pid, name, int(price), parse_stock(request.form.get("stock")))
                 )
                 conn.commit()
                 flash("✅ 商品新增成功", "success")
@@ -1030,11 +2981,11 @@ def manage_products():
                 conn.rollback()
                 flash("商品 ID 已存在", "warning")
             except ValueError:
-                flash("價格必須是整數", "danger")
+                flash("價格與庫存必須是整數（庫存不可為負）", "danger")
 
     # 這裡重點：依 pid 的數字大小排序（pid 是 TEXT）
     cursor.execute("""
-        SELECT pid, name, price
+        SELECT pid, name, price, stock
         FROM products
         ORDER BY (pid::int) ASC
     """)
@@ -1043,7 +2994,17 @@ def manage_products():
     return render_template("manage_products.html", products=products)
 
 
-# 就地編輯：更新商品名稱與價格
+def parse_stock(raw):
+    """庫存欄位：空白 = 不限量（NULL），否則必須是非負整數（不合法丟 ValueError）。"""
+    raw = (raw or "").strip()
+    if not raw:
+        return None
+    stock = int(raw)
+    if stock < 0:
+        raise ValueError(raw)
+    return stock
+
+# 就地編輯：更新商品名稱、價格與庫存
 @app.post("/products/<pid>/update")
 @admin_required
 def update_product(pid):
@@ -1057,13 +3018,14 @@ def update_product(pid):
         price = int(price_raw)
         if price < 0:
             raise ValueError()
+        stock = parse_stock(request.form.get("stock"))
     except ValueError:
-        flash("價格必須是非負整數", "danger")
+        flash("價格與庫存必須是非負整數", "danger")
         return redirect(url_for("manage_products"))
 
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("UPDATE products SET name=%s, price=%s WHERE pid=%s", (name, price, pid))
+    cur.execute("UPDATE products SET name=%s, price=%s, stock=%s WHERE pid=%s", (name, price, stock, pid))
     conn.commit()
     conn.close()
     flash("已更新商品", "success")
@@ -1076,10 +3038,14 @@ def update_product(pid):
 def delete_product(pid):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM cart_items WHERE product_id = %s", (pid,))
-    cursor.execute("DELETE FROM products WHERE pid = %s", (pid,))
+    # 一條語句同時清掉購物車項目與商品；外鍵檢查在語句結束時才做，所以順序沒問題
+    cursor.execute("""
+        WITH gone AS (DELETE FROM cart_items WHERE product_id = %(pid)s)
+        DELETE FROM products WHERE pid = %(pid)s
+    """, {"pid": pid})
     conn.commit()
     conn.close()
+    invalidate_cached_cart_count()  # 其他使用者的徽章由 products 版本號失效
     flash("🗑️ 商品與相關購物車項目已刪除", "success")
     return redirect(url_for("manage_products"))
 
@@ -1092,8 +3058,9 @@ def clear_cart():
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM cart_items WHERE user_id = %s", (user_id,))
-        conn.commit(); flash("🧹 已清空購物車")
+        total = cart_clear(cursor, user_id)
+        conn.commit(); set_cached_cart_count(user_id, total)
+        flash("🧹 已清空購物車")
     except Exception as e:
         print("清空購物車錯誤：", e); flash("❌ 清空失敗，請稍後再試")
     finally:
@@ -1121,29 +3088,170 @@ def checkout():
     if not cleaned:
         flash("❌ 沒有可結帳的商品"); return redirect(url_for("cart"))
 
+    # 頁面上的數量可能還在去抖、尚未存回；先整批寫回購物車，再用同一條連線取出計價明細
     conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    only_pids = [pid for pid, _ in cleaned]
-    cursor.execute("SELECT pid, name, price FROM products WHERE pid = ANY(%s)", (only_pids,))
-    rows = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cart_total = cart_set_quantities(cursor, user_id, cleaned)
+        rows = cart_lines(cursor, user_id, [pid for pid, _ in cleaned])
+        conn.commit()
+    finally:
+        conn.close()
+    set_cached_cart_count(user_id, cart_total)
 
-    info = {r["pid"]: r for r in rows}
-    items, total = [], 0
-    for pid, q in cleaned:
-        if pid in info:
-            name = info[pid]["name"]; price = info[pid]["price"]
-            subtotal = price * q; total += subtotal
-            items.append({"pid": pid, "name": name, "price": price, "qty": q, "subtotal": subtotal})
+    items = [{"pid": r["pid"], "name": r["name"], "price": r["price"],
+              "qty": r["quantity"], "subtotal": r["subtotal"]} for r in rows]
+    total = sum(it["subtotal"] for it in items)
     if not items:
         flash("❌ 沒有可結帳的商品"); return redirect(url_for("cart"))
 
-    return render_template("checkout.html", items=items, total=total)
+    # 每次進結帳頁給一把新的冪等鍵；同一張結帳單重複送出（連點、重新整理、重送）只會成立一筆訂單
+    return render_template("checkout.html", items=items, total=total,
+                           idempotency_key=uuid.uuid4().hex)
+
+# ===== 訂單 =====
+# 購物車 → 訂單在同一個交易裡完成：
+#   1. 先佔 (user_id, idempotency_key)：已存在就直接回傳舊訂單（並發的重複送出會卡在唯一索引上，等前一筆提交後拿到同一張）
+#   2. DELETE cart_items ... RETURNING 一次取走要結帳的購物車列（同一使用者並發結帳，第二筆只會拿到空的）
+#   3. 有設庫存的商品依 pid 排序後 FOR NO KEY UPDATE 再扣庫存：固定上鎖順序 → 大量並發結帳也不會互相死鎖；
+#      NO KEY 鎖不會擋到 cart_items 外鍵需要的 KEY SHARE，熱賣商品被搶購時，其他人照樣能加入購物車
+#   4. 寫 order_items、回填訂單總額
+# 任何一步失敗整筆 rollback，購物車與庫存都回到原樣。
+ORDER_KEY_MAX_LEN = 100
+
+class CheckoutError(Exception):
+    """結帳失敗（購物車空、庫存不足…），訊息可以直接 flash 給使用者。"""
+
+def place_order(conn, user_id, idempotency_key, pids=None):
+    """
+    把 user_id 的購物車（pids 有給時只結這幾項）轉成訂單，回傳 (order_id, created)。
+    不 commit：由呼叫端提交；丟 CheckoutError 時呼叫端要 rollback。
+    """
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""
+            INSERT INTO orders (user_id, idempotency_key) VALUES (%s, %s)
+            ON CONFLICT (user_id, idempotency_key) DO NOTHING
+            RETURNING id
+        """, (user_id, idempotency_key))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute("SELECT id FROM orders WHERE user_id = %s AND idempotency_key = %s",
+                        (user_id, idempotency_key))
+            return cur.fetchone()["id"], False
+        order_id = row["id"]
+
+        cur.execute("""
+            WITH taken AS (
+                DELETE FROM cart_items
+                WHERE user_id = %(user_id)s
+                  AND (%(pids)s::text[] IS NULL OR product_id = ANY(%(pids)s::text[]))
+                RETURNING product_id, quantity
+            )
+            SELECT p.pid, p.name, p.price, p.stock, t.quantity
+            FROM taken t JOIN products p ON p.pid = t.product_id
+            ORDER BY p.pid
+        """, {"user_id": user_id, "pids": pids})
+        lines = cur.fetchall()
+        if not lines:
+            raise CheckoutError("購物車是空的，或選取的商品已結帳")
+
+        tracked = [ln["pid"] for ln in lines if ln["stock"] is not None]
+        if tracked:
+            cur.execute("""
+                SELECT pid, stock FROM products
+                WHERE pid = ANY(%s::text[])
+                ORDER BY pid
+                FOR NO KEY UPDATE
+            """, (tracked,))
+            stock = {r["pid"]: r["stock"] for r in cur.fetchall()}
+            short = [ln["name"] for ln in lines
+                     if stock.get(ln["pid"]) is not None and stock[ln["pid"]] < ln["quantity"]]
+            if short:
+                raise CheckoutError("庫存不足：" + "、".join(short))
+            cur.execute("""
+                UPDATE products p SET stock = p.stock - v.qty
+                FROM unnest(%s::text[], %s::int[]) AS v(pid, qty)
+                WHERE p.pid = v.pid AND p.stock IS NOT NULL
+            """, ([ln["pid"] for ln in lines], [ln["quantity"] for ln in lines]))
+
+        execute_values(cur, """
+            INSERT INTO order_items (order_id, product_id, name, unit_price, quantity) VALUES %s
+        """, [(order_id, ln["pid"], ln["name"], ln["price"], ln["quantity"]) for ln in lines])
+        cur.execute("UPDATE orders SET item_count = %s, total = %s WHERE id = %s", (
+            sum(ln["quantity"] for ln in lines),
+            sum(ln["price"] * ln["quantity"] for ln in lines),
+            order_id,
+        ))
+    return order_id, True
+
+@app.route("/orders", methods=["POST"])
+def create_order():
+    if "username" not in session:
+        flash("請先登入"); return redirect(url_for("login"))
+    user_id = session["username"]
+
+    key = (request.form.get("idempotency_key") or request.headers.get("Idempotency-Key") or "").strip()
+    if not key or len(key) > ORDER_KEY_MAX_LEN:
+        flash("❌ 結帳資料不完整，請重新結帳"); return redirect(url_for("cart"))
+    pids = request.form.getlist("pid[]") or None
+
+    conn = get_db_connection()
+    try:
+        order_id, created = place_order(conn, user_id, key, pids)
+        conn.commit()
+    except CheckoutError as e:
+        conn.rollback()
+        flash(f"❌ {e}"); return redirect(url_for("cart"))
+    except Exception as e:
+        conn.rollback()
+        print("建立訂單錯誤：", e); flash("❌ 下單失敗，請稍後再試")
+        return redirect(url_for("cart"))
+    finally:
+        conn.close()
+
+    invalidate_cached_cart_count()
+    flash("✅ 訂單已成立" if created else "這張訂單先前已經送出，不會重複下單")
+    return redirect(url_for("order_detail", order_id=order_id))
+
+@app.route("/orders")
+def my_orders():
+    if "username" not in session:
+        flash("請先登入"); return redirect(url_for("login"))
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        SELECT id, status, item_count, total, created_at
+        FROM orders WHERE user_id = %s
+        ORDER BY created_at DESC, id DESC
+        LIMIT 100
+    """, (session["username"],))
+    orders = cur.fetchall()
+    conn.close()
+    return render_template("orders.html", orders=orders, tz=TZ)
+
+@app.route("/orders/<int:order_id>")
+def order_detail(order_id):
+    if "username" not in session:
+        flash("請先登入"); return redirect(url_for("login"))
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT id, user_id, status, item_count, total, created_at FROM orders WHERE id = %s",
+                (order_id,))
+    order = cur.fetchone()
+    if not order or (order["user_id"] != session["username"] and session.get("role") != "admin"):
+        conn.close(); abort(404)
+    cur.execute("""
+        SELECT product_id, name, unit_price, quantity, (unit_price * quantity) AS subtotal
+        FROM order_items WHERE order_id = %s ORDER BY product_id
+    """, (order_id,))
+    items = cur.fetchall()
+    conn.close()
+    return render_template("order_detail.html", order=order, items=items, tz=TZ)
 
 # ===== 課程專區 =====
 @app.route("/courses")
+@page_cache("courses")
 def courses():
-    ensure_courses_table()
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     cur.execute("""
@@ -1158,24 +3266,23 @@ def courses():
 @app.route("/manage_courses", methods=["GET", "POST"])
 @admin_required
 def manage_courses():
-    ensure_courses_table()
     if request.method == "POST":
         title = (request.form.get("title") or "").strip()
         description = (request.form.get("description") or "").strip()
         signup_link = (request.form.get("signup_link") or "").strip()
         pinned = request.form.get("pinned") == "on"
-        dm_rel = None
+        dm_rel = dm_sha256 = None
         if not title:
             flash("請填寫標題"); return redirect(url_for("manage_courses"))
         if "dm_file" in request.files:
-            dm_rel = save_course_dm(request.files["dm_file"])
+            dm_rel, dm_sha256 = save_course_dm(request.files["dm_file"])
         conn = get_db_connection()
         with conn:
             with conn.cursor() as cur:
                 cur.execute("""
-                    INSERT INTO courses (title, description, dm_file, signup_link, pinned)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (title, description, dm_rel, signup_link, pinned))
+                    INSERT INTO courses (title, description, dm_file, dm_sha256, signup_link, pinned)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, (title, description, dm_rel, dm_sha256, signup_link, pinned))
         conn.close()
         flash("課程已新增"); return redirect(url_for("manage_courses"))
 
@@ -1202,22 +3309,22 @@ def update_course(course_id):
 
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT dm_file FROM courses WHERE id=%s", (course_id,))
-    old = cur.fetchone(); old_dm = (old or {}).get("dm_file")
+    cur.execute("SELECT dm_file, dm_sha256 FROM courses WHERE id=%s", (course_id,))
+    old = cur.fetchone() or {}; old_dm = old.get("dm_file")
 
-    new_dm = old_dm
+    new_dm, new_sha256 = old_dm, old.get("dm_sha256")
     if "dm_file" in request.files and request.files["dm_file"].filename.strip():
-        maybe = save_course_dm(request.files["dm_file"])
+        maybe, maybe_sha256 = save_course_dm(request.files["dm_file"])
         if maybe:
-            new_dm = maybe
+            new_dm, new_sha256 = maybe, maybe_sha256
             if old_dm and old_dm != new_dm:
                 delete_course_dm_if_exists(old_dm)
 
     cur.execute("""
         UPDATE courses
-        SET title=%s, description=%s, signup_link=%s, pinned=%s, dm_file=%s
+        SET title=%s, description=%s, signup_link=%s, pinned=%s, dm_file=%s, dm_sha256=%s
         WHERE id=%s
-    """, (title, description, signup_link, pinned, new_dm, course_id))
+    """, (title, description, signup_link, pinned, new_dm, new_sha256, course_id))
     conn.commit(); conn.close()
     flash("課程已更新"); return redirect(url_for("manage_courses"))
 
@@ -1240,7 +3347,9 @@ def download_course_dm(filename):
     abs_path = os.path.join(UPLOAD_FOLDER_COURSES, filename)
     if not os.path.isfile(abs_path): abort(404)
     mime = mimetypes.guess_type(abs_path)[0] or "application/octet-stream"
-    return send_file(abs_path, as_attachment=True, download_name=filename, mimetype=mime)
+    # DM 檔名是 uuid，換檔就是新網址
+    return send_file_offloaded(abs_path, mimetype=mime, cache_control=IMMUTABLE_CACHE_CONTROL,
+                               as_attachment=True, download_name=filename)
 
 # =========================
 # === 課程回顧（新模組） ===
@@ -1254,112 +3363,6 @@ def slugify(name: str) -> str:
     s = re.sub(r"[^fuqian-zA-Z0-9\-]+", "", s)
     return s.lower()
 
-def ensure_review_tables():
-    """建立/補齊 課程回顧三張表 + review_media 新欄位/索引（可重複執行）。"""
-    conn = get_db_connection()
-    with conn:
-        with conn.cursor() as cur:
-            # 分類表
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS review_categories (
-              id SERIAL PRIMARY KEY,
-              name TEXT UNIQUE NOT NULL,
-              slug TEXT UNIQUE NOT NULL,
-              sort_order INTEGER DEFAULT 0
-            );
-            """)
-
-            # 主文表
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS course_reviews (
-              id SERIAL PRIMARY KEY,
-              category_id INTEGER NOT NULL REFERENCES review_categories(id) ON DELETE RESTRICT,
-              title TEXT NOT NULL,
-              event_date DATE,
-              cover_path TEXT,
-              summary TEXT,
-              content_html TEXT,
-              status TEXT DEFAULT 'published',
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-
-            # 媒體表（舊版先建立基本欄位）
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS review_media (
-              id SERIAL PRIMARY KEY,
-              review_id INTEGER NOT NULL REFERENCES course_reviews(id) ON DELETE CASCADE,
-              file_path TEXT NOT NULL,
-              file_name TEXT,
-              mime TEXT NOT NULL,
-              size_bytes BIGINT,
-              sort_order INTEGER DEFAULT 0,
-              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-
-            # ✅ 補齊新欄位（縮圖/WEBP 與尺寸）
-            cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS width INT;")
-            cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS height INT;")
-            cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_480 TEXT;")
-            cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_960 TEXT;")
-            cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_webp TEXT;")
-
-            # 索引
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_review_media_review ON review_media(review_id);")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_review_media_sort ON review_media(review_id, sort_order, created_at, id);")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_category ON course_reviews(category_id);")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_status ON course_reviews(status);")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_date ON course_reviews((COALESCE(event_date, created_at)));")
-
-            # --- 先把 sort_order 去重，避免 UNIQUE INDEX 建不成功 ---
-            cur.execute("""
-            WITH ranked AS (
-              SELECT id,
-                     review_id,
-                     ROW_NUMBER() OVER (
-                       PARTITION BY review_id
-                       ORDER BY COALESCE(sort_order, 0), created_at, id
-                     ) - 1 AS rn
-              FROM review_media
-            )
-            UPDATE review_media m
-            SET sort_order = r.rn
-            FROM ranked r
-            WHERE m.id = r.id AND COALESCE(m.sort_order, -1) <> r.rn;
-            """)
-
-            # ✅ 每篇 sort_order 唯一（可重複執行）
-            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_review_media_order ON review_media(review_id, sort_order);")
-
-            # 舊表相容：如有 review_photos 且 review_media 為空，搬一次
-            cur.execute("""
-            DO $$
-            BEGIN
-              IF to_regclass('public.review_photos') IS NOT NULL THEN
-                IF NOT EXISTS (SELECT 1 FROM review_media) THEN
-                  INSERT INTO review_media (review_id, file_path, file_name, mime, sort_order, created_at)
-                  SELECT review_id,
-                         image_path,
-                         caption,
-                         'image/*'::text,
-                         COALESCE(sort_order, 0),
-                         NOW()
-                  FROM review_photos;
-                END IF;
-              END IF;
-            END$$;
-            """)
-
-            # 預設塞一個分類（若沒有任何分類）
-            cur.execute("SELECT COUNT(*) AS ximen FROM review_categories;")
-            if (cur.fetchone() or {}).get("ximen", 0) == 0:
-                cur.execute(
-                    "INSERT INTO review_categories (name, slug, sort_order) VALUES (%s,%s,%s);",
-                    ("一般課程", "general", 0)
-                )
-    conn.close()
-
 # === Banner（首頁輪播）設定 ===
 HERO_DIR = os.path.join(BASE_DIR, "static", "hero")
 ALLOWED_BANNER_EXTS = {"jpg", "jpeg", "png", "webp"}
@@ -1373,72 +3376,336 @@ def gen_banner_filename(original_name: str) -> str:
     ext = os.path.splitext(original_name)[1].lower() or ".jpg"
     return f"{int(datetime.now(TZ).timestamp())}_{uuid.uuid4().hex[:6]}_{stem}{ext}"
 
-# 取用 /uploads 下的檔案（圖片/影片 inline，其餘下載）
-@app.route("/u/<path:relpath>")
-def serve_upload(relpath):
-    # ✅ 1) 容錯：Windows 反斜線、開頭多餘的 /
-    relpath = (relpath or "").replace("\\", "/").lstrip("/")
+# ===== 上傳檔案的送出方式 =====
+# 1) 內容雜湊網址：upload_url() 會在 /u/ 網址帶上 ?v=<檔案 SHA-256 前 12 碼>，
+#    請求帶的 v 和資料庫記的雜湊相符時回 immutable、快取一年；內容換了網址就跟著換。
+#    雜湊只在上傳時算、存在資料庫（review_media.content_sha256、course_reviews.cover_sha256、courses.dm_sha256），
+#    多台主機 / 容器看到的是同一個值；產生網址與送檔時只查這些欄位（依 cache_versions 快取在 process 內），不讀檔。
+#    還沒有雜湊的舊資料網址不帶 v、走一般快取，由排程工作 upload_content_hashes 在背景補算寫回資料庫。
+# 2) SENDFILE_MODE：前面有 nginx / Apache 時讓 proxy 直接送檔（含 Range / 206），worker 不必串流大檔：
+#      x-accel    → X-Accel-Redirect: <prefix><相對路徑>；每個可送出的資料夾各一個 internal location，只開放該資料夾：
+#                     location /_sendfile/       { internal; alias /srv/app/uploads/; }       # UPLOAD_DIR
+#                     location /_sendfile_files/ { internal; alias /srv/app/static/files/; }  # 下載專區
+#                   VARIANT_CACHE_DIR 預設在 UPLOAD_DIR 底下；搬到別處時再加 SENDFILE_ACCEL_VARIANTS_PREFIX 的 location。
+#      x-sendfile → X-Sendfile: <絕對路徑>（Apache mod_xsendfile：XSendFilePath 只設上面這些資料夾）
+#    不在這些資料夾裡的檔案、或未設定 SENDFILE_MODE 時，由 send_file(conditional=True) 自己處理 ETag / 304 / Range 206。
+SENDFILE_MODE = (os.environ.get("SENDFILE_MODE") or "").strip().lower()   # "" | x-accel | x-sendfile
+_accel_prefix = lambda name, default: "/" + (os.environ.get(name) or default).strip("/") + "/"
+SENDFILE_ACCEL_PREFIX = _accel_prefix("SENDFILE_ACCEL_PREFIX", "/_sendfile/")
+SENDFILE_ACCEL_FILES_PREFIX = _accel_prefix("SENDFILE_ACCEL_FILES_PREFIX", "/_sendfile_files/")
+SENDFILE_ACCEL_VARIANTS_PREFIX = _accel_prefix("SENDFILE_ACCEL_VARIANTS_PREFIX", "/_sendfile_variants/")
+UPLOAD_TOKEN_LEN = 12
+UPLOAD_HASH_BACKFILL_MB = int(os.environ.get("UPLOAD_HASH_BACKFILL_MB", 512))   # 背景補算每輪最多讀幾 MB
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# 記內容雜湊的欄位：(資料表, 路徑欄位, 雜湊欄位)；資料表異動會遞增對應的 cache_versions（migration 8）
+_UPLOAD_HASH_COLUMNS = (
+    ("review_media", "file_path", "content_sha256"),
+    ("course_reviews", "cover_path", "cover_sha256"),
+    ("courses", "dm_file", "dm_sha256"),
+)
+_UPLOAD_HASH_VERSIONS = ("reviews", "courses")
+
+def file_sha256(abs_path) -> str:
+    h = hashlib.sha256()
+    with open(abs_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+@lru_cache(maxsize=8192)
+def _stored_upload_sha256(relpath: str, versions: str):
+    """資料庫裡 relpath 的內容雜湊（沒有回 None）；versions 是相關 cache_versions，資料有異動就換 key 重查。"""
+    sql = " UNION ALL ".join(
+        f"(SELECT {col} AS sha256 FROM {table} WHERE {path_col} = ANY(%(paths)s) AND {col} IS NOT NULL LIMIT 1)"
+        for table, path_col, col in _UPLOAD_HASH_COLUMNS)
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            # 舊資料的路徑可能存成 uploads/reviews/...
+            cur.execute(sql + " LIMIT 1", {"paths": [relpath, "uploads/" + relpath]})
+            row = cur.fetchone()
+    finally:
+        conn.close()
+    return row["sha256"] if row else None
 
-    # ✅ 2) 容錯：如果 DB 以前存成 uploads/reviews/xxx.jpg，也能正常找到
-    if relpath.startswith("uploads/"):
-        relpath = relpath[len("uploads/"):]
-    if relpath.startswith("static/uploads/"):
-        relpath = relpath[len("static/uploads/"):]
+def upload_content_token(relpath):
+    versions = ",".join(str(get_cache_version(n)) for n in _UPLOAD_HASH_VERSIONS)
+    sha256 = _stored_upload_sha256(norm_upload_relpath(relpath), versions)
+    return sha256[:UPLOAD_TOKEN_LEN] if sha256 else None
 
-    uploads_root = UPLOAD_DIR
-    target = (uploads_root / relpath).resolve()
+def resolve_upload_path(relpath: str):
+    """相對 uploads 的路徑 → 絕對路徑；跑出 uploads 之外或不是檔案回 None。"""
+    target = (UPLOAD_DIR / norm_upload_relpath(relpath)).resolve()
+    if not target.is_relative_to(UPLOAD_DIR) or not target.is_file():
+        return None
+    return target
+
+@maintenance_job("upload_content_hashes", interval_seconds=600)
+def backfill_upload_hashes():
+    """替還沒有內容雜湊的媒體 / 封面 / DM 讀檔補算、寫回資料庫，每輪最多讀 UPLOAD_HASH_BACKFILL_MB。"""
+    budget = UPLOAD_HASH_BACKFILL_MB * 1024 * 1024
+    stored = 0
+    conn = get_db_connection()
+    try:
+        for table, path_col, col in _UPLOAD_HASH_COLUMNS:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT DISTINCT {path_col} AS path FROM {table}
+                    WHERE {col} IS NULL AND COALESCE({path_col}, '') <> ''
+                """)
+                paths = [r["path"] for r in cur.fetchall()]
+            hashed = []
+            for path in paths:
+                target = resolve_upload_path(path)
+                if target is None:   # 檔案不見了，之後的請求本來就是 404
+                    continue
+                size = target.stat().st_size
+                if (stored or hashed) and size > budget:
+                    break
+                hashed.append((path, file_sha256(target)))
+                budget -= size
+            if hashed:
+                with conn, conn.cursor() as cur:
+                    execute_values(cur, f"""
+                        UPDATE {table} AS t SET {col} = v.sha256
+                        FROM (VALUES %s) AS v(path, sha256)
+                        WHERE t.{path_col} = v.path AND t.{col} IS NULL
+                    """, hashed)
+                stored += len(hashed)
+            if budget <= 0:
+                break
+    finally:
+        conn.close()
+    return stored
+
+@app.template_global()
+def upload_url(relpath, sha256=None, **params):
+    """/u/ 網址（帶內容雜湊 v）；sha256 有給就直接用，否則查資料庫記的雜湊，都不讀檔。"""
+    if not relpath:
+        return ""
+    relpath = norm_upload_relpath(relpath)
+    token = (sha256 or "")[:UPLOAD_TOKEN_LEN] or upload_content_token(relpath)
+    if token:
+        params["v"] = token
+    return url_for("serve_upload", relpath=relpath, **params)
+
+def _accel_redirect_uri(path: str):
+    """X-Accel-Redirect 用的 internal URI（prefix + 相對於該資料夾的路徑）；不在可送出的資料夾裡回 None。"""
+    for root, prefix in ((UPLOAD_DIR, SENDFILE_ACCEL_PREFIX),
+                         (VARIANT_CACHE_DIR, SENDFILE_ACCEL_VARIANTS_PREFIX),
+                         (Path(FILES_DIR).resolve(), SENDFILE_ACCEL_FILES_PREFIX)):
+        p = Path(path)
+        if p.is_relative_to(root):
+            return quote(prefix + p.relative_to(root).as_posix())
+    return None
+
+def send_file_offloaded(path, *, mimetype, cache_control, as_attachment=False, download_name=None):
+    """送出本機檔案；設定 SENDFILE_MODE 時只回標頭，實際內容交給前面的 proxy。"""
+    path = os.path.realpath(path)
+    accel = _accel_redirect_uri(path) if SENDFILE_MODE == "x-accel" else None
+    if not (accel or SENDFILE_MODE == "x-sendfile"):
+        resp = send_file(path, mimetype=mimetype, as_attachment=as_attachment,
+                         download_name=download_name, conditional=True)
+    else:
+        # 借 send_file 產生 Content-Type / Content-Disposition（含中文檔名），內容本身不送
+        resp = send_file(path, mimetype=mimetype, as_attachment=as_attachment,
+                         download_name=download_name, conditional=False, etag=False, last_modified=None)
+        resp.close()
+        resp.response = []
+        resp.headers.pop("Content-Length", None)
+        if accel:
+            resp.headers["X-Accel-Redirect"] = accel
+        else:
+            resp.headers["X-Sendfile"] = path
+    resp.headers["Cache-Control"] = cache_control
+    return resp
+
+# ===== 圖片變體：/u/<path>?w=480|960&fmt=webp|jpeg =====
+# 第一次請求時才產生，存在 VARIANT_CACHE_DIR（檔名含原檔 mtime/大小，原檔換了自然失效）。
+# 同一個變體同時被要求時只產生一次：process 內用分段 thread lock，跨 process 用 O_EXCL lockfile。
+# 沒指定 fmt 時依 Accept 決定（支援 image/webp 就給 WEBP），回應帶 Vary: Accept。
+VARIANT_WIDTHS = set(THUMB_SIZES)
+VARIANT_FORMATS = {   # fmt → (Pillow 格式, MIME, 副檔名, 品質)
+    "webp": ("WEBP", "image/webp", "webp", WEBP_QUALITY),
+    "jpeg": ("JPEG", "image/jpeg", "jpg", JPEG_QUALITY),
+}
+VARIANT_CACHE_DIR = Path(os.environ.get("VARIANT_CACHE_DIR", UPLOAD_DIR / ".variants")).resolve()
+VARIANT_LOCK_WAIT = 30    # 秒；等別人產生同一個變體的上限
+VARIANT_LOCK_STALE = 120  # 秒；lockfile 比這更舊就視為前一個產生者掛了
+
+_variant_locks = [threading.Lock() for _ in range(64)]
+
+def negotiate_image_format() -> str:
+    accepted = {m for m, q in request.accept_mimetypes if q > 0}
+    return "webp" if "image/webp" in accepted else "jpeg"
+
+def get_image_variant(src: Path, relpath: str, width, fmt: str) -> Path:
+    """回傳變體檔路徑；快取沒有就產生（產生失敗丟例外）。"""
+    pil_format, _, ext, quality = VARIANT_FORMATS[fmt]
+    # 背景工作已產生的 480/960 JPG 直接沿用
+    if fmt == "jpeg" and width:
+        sibling = src.with_name(f"{src.stem}.{width}w.jpg")
+        if sibling.is_file():
+            return sibling
+
+    st = src.stat()
+    key = hashlib.sha1(f"{relpath}|{st.st_mtime_ns}|{st.st_size}|{width or 0}|{fmt}".encode()).hexdigest()
+    dest = VARIANT_CACHE_DIR / key[:2] / f"{key}.{ext}"
+    if dest.is_file():
+        return dest
+
+    with _variant_locks[int(key[:8], 16) % len(_variant_locks)]:
+        if dest.is_file():
+            return dest
+        ensure_dir(dest.parent)
+        lock = dest.with_name(dest.name + ".lock")
+        deadline = monotonic() + VARIANT_LOCK_WAIT
+        while True:
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                if dest.is_file():
+                    return dest
+                try:
+                    if datetime.now().timestamp() - lock.stat().st_mtime > VARIANT_LOCK_STALE:
+                        lock.unlink()
+                        continue
+                except FileNotFoundError:
+                    continue
+                if monotonic() > deadline:
+                    raise TimeoutError(f"variant lock busy: {dest.name}")
+                sleep(0.05)
+
+        tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            if not dest.is_file():
+                started = perf_counter()
+                build_variant(str(src), str(tmp), width, pil_format, quality, WEBP_METHOD)
+                record_image_op("variant", perf_counter() - started)
+                os.replace(tmp, dest)
+        finally:
+            for p in (tmp, lock):
+                try: p.unlink()
+                except FileNotFoundError: pass
+    return dest
+
+def serve_image_variant(target: Path, relpath: str, cache_control=None):
+    """處理 /u/ 的 w / fmt 參數；參數不合法回 400，產生失敗就退回原檔（回 None）。"""
+    w = request.args.get("w")
+    fmt = (request.args.get("fmt") or "").lower() or None
+    if w is not None and (not w.isdigit() or int(w) not in VARIANT_WIDTHS):
+        abort(400)
+    if fmt is not None and fmt not in VARIANT_FORMATS:
+        abort(400)
+    negotiated = fmt is None
+    fmt = fmt or negotiate_image_format()
+    try:
+        path = get_image_variant(target, relpath, int(w) if w else None, fmt)
+    except Exception as e:
+        app.logger.warning("image variant %s w=%s fmt=%s failed: %s", relpath, w, fmt, e)
+        return None
+    resp = send_file_offloaded(path, mimetype=VARIANT_FORMATS[fmt][1],
+                               cache_control=cache_control or "public, max-age=86400")
+    if negotiated:
+        resp.vary.add("Accept")
+    return resp
 
-    # 防止 path traversal
-    if not str(target).startswith(str(uploads_root)) or not target.is_file():
+# 取用 /uploads 下的檔案（圖片/影片 inline，其餘下載）
+@app.route("/u/<path:relpath>")
+def serve_upload(relpath):
+    # 容錯：Windows 反斜線、開頭多餘的 /、DB 以前存成 uploads/reviews/xxx.jpg 都能找到；也防 path traversal
+    relpath = norm_upload_relpath(relpath)
+    target = resolve_upload_path(relpath)
+    if target is None:
         abort(404)
 
     mime = guess_mime(target)
+    v = request.args.get("v")
+    cache_control = None
+    if v and v == upload_content_token(relpath):
+        cache_control = IMMUTABLE_CACHE_CONTROL
+
+    # 圖片變體（縮圖 / WEBP）
+    if ("w" in request.args or "fmt" in request.args) and mime.startswith("image/") and mime != "image/gif":
+        resp = serve_image_variant(target, relpath, cache_control)
+        if resp is not None:
+            return resp
+
     as_attachment = not (mime.startswith("image/") or mime.startswith("video/"))
-    resp = send_file(
-        target,
-        mimetype=mime,
-        as_attachment=as_attachment,
-        download_name=target.name,
-        conditional=True
-    )
-    resp.headers["Cache-Control"] = "public, max-age=86400" if not as_attachment else "no-store"
-    return resp
+    if cache_control is None:
+        cache_control = "public, max-age=86400" if not as_attachment else "no-store"
+    return send_file_offloaded(target, mimetype=mime, cache_control=cache_control,
+                               as_attachment=as_attachment, download_name=target.name)
 
 
+REVIEWS_PAGE_SIZE = 12
 
 @app.route("/reviews")
+@page_cache("reviews", args=("cat", "before", "partial"))
 def reviews():
-    ensure_review_tables()
     cat_slug = (request.args.get("cat") or "").strip() or None
     conn = get_db_connection()
     with conn:
         with conn.cursor() as cur:
             cur.execute("SELECT id,name,slug FROM review_categories ORDER BY sort_order, name;")
             categories = cur.fetchall()
+            # 各分類已發佈篇數（partial index 上的一次 GROUP BY）
+            cur.execute("""
+            SELECT category_id, COUNT(*) AS n
+            FROM course_reviews
+            WHERE status='published'
+            GROUP BY category_id
+            """)
+            counts = {r["category_id"]: r["n"] for r in cur.fetchall()}
+            for c in categories:
+                c["count"] = counts.get(c["id"], 0)
+            total_count = sum(counts.values())
+
+            where, params = ["r.status='published'"], []
             if cat_slug:
-                cur.execute("""
-                SELECT r.*, ximen.name AS category_name, ximen.slug AS category_slug
-                FROM course_reviews r
-                JOIN review_categories ximen ON ximen.id=r.category_id
-                WHERE r.status='published' AND ximen.slug=%s
-                ORDER BY COALESCE(r.event_date, r.created_at) DESC, r.id DESC
-                """, (cat_slug,))
-            else:
-                cur.execute("""
-                SELECT r.*, ximen.name AS category_name, ximen.slug AS category_slug
-                FROM course_reviews r
-                JOIN review_categories ximen ON ximen.id=r.category_id
-                WHERE r.status='published'
-                ORDER BY COALESCE(r.event_date, r.created_at) DESC, r.id DESC
-                """)
+                cat = next((c for c in categories if c["slug"] == cat_slug), None)
+                where.append("r.category_id = %s"); params.append(cat["id"] if cat else None)
+
+            # keyset 分頁：before = "<排序時間 ISO>|<id>"（上一頁最後一筆）
+            before = (request.args.get("before") or "").strip()
+            if before:
+                try:
+                    ts, rid = before.rsplit("|", 1)
+                    where.append("(COALESCE(r.event_date, r.created_at), r.id) < (%s, %s)")
+                    params += [datetime.fromisoformat(ts), int(rid)]
+                except ValueError:
+                    before = ""
+
+            # 卡片只需要這幾欄（不拿 content_html）
+            cur.execute(f"""
+            SELECT r.id, r.title, left(r.summary, 300) AS summary, r.cover_path, r.cover_sha256, r.event_date,
+                   COALESCE(r.event_date, r.created_at) AS sort_at,
+                   ximen.name AS category_name, ximen.slug AS category_slug
+            FROM course_reviews r
+            JOIN review_categories ximen ON ximen.id=r.category_id
+            WHERE {" AND ".join(where)}
+            ORDER BY COALESCE(r.event_date, r.created_at) DESC, r.id DESC
+            LIMIT %s
+            """, params + [REVIEWS_PAGE_SIZE + 1])
             items = cur.fetchall()
     conn.close()
-    return render_template("reviews.html", categories=categories, items=items, cat_slug=cat_slug)
+
+    next_before = None
+    if len(items) > REVIEWS_PAGE_SIZE:
+        items = items[:REVIEWS_PAGE_SIZE]
+        last = items[-1]
+        next_before = f"{last['sort_at'].isoformat()}|{last['id']}"
+
+    template = "_review_cards.html" if request.args.get("partial") == "1" else "reviews.html"
+    return render_template(template, categories=categories, items=items, cat_slug=cat_slug,
+                           total_count=total_count, before=before, next_before=next_before)
 
 # ====== 回顧：前台單篇 ======
 @app.route("/reviews/<int:rid>")
+@page_cache("reviews")
 def review_detail(rid: int):
-    ensure_review_tables()
     conn = get_db_connection()
     with conn:
         with conn.cursor() as cur:
@@ -1451,7 +3718,7 @@ def review_detail(rid: int):
             review = cur.fetchone()
             if not review: abort(404)
             cur.execute("""
-            SELECT id, file_path, file_name, mime
+            SELECT id, file_path, file_name, mime, file_path_480, file_path_960, derivatives_status, content_sha256
             FROM review_media
             WHERE review_id=%s
             ORDER BY sort_order, created_at, id
@@ -1464,7 +3731,6 @@ def review_detail(rid: int):
 @app.route("/admin/reviews", methods=["GET","POST"])
 @admin_required
 def admin_reviews():
-    ensure_review_tables()
     if request.method == "POST":
         title = (request.form.get("title") or "").strip()
         category_id = request.form.get("category_id")
@@ -1477,11 +3743,12 @@ def admin_reviews():
         if not title or not category_id:
             flash("請填寫標題與分類","warning"); return redirect(url_for("admin_reviews"))
 
-        cover_path = None
+        cover_path = cover_sha256 = None
         if cover and cover.filename:
             saved = safe_uuid_filename(cover.filename)
             cover_abs = os.path.join(UPLOAD_FOLDER_REVIEWS, saved)
             cover.save(cover_abs)
+            cover_sha256 = file_sha256(cover_abs)
             cover_path = f"reviews/{saved}"
 
         conn = get_db_connection()
@@ -1491,14 +3758,14 @@ def admin_reviews():
                 with conn.cursor() as cur:
                     if event_date:
                         cur.execute("""
-                        INSERT INTO course_reviews(category_id,title,event_date,cover_path,summary,content_html,status)
-                        VALUES(%s,%s,%s,%s,%s,%s,%s) RETURNING id
-                        """, (category_id, title, event_date, cover_path, summary, content_html, status))
+                        INSERT INTO course_reviews(category_id,title,event_date,cover_path,cover_sha256,summary,content_html,status)
+                        VALUES(%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id
+                        """, (category_id, title, event_date, cover_path, cover_sha256, summary, content_html, status))
                     else:
                         cur.execute("""
-                        INSERT INTO course_reviews(category_id,title,cover_path,summary,content_html,status)
-                        VALUES(%s,%s,%s,%s,%s,%s) RETURNING id
-                        """, (category_id, title, cover_path, summary, content_html, status))
+                        INSERT INTO course_reviews(category_id,title,cover_path,cover_sha256,summary,content_html,status)
+                        VALUES(%s,%s,%s,%s,%s,%s,%s) RETURNING id
+                        """, (category_id, title, cover_path, cover_sha256, summary, content_html, status))
                     new_id = cur.fetchone()["id"]
             flash("課程回顧已新增，現在可以上傳相片/影片囉！","success")
         except Exception as e:
@@ -1531,7 +3798,6 @@ def admin_reviews():
 @app.route("/admin/reviews/categories/new", methods=["POST"])
 @admin_required
 def admin_create_review_category():
-    ensure_review_tables()
     name = (request.form.get("name") or "").strip()
     if not name:
         flash("請輸入分類名稱","warning"); return redirect(url_for("admin_reviews"))
@@ -1583,7 +3849,6 @@ def jinja_datefmt(value, fmt="%Y-%m-%d"):
 @app.route("/admin/reviews/<int:rid>/edit", methods=["GET","POST"])
 @admin_required
 def admin_review_edit(rid):
-    ensure_review_tables()
     conn = get_db_connection()
 
     if request.method == "POST":
@@ -1597,11 +3862,12 @@ def admin_review_edit(rid):
             flash("請填寫標題與分類","warning")
             return redirect(url_for("admin_review_edit", rid=rid))
 
-        cover_path = None
+        cover_path = cover_sha256 = None
         if cover and cover.filename:
             saved = safe_uuid_filename(cover.filename)
             cover_abs = os.path.join(UPLOAD_FOLDER_REVIEWS, saved)
             cover.save(cover_abs)
+            cover_sha256 = file_sha256(cover_abs)
             cover_path = f"reviews/{saved}"
 
         with conn:
@@ -1609,9 +3875,9 @@ def admin_review_edit(rid):
                 if cover_path:
                     cur.execute("""
                     UPDATE course_reviews
-                    SET title=%s, category_id=%s, event_date=%s, status=%s, cover_path=%s
+                    SET title=%s, category_id=%s, event_date=%s, status=%s, cover_path=%s, cover_sha256=%s
                     WHERE id=%s
-                    """, (title, category_id, event_date, status, cover_path, rid))
+                    """, (title, category_id, event_date, status, cover_path, cover_sha256, rid))
                 else:
                     cur.execute("""
                     UPDATE course_reviews
@@ -1638,7 +3904,8 @@ def admin_review_edit(rid):
             cur.execute("SELECT id,name FROM review_categories ORDER BY sort_order, name;")
             cats = cur.fetchall()
             cur.execute("""
-            SELECT id, file_path, file_name, mime, sort_order, created_at
+            SELECT id, file_path, file_name, mime, sort_order, created_at,
+                   file_path_480, file_path_960, derivatives_status, derivatives_error, content_sha256
             FROM review_media
             WHERE review_id=%s
             ORDER BY sort_order, created_at, id
@@ -1651,7 +3918,6 @@ def admin_review_edit(rid):
 @app.route("/admin/reviews/<int:rid>/delete", methods=["POST"])
 @admin_required
 def admin_review_delete(rid):
-    ensure_review_tables()
     # 先把檔案從硬碟移除
     conn = get_db_connection()
     with conn:
@@ -1671,98 +3937,316 @@ def admin_review_delete(rid):
     flash("🗑️ 已刪除回顧與其媒體","success")
     return redirect(url_for("admin_reviews"))
 
-# 單篇後台上傳：支援多檔；圖片自動產 480/960 縮圖 & WEBP
+# ===== 回顧媒體上傳：邊收邊寫 =====
+# 指定的 endpoint 上傳時，multipart 每一段檔案直接寫進目的資料夾裡的暫存檔，
+# 一邊算 SHA-256、一邊計大小；超過單檔上限就截斷、後面的 bytes 只讀不存。
+# 整個 request 的上限由 MAX_CONTENT_LENGTH 把關（超過時 werkzeug 丟 413）。
+# 沒被採用的暫存檔會在 request 結束時刪掉。
+UPLOAD_IO_WORKERS = int(os.environ.get("UPLOAD_IO_WORKERS", 4))
+
+class UploadSink:
+    """werkzeug 用來裝單一上傳檔的 file-like 物件：落地到暫存檔並同步計算雜湊。"""
+
+    def __init__(self, dirpath: str, limit_bytes: int):
+        ensure_dir(Path(dirpath))
+        fd, self.path = tempfile.mkstemp(prefix=".upload-", suffix=".part", dir=dirpath)
+        self._f = os.fdopen(fd, "w+b")
+        self.limit = limit_bytes
+        self.size = 0
+        self.too_large = False
+        self.committed = False
+        self._sha = hashlib.sha256()
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.too_large:
+            return len(data)
+        if self.limit and self.size > self.limit:
+            self.too_large = True
+            self._f.seek(0)
+            self._f.truncate()
+            return len(data)
+        self._sha.update(data)
+        return self._f.write(data)
+
+    @property
+    def sha256(self) -> str:
+        return self._sha.hexdigest()
+
+    def commit(self, dest) -> None:
+        """寫完的檔案 fsync 後原子地改名成正式檔名（同一個資料夾，不會跨檔案系統）。"""
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.path, dest)
+        self.committed = True
+
+    def discard(self) -> None:
+        if not self._f.closed:
+            self._f.close()
+        if not self.committed:
+            try: os.unlink(self.path)
+            except FileNotFoundError: pass
+
+    def __getattr__(self, name):
+        # read / readline / seek / tell / close ... 交給底層檔案
+        return getattr(self._f, name)
+
+class StreamingUploadRequest(_flask.Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        target = STREAMING_UPLOAD_ENDPOINTS.get(self.endpoint)
+        if target is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        dirpath, limit_mb = target
+        sink = UploadSink(dirpath, limit_mb * 1024 * 1024)
+        g.setdefault("_upload_sinks", []).append(sink)
+        return sink
+
+app.request_class = StreamingUploadRequest
+
+# endpoint → (暫存/目的資料夾, 單檔上限 MB)
+STREAMING_UPLOAD_ENDPOINTS = {
+    "admin_upload_review_media": (UPLOAD_FOLDER_REVIEWS, MAX_FILE_MB),
+    "admin_upload_review_photos": (UPLOAD_FOLDER_REVIEWS, MAX_FILE_MB),
+}
+
+@app.teardown_appcontext
+def discard_upload_sinks(exc):
+    for sink in g.pop("_upload_sinks", []):
+        sink.discard()
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(e):
+    flash(f"❌ 上傳內容超過 {MAX_UPLOAD_MB} MB，請分批上傳", "danger")
+    return redirect(request.referrer or url_for("index"))
+
+_upload_io_pool = None   # (pid, ThreadPoolExecutor)
+
+def get_upload_io_pool() -> ThreadPoolExecutor:
+    global _upload_io_pool
+    if _upload_io_pool is None or _upload_io_pool[0] != os.getpid():
+        _upload_io_pool = (os.getpid(), ThreadPoolExecutor(max_workers=UPLOAD_IO_WORKERS,
+                                                           thread_name_prefix="upload-io"))
+    return _upload_io_pool[1]
+
+def _finalize_review_upload(f):
+    """（thread pool 內執行）暫存檔轉正；圖片只讀檔頭確認格式與尺寸。不是可辨識的圖片回傳 None。"""
+    sink = f.stream
+    dest = Path(UPLOAD_FOLDER_REVIEWS) / safe_uuid_filename(f.filename)
+    sink.commit(dest)
+    mime = guess_mime(dest.name)
+    width = height = None
+    status = "none"
+    if mime.startswith("image/"):
+        started = perf_counter()
+        try:
+            with Image.open(dest) as img:
+                width, height = img.size
+            status = "pending"
+            record_image_op("upload_probe", perf_counter() - started)
+        except Exception:
+            try: dest.unlink()
+            except OSError: pass
+            return None
+    return {
+        "file_path": f"reviews/{dest.name}", "abs_path": dest,
+        "file_name": secure_filename(f.filename), "mime": mime, "size_bytes": sink.size,
+        "width": width, "height": height, "status": status, "sha256": sink.sha256,
+    }
+
+@maintenance_job("sweep_stale_upload_parts", interval_seconds=3600)
+def sweep_stale_upload_parts():
+    """process 被砍掉時留下的 .upload-*.part（超過一天）清掉。"""
+    cutoff = datetime.now().timestamp() - 86400
+    removed = 0
+    for dirpath in {d for d, _ in STREAMING_UPLOAD_ENDPOINTS.values()}:
+        for p in Path(dirpath).glob(".upload-*.part"):
+            try:
+                if p.stat().st_mtime < cutoff:
+                    p.unlink(); removed += 1
+            except OSError:
+                pass
+    return removed
+
+# ===== 回顧圖片縮圖 / WEBP（背景產生）=====
+# 上傳時只存原檔、把 review_media.derivatives_status 設為 pending；
+# 由排程 leader 的 review_media_derivatives 工作用 FOR UPDATE SKIP LOCKED 認領，
+# 丟給 ProcessPoolExecutor 產生 480/960 JPG 與 WEBP，完成後回寫路徑並標記 ready。
+# 卡在 processing 超過 DERIVATIVE_CLAIM_TIMEOUT（worker 被砍、process 掛掉）會被重新認領。
+DERIVATIVE_WORKERS = int(os.environ.get("DERIVATIVE_WORKERS", max(1, min(4, (os.cpu_count() or 2) - 1))))
+DERIVATIVE_BATCH = int(os.environ.get("DERIVATIVE_BATCH", DERIVATIVE_WORKERS * 2))
+DERIVATIVE_MAX_ATTEMPTS = int(os.environ.get("DERIVATIVE_MAX_ATTEMPTS", 3))
+DERIVATIVE_CLAIM_TIMEOUT = int(os.environ.get("DERIVATIVE_CLAIM_TIMEOUT", 600))   # 秒
+DERIVATIVE_RUN_BUDGET = float(os.environ.get("DERIVATIVE_RUN_BUDGET", 120))      # 每輪最多處理幾秒，避免卡住其他排程工作
+
+_derivative_pool = None   # (pid, ProcessPoolExecutor)；只有排程執行緒會用到
+
+def get_derivative_pool() -> ProcessPoolExecutor:
+    """每個 process 一個 worker pool；用 spawn 啟動，避免在多執行緒的 web process 裡 fork。"""
+    global _derivative_pool
+    if _derivative_pool is None or _derivative_pool[0] != os.getpid():
+        _derivative_pool = (os.getpid(), ProcessPoolExecutor(
+            max_workers=DERIVATIVE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        ))
+    return _derivative_pool[1]
+
+def _reset_derivative_pool():
+    global _derivative_pool
+    if _derivative_pool is not None and _derivative_pool[0] == os.getpid():
+        _derivative_pool[1].shutdown(wait=False, cancel_futures=True)
+    _derivative_pool = None
+
+def claim_derivative_jobs(limit: int) -> list:
+    """認領待處理的圖片（含逾時的 processing），立即 commit 讓其他認領者看得到。"""
+    conn = get_db_connection()
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE review_media
+                SET derivatives_status = 'processing',
+                    derivatives_claimed_at = NOW(),
+                    derivatives_attempts = derivatives_attempts + 1
+                WHERE id IN (
+                    SELECT id FROM review_media
+                    WHERE derivatives_status = 'pending'
+                       OR (derivatives_status = 'processing'
+                           AND derivatives_claimed_at < NOW() - make_interval(secs => %s))
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, file_path, derivatives_attempts
+            """, (DERIVATIVE_CLAIM_TIMEOUT, limit))
+            rows = cur.fetchall()
+    conn.close()
+    return rows
+
+def finish_derivative_job(job: dict, result: dict = None, error: str = None):
+    """回寫結果；若這段期間媒體已被刪除，順手把剛產生的檔案清掉。"""
+    conn = get_db_connection()
+    with conn:
+        with conn.cursor() as cur:
+            if result is not None:
+                rel_dir = posixpath.dirname(job["file_path"])
+                rel = lambda name: posixpath.join(rel_dir, name) if name else None
+                thumbs = result["thumbs"]
+                cur.execute("""
+                    UPDATE review_media
+                    SET derivatives_status = 'ready', derivatives_error = NULL,
+                        derivatives_claimed_at = NULL,
+                        width = %s, height = %s,
+                        file_path_480 = %s, file_path_960 = %s, file_path_webp = %s
+                    WHERE id = %s AND derivatives_status = 'processing'
+                """, (result["width"], result["height"],
+                      rel(thumbs.get(480)), rel(thumbs.get(960)), rel(result["webp"]), job["id"]))
+                if cur.rowcount == 0:
+                    for name in [*thumbs.values(), result["webp"]]:
+                        p = (UPLOAD_DIR / rel(name)).resolve()
+                        if str(p).startswith(str(UPLOAD_DIR)) and p.exists():
+                            try: p.unlink()
+                            except OSError: pass
+            else:
+                cur.execute("""
+                    UPDATE review_media
+                    SET derivatives_status = CASE WHEN derivatives_attempts >= %s THEN 'failed' ELSE 'pending' END,
+                        derivatives_error = %s,
+                        derivatives_claimed_at = NULL
+                    WHERE id = %s AND derivatives_status = 'processing'
+                """, (DERIVATIVE_MAX_ATTEMPTS, (error or "")[:500], job["id"]))
+    conn.close()
+
+@maintenance_job("review_media_derivatives", interval_seconds=5)
+def process_review_media_derivatives():
+    """一批一批認領、平行處理，直到佇列清空或超過本輪時間預算。回傳處理完成的張數。"""
+    started = monotonic()
+    done = 0
+    while monotonic() - started < DERIVATIVE_RUN_BUDGET:
+        jobs = claim_derivative_jobs(DERIVATIVE_BATCH)
+        if not jobs:
+            break
+        pool = get_derivative_pool()
+        futures = []
+        for job in jobs:
+            orig = (UPLOAD_DIR / job["file_path"]).resolve()
+            futures.append(pool.submit(build_derivatives, str(orig), THUMB_SIZES,
+                                       JPEG_QUALITY, WEBP_QUALITY, WEBP_METHOD))
+        broken = False
+        for job, fut in zip(jobs, futures):
+            try:
+                result = fut.result()
+                record_image_op("derivatives", result.get("seconds", 0))
+                finish_derivative_job(job, result=result)
+                done += 1
+            except BrokenProcessPool as e:
+                # worker 被 OOM killer 之類砍掉：這批記一次失敗，重建 pool 後下一輪再試
+                broken = True
+                finish_derivative_job(job, error=f"worker crashed: {e}")
+            except Exception as e:
+                app.logger.warning("review_media %s derivatives failed: %s", job["id"], e)
+                finish_derivative_job(job, error=str(e))
+        if broken:
+            _reset_derivative_pool()
+            break
+    return done
+
+# 單篇後台上傳：支援多檔；只存原檔，圖片的 480/960 縮圖 & WEBP 交給背景工作
 @app.route("/admin/reviews/<int:rid>/media/upload", methods=["POST"])
 @admin_required
 def admin_upload_review_media(rid: int):
-    ensure_review_tables()
-
-    files = request.files.getlist("media") or []
+    files = [f for f in (request.files.getlist("media") or request.files.getlist("photos"))  # photos：舊表單欄位
+             if f and f.filename]
     if not files:
         flash("沒有選擇檔案", "warning")
         return redirect(url_for("admin_review_edit", rid=rid))
 
-    inserted = 0
-    with get_db_connection() as conn, conn.cursor() as cur:
-        for f in files:
-            if not f or not f.filename:
-                continue
-            if not allowed_ext(f.filename, ALLOWED_MEDIA_EXTS):
-                continue
-
-            # 大小限制
-            f.stream.seek(0, os.SEEK_END)
-            size_bytes = f.stream.tell()
-            f.stream.seek(0)
-            if size_bytes > MAX_FILE_MB * 1024 * 1024:
-                continue
-
-            # 存原檔
-            saved = safe_uuid_filename(f.filename)
-            orig_path = (Path(UPLOAD_FOLDER_REVIEWS) / saved).resolve()
-            orig_path.parent.mkdir(parents=True, exist_ok=True)
-            f.save(orig_path)
-
-            file_rel = f"reviews/{orig_path.name}"
-            mime = guess_mime(orig_path)
-            width = height = None
-            rel480 = rel960 = relwebp = None
+    # 檔案在解析表單時已經邊收邊寫到暫存檔；這裡只挑掉副檔名不符 / 超過大小 / 空檔
+    accepted = [f for f in files
+                if allowed_ext(f.filename, ALLOWED_MEDIA_EXTS)
+                and isinstance(f.stream, UploadSink)
+                and not f.stream.too_large and f.stream.size > 0]
+    # 轉正（fsync + rename + 讀圖片檔頭）平行處理
+    saved = [r for r in get_upload_io_pool().map(_finalize_review_upload, accepted) if r]
+    skipped = len(files) - len(saved)
 
-            # 圖片才做縮圖 / WEBP
-            if mime.startswith("image/"):
-                try:
-                    from PIL import Image
-                    with Image.open(orig_path) as img:
-                        if img.mode not in ("RGB", "RGBA"):
-                            img = img.convert("RGB")
-                        width, height = img.size
-
-                        # 480 / 960 縮圖（JPG）
-                        for w in THUMB_SIZES:
-                            thumb = resize_fit_width(img, w)
-                            tpath = orig_path.with_name(f"{orig_path.stem}.{w}w.jpg")
-                            thumb.save(tpath, "JPEG", quality=JPEG_QUALITY, optimize=True)
-                            rel = f"reviews/{tpath.name}"
-                            if w == 480: rel480 = rel
-                            if w == 960: rel960 = rel
-
-                        # 原尺寸 WEBP
-                        webp_path = orig_path.with_suffix(".webp")
-                        img.save(webp_path, "WEBP", quality=WEBP_QUALITY, method=6)
-                        relwebp = f"reviews/{webp_path.name}"
-                except Exception:
-                    # 影像處理失敗就把原檔刪掉，換下一個
-                    try:
-                        if orig_path.exists(): orig_path.unlink()
-                    except:
-                        pass
-                    continue
+    if saved:
+        try:
+            with get_db_connection() as conn, conn.cursor() as cur:
+                # 鎖住這篇回顧，同時上傳時排序號才不會撞到 uq_review_media_order
+                cur.execute("SELECT id FROM course_reviews WHERE id=%s FOR UPDATE", (rid,))
+                if not cur.fetchone():
+                    raise LookupError(rid)
+                cur.execute("SELECT COALESCE(MAX(sort_order), -1) + 1 AS next FROM review_media WHERE review_id=%s", (rid,))
+                base = cur.fetchone()["next"]
+                execute_values(cur, """
+                    INSERT INTO review_media
+                      (review_id, file_path, file_name, mime, size_bytes, sort_order, created_at,
+                       width, height, derivatives_status, content_sha256)
+                    VALUES %s
+                """, [
+                    (rid, r["file_path"], r["file_name"], r["mime"], r["size_bytes"], base + i,
+                     r["width"], r["height"], r["status"], r["sha256"])
+                    for i, r in enumerate(saved)
+                ], template="(%s, %s, %s, %s, %s, %s, NOW(), %s, %s, %s, %s)")
+        except Exception as e:
+            for r in saved:
+                try: r["abs_path"].unlink()
+                except OSError: pass
+            if isinstance(e, LookupError):
+                flash("找不到回顧", "danger")
+                return redirect(url_for("admin_reviews"))
+            raise
 
-            # 寫入 DB（sort_order = 同篇最大+1）
-            cur.execute("""
-                INSERT INTO review_media
-                  (review_id, file_path, file_name, mime, size_bytes,
-                   sort_order, created_at, width, height,
-                   file_path_480, file_path_960, file_path_webp)
-                VALUES
-                  (%s, %s, %s, %s, %s,
-                   COALESCE((SELECT COALESCE(MAX(sort_order), -1) + 1 FROM review_media WHERE review_id=%s), 0),
-                   NOW(), %s, %s, %s, %s, %s)
-            """, (
-                rid, file_rel, secure_filename(f.filename), mime, size_bytes,
-                rid, width, height, rel480, rel960, relwebp
-            ))
-            inserted += 1
-
-    flash(f"✅ 已上傳 {inserted} 個檔案", "success")
+    msg = f"✅ 已上傳 {len(saved)} 個檔案，縮圖產生中"
+    if skipped:
+        msg += f"（{skipped} 個檔案格式不符或超過 {MAX_FILE_MB} MB，已略過）"
+    flash(msg, "success")
     return redirect(url_for("admin_review_edit", rid=rid))
 
 # 刪除單一媒體（含縮圖/WEBP 檔）
 @app.route("/admin/reviews/<int:rid>/media/<int:mid>/delete", methods=["POST"])
 @admin_required
 def admin_delete_review_media(rid: int, mid: int):
-    ensure_review_tables()
-
     row = None
     with get_db_connection() as conn, conn.cursor() as cur:
         cur.execute("""
@@ -1797,9 +4281,7 @@ def admin_delete_review_media(rid: int, mid: int):
 @app.route("/admin/reviews/<int:rid>/upload", methods=["POST"])
 @admin_required
 def admin_upload_review_photos(rid):
-    # 轉給新的多檔上傳入口
-    if not request.files.getlist("media"):
-        request.files.setlist("media", request.files.getlist("photos"))
+    # 轉給新的多檔上傳入口（它也會讀 photos 欄位）
     return admin_upload_review_media(rid)
 
 @app.route("/video")
@@ -1811,17 +4293,19 @@ def inject_cart_count():
     username = session.get("username")
     if not username: return dict(cart_count=0)
 
+    cached = get_cached_cart_count(username)
+    if cached is not None:
+        return dict(cart_count=cached)
+
     total = 0
     conn = None
     try:
         conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT COALESCE(SUM(quantity), 0) AS total FROM cart_items WHERE user_id = %s", (username,))
-        row = cur.fetchone() or {}
-        total = row.get("total", 0)
-        print("✅ inject_cart_count → user_id =", username, "total =", total)
+        with conn.cursor() as cur:
+            total = query_cart_count(cur, username)
+        set_cached_cart_count(username, total)
     except Exception as e:
-        print("⚠️ inject_cart_count error:", e)
+        app.logger.warning("inject_cart_count error: %s", e)
     finally:
         if conn: conn.close()
     return dict(cart_count=total)
@@ -1843,7 +4327,7 @@ def filesize_filter(num):
 @app.after_request
 def add_no_cache_headers(resp):
     ctype = resp.headers.get("Content-Type", "")
-    if ctype.startswith("text/html"):
+    if ctype.startswith("text/html") and not g.get("_page_cached"):
         resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0, private"
         resp.headers["Pragma"] = "no-cache"
         resp.headers["Expires"] = "0"
@@ -1974,5 +4458,30 @@ def change_password():
 
     return render_template("change_password.html")
 
+# 資料表由 init_db.py 的 migration 建立：部署時跑 `flask --app app migrate`（或 python init_db.py），
+# gunicorn 則由 gunicorn.conf.py 在啟動時執行一次
+def ensure_rent_location_constraints(verbose=True) -> list:
+    """
+    替 LOCATION_ALBUMS 裡還沒有排他約束的場地補上約束（只有沒 btree_gist 的資料庫需要）。
+    gunicorn master 也會呼叫（fork 之前），所以用自己的連線、不碰連線池。
+    """
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
+    try:
+        with conn, conn.cursor() as cur:
+            added = ensure_rent_overlap_constraints(cur, LOCATION_ALBUMS)
+    finally:
+        conn.close()
+    if verbose and added:
+        print("✅ 已補上場地排他約束：" + "、".join(added))
+    return added
+
+@app.cli.command("migrate")
+def migrate_command():
+    """套用尚未執行的資料庫 migration，並替沒有排他約束的租借場地補上約束。"""
+    run_migrations()
+    ensure_rent_location_constraints()
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    run_migrations()
+    ensure_rent_location_constraints()
+    app.run(debug=True)   # 排程在第一個 request 時啟動（debug reloader 的父程序不處理 request，不會多開）
@@ -0,0 +1,159 @@
+# benchmarks/booking_stress.py
+# 租借並發壓測：大量執行緒同時對少數幾天、兩個場地送隨機時段，全部走 app.book_rent()，
+# 檢查吞吐量 / 延遲、被排他約束擋下與重試的次數，最後確認 pending / approved 的申請沒有任何重疊。
+#
+#   DATABASE_URL=postgresql://... python benchmarks/booking_stress.py --requests 2000 --concurrency 64 --days 3
+#
+# 只會動到 2099 年以後、email 為 bench_bk_*@bench.invalid 的申請，跑完會清掉（--keep 保留）。
+# 每個執行緒自己開一條連線，--concurrency 不要超過資料庫的 max_connections。
+import argparse
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, time, timedelta
+from time import perf_counter
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as site  # noqa: E402
+from app import BookingError, book_rent, LOCATION_ALBUMS  # noqa: E402
+
+EMAIL_PATTERN = "bench\\_bk\\_%@bench.invalid"
+FIRST_DAY = date(2099, 1, 5)
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def connect(dsn):
+    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+
+
+def cleanup(conn):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM rent_requests WHERE date >= %s AND email LIKE %s",
+                    (FIRST_DAY, EMAIL_PATTERN))
+    conn.commit()
+
+
+def random_slot(rng, days):
+    """營業時間內、15 分鐘對齊、30～120 分鐘的隨機時段。"""
+    open_q = site.BUSINESS_OPEN.hour * 4 + site.BUSINESS_OPEN.minute // 15
+    close_q = site.BUSINESS_CLOSE.hour * 4 + site.BUSINESS_CLOSE.minute // 15
+    length = rng.randint(2, 8)
+    start = rng.randint(open_q, close_q - length)
+    to_time = lambda q: time(q // 4, q % 4 * 15)
+    return (rng.choice(sorted(LOCATION_ALBUMS)), FIRST_DAY + timedelta(days=rng.randrange(days)),
+            to_time(start), to_time(start + length))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="book_rent() 並發壓測")
+    ap.add_argument("--requests", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--days", type=int, default=3, help="申請集中在幾天內（越少衝突越多）")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--keep", action="store_true", help="跑完不清除測試資料")
+    args = ap.parse_args()
+
+    dsn = os.environ["DATABASE_URL"]
+    admin = connect(dsn)
+    cleanup(admin)
+
+    rng = random.Random(args.seed)
+    jobs = [(i,) + random_slot(rng, args.days) for i in range(args.requests)]
+
+    local = threading.local()
+    conns, conns_lock = [], threading.Lock()
+    retries = Counter()
+
+    # 數一下 run_booking_statement 的重試次數（死鎖 / 序列化失敗後會呼叫 sleep）
+    real_sleep = site.sleep
+    def counting_sleep(seconds):
+        retries[threading.get_ident()] += 1
+        real_sleep(seconds)
+    site.sleep = counting_sleep
+
+    def run(job):
+        i, location, d, s_t, e_t = job
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = connect(dsn)
+            with conns_lock:
+                conns.append(conn)
+        t0 = perf_counter()
+        try:
+            book_rent(conn, location, d, s_t, e_t, f"壓測 {i}", "0900-000-000",
+                      f"bench_bk_{i:06d}@bench.invalid", "[bench]")
+            outcome = "booked"
+        except BookingError:
+            outcome = "conflict"
+        except Exception as e:
+            conn.rollback()
+            outcome = f"error: {type(e).__name__}: {e}"
+        return outcome, perf_counter() - t0
+
+    t_start = perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(run, jobs))
+    finally:
+        site.sleep = real_sleep
+    elapsed = perf_counter() - t_start
+    for c in conns:
+        c.close()
+
+    counts = Counter(outcome for outcome, _ in results)
+    lat = sorted(dt * 1000 for _, dt in results)
+
+    with admin.cursor() as cur:
+        cur.execute("""
+            SELECT COUNT(*) AS n FROM rent_requests
+            WHERE date >= %s AND email LIKE %s AND status IN ('pending', 'approved')
+        """, (FIRST_DAY, EMAIL_PATTERN))
+        stored = cur.fetchone()["n"]
+        cur.execute("""
+            SELECT COUNT(*) AS n
+            FROM rent_requests a JOIN rent_requests b
+              ON a.id < b.id AND a.location = b.location AND a.during && b.during
+            WHERE a.date >= %s AND b.date >= %s
+              AND a.status IN ('pending', 'approved') AND b.status IN ('pending', 'approved')
+        """, (FIRST_DAY, FIRST_DAY))
+        overlaps = cur.fetchone()["n"]
+    admin.rollback()
+
+    print(f"requests: {len(jobs)}（{len(LOCATION_ALBUMS)} 個場地 × {args.days} 天），concurrency {args.concurrency}")
+    print(f"elapsed: {elapsed:.2f}s  throughput: {len(jobs) / elapsed:.1f} requests/s")
+    print(f"latency ms: p50 {percentile(lat, 50):.1f}  p95 {percentile(lat, 95):.1f}  "
+          f"p99 {percentile(lat, 99):.1f}  max {lat[-1]:.1f}")
+    for outcome in sorted(counts):
+        print(f"  {outcome}: {counts[outcome]}")
+    print(f"  retries (deadlock / serialization): {sum(retries.values())}")
+
+    problems = []
+    if any(o.startswith("error") for o in counts):
+        problems.append("有未預期的錯誤")
+    if overlaps:
+        problems.append(f"{overlaps} 組有效申請時段重疊")
+    if stored != counts.get("booked", 0):
+        problems.append(f"寫入 {stored} 筆，與成功數 {counts.get('booked', 0)} 不符")
+    print(f"stored active bookings: {stored}, overlapping pairs: {overlaps}")
+    print("OK" if not problems else "FAIL: " + "；".join(problems))
+
+    if not args.keep:
+        cleanup(admin)
+    admin.close()
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
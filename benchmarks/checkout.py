@@ -0,0 +1,174 @@
+# benchmarks/checkout.py
+# 結帳壓力測試：一次灌 N 個使用者的購物車，再用大量執行緒同時呼叫 app.place_order()，
+# 檢查吞吐量 / 延遲、有沒有死鎖、熱賣商品有沒有賣超、重複送出是否只成立一筆訂單。
+#
+#   DATABASE_URL=postgresql://... python benchmarks/checkout.py --users 300 --concurrency 64 --stock 150
+#
+# 只會動到 bench_ck_ 開頭的使用者與 99xxxx 的商品，跑完會清掉（--keep 保留）。
+# 每個執行緒自己開一條連線，--concurrency 不要超過資料庫的 max_connections。
+import argparse
+import os
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import CheckoutError, place_order  # noqa: E402
+
+USER_PREFIX = "bench_ck_"
+PID_BASE = 990000
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def connect(dsn):
+    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+
+
+def cleanup(conn):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM orders WHERE user_id LIKE %s", (USER_PREFIX + "%",))
+        cur.execute("DELETE FROM cart_items WHERE user_id LIKE %s", (USER_PREFIX + "%",))
+        cur.execute("DELETE FROM users WHERE username LIKE %s", (USER_PREFIX + "%",))
+        cur.execute("DELETE FROM products WHERE pid::int >= %s AND pid::int < %s", (PID_BASE, PID_BASE + 1000))
+    conn.commit()
+
+
+def seed(conn, users, items, stock):
+    """第一個商品是限量熱賣品（stock），其餘不限量；每個人購物車裡每樣各 1 件。"""
+    pids = [str(PID_BASE + i) for i in range(items)]
+    names = [f"{USER_PREFIX}{i:05d}" for i in range(users)]
+    with conn.cursor() as cur:
+        execute_values(cur, "INSERT INTO products (pid, name, price, stock) VALUES %s", [
+            (pid, f"壓測商品 {i}", 100 + i, stock if i == 0 else None) for i, pid in enumerate(pids)
+        ])
+        execute_values(cur, "INSERT INTO users (username, password, role) VALUES %s",
+                       [(u, "x", "member") for u in names])
+        execute_values(cur, "INSERT INTO cart_items (user_id, product_id, quantity) VALUES %s",
+                       [(u, pid, 1) for u in names for pid in pids])
+    conn.commit()
+    return names, pids
+
+
+def main():
+    ap = argparse.ArgumentParser(description="place_order() 並發壓測")
+    ap.add_argument("--users", type=int, default=300)
+    ap.add_argument("--items", type=int, default=3, help="每個購物車的品項數")
+    ap.add_argument("--stock", type=int, default=150, help="熱賣商品庫存")
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--dup", type=float, default=0.2, help="同一把冪等鍵重複送出的比例")
+    ap.add_argument("--keep", action="store_true", help="跑完不清除測試資料")
+    args = ap.parse_args()
+
+    dsn = os.environ["DATABASE_URL"]
+    admin = connect(dsn)
+    cleanup(admin)
+    users, pids = seed(admin, args.users, args.items, args.stock)
+
+    # 每個使用者一把鍵；部分使用者用同一把鍵送兩次（模擬連點），交錯排進工作佇列
+    jobs = [(u, uuid.uuid4().hex) for u in users]
+    n_dup = int(len(jobs) * args.dup)
+    jobs = jobs + jobs[:n_dup]
+    jobs.sort(key=lambda j: j[0])
+
+    local = threading.local()
+    conns, conns_lock = [], threading.Lock()
+
+    def run(job):
+        user_id, key = job
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = connect(dsn)
+            with conns_lock:
+                conns.append(conn)
+        t0 = perf_counter()
+        try:
+            order_id, created = place_order(conn, user_id, key)
+            conn.commit()
+            outcome = "created" if created else "replayed"
+        except CheckoutError:
+            conn.rollback()
+            outcome = "rejected"
+        except psycopg2.errors.DeadlockDetected:
+            conn.rollback()
+            outcome = "deadlock"
+        except Exception as e:
+            conn.rollback()
+            outcome = f"error: {type(e).__name__}: {e}"
+        return outcome, perf_counter() - t0
+
+    t_start = perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(run, jobs))
+    elapsed = perf_counter() - t_start
+    for c in conns:
+        c.close()
+
+    counts = {}
+    for outcome, _ in results:
+        counts[outcome] = counts.get(outcome, 0) + 1
+    lat = sorted(dt * 1000 for _, dt in results)
+
+    with admin.cursor() as cur:
+        cur.execute("SELECT stock FROM products WHERE pid = %s", (pids[0],))
+        remaining = cur.fetchone()["stock"]
+        cur.execute("""
+            SELECT COALESCE(SUM(oi.quantity), 0) AS sold
+            FROM order_items oi JOIN orders o ON o.id = oi.order_id
+            WHERE o.user_id LIKE %s AND oi.product_id = %s
+        """, (USER_PREFIX + "%", pids[0]))
+        sold = cur.fetchone()["sold"]
+        cur.execute("""
+            SELECT COUNT(*) AS n, COUNT(DISTINCT (user_id, idempotency_key)) AS keys
+            FROM orders WHERE user_id LIKE %s AND item_count > 0
+        """, (USER_PREFIX + "%",))
+        orders = cur.fetchone()
+        cur.execute("""
+            SELECT COUNT(*) AS n FROM orders o
+            WHERE o.user_id LIKE %s
+              AND EXISTS (SELECT 1 FROM cart_items ci WHERE ci.user_id = o.user_id)
+        """, (USER_PREFIX + "%",))
+        leftover_carts = cur.fetchone()["n"]
+    admin.rollback()
+
+    print(f"checkouts: {len(jobs)}（{args.users} 位使用者，其中 {n_dup} 筆重複送出），concurrency {args.concurrency}")
+    print(f"elapsed: {elapsed:.2f}s  throughput: {len(jobs) / elapsed:.1f} checkouts/s")
+    print(f"latency ms: p50 {percentile(lat, 50):.1f}  p95 {percentile(lat, 95):.1f}  "
+          f"p99 {percentile(lat, 99):.1f}  max {lat[-1]:.1f}")
+    for outcome in sorted(counts):
+        print(f"  {outcome}: {counts[outcome]}")
+
+    problems = []
+    if counts.get("deadlock"):
+        problems.append(f"{counts['deadlock']} 次死鎖")
+    if any(o.startswith("error") for o in counts):
+        problems.append("有未預期的錯誤")
+    if remaining < 0 or sold + remaining != args.stock:
+        problems.append(f"庫存對不上：賣出 {sold} + 剩餘 {remaining} != {args.stock}")
+    if sold != min(args.stock, args.users):
+        problems.append(f"熱賣品賣出 {sold}，預期 {min(args.stock, args.users)}")
+    if orders["n"] != orders["keys"] or orders["n"] != counts.get("created", 0):
+        problems.append(f"訂單數 {orders['n']} 與成立數 {counts.get('created', 0)} 不符（重複下單？）")
+    if leftover_carts:
+        problems.append(f"{leftover_carts} 位已下單的使用者購物車沒清空")
+    print(f"hot item: sold {sold}, remaining {remaining}")
+    print("OK" if not problems else "FAIL: " + "；".join(problems))
+
+    if not args.keep:
+        cleanup(admin)
+    admin.close()
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,517 @@
+# benchmarks/harness.py
+# 熱門路由的壓測：灌一份接近正式環境量級的資料，再量各路由的 p50 / p95 / p99、吞吐量與每個請求的 SQL 次數。
+#
+#   python benchmarks/harness.py seed                    # 預設 10 萬筆租借、1 萬篇回顧（各 3 張圖）、2000 個購物車
+#   python benchmarks/harness.py run --mode client       # Flask test client（同一個 process）
+#   python benchmarks/harness.py run --mode gunicorn -w 4 --concurrency 32   # 起一組 gunicorn 再打 HTTP
+#   python benchmarks/harness.py run --mode http --url http://127.0.0.1:8000 # 打已經在跑的站
+#   python benchmarks/harness.py run ... --out after.json --compare before.json
+#   python benchmarks/harness.py clean
+#
+# 壓測資料都帶記號（使用者 bench_*、Email @bench.invalid、標題 [bench]、商品 98xxxx），clean 只刪這些。
+# 每個請求的 SQL 次數取自回應的 Server-Timing（METRICS_ENABLED=1，client / gunicorn 模式會自動打開）。
+import argparse
+import http.cookiejar
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from time import monotonic, perf_counter, sleep
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BENCH_EMAIL_DOMAIN = "bench.invalid"
+BENCH_TITLE_PREFIX = "[bench] "
+BENCH_USER_PREFIX = "bench_u"
+BENCH_ADMIN = "bench_admin"
+BENCH_PASSWORD = "bench"
+BENCH_CATEGORY_SLUG = "bench"
+BENCH_PID_BASE = 980000
+BENCH_PRODUCTS = 20
+RENT_FIRST_DAY = date(2031, 1, 2)          # 遠在未來：不會被封存工作搬走，也不會跟真資料撞時段
+RENT_LOCATIONS = ("府前教室", "西門教室")
+RENT_SLOTS_PER_DAY = 50                     # 09:00～21:30，每 15 分鐘一格
+ROUTES = ("index", "reviews", "shop", "cart", "rent_post", "timeslots", "rent_calendar", "review_upload")
+
+_server_timing_re = re.compile(r'db;dur=[\d.]+;desc="(\d+) queries"')
+
+
+def connect():
+    return psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = (len(sorted_vals) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+
+# ===== 資料 =====
+def clean(conn):
+    upload_dir = os.environ.get("UPLOAD_DIR", os.path.join(ROOT, "uploads"))
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT m.file_path, m.file_path_480, m.file_path_960, m.file_path_webp
+            FROM review_media m JOIN course_reviews r ON r.id = m.review_id
+            WHERE r.title LIKE %s AND m.size_bytes > 0
+        """, (BENCH_TITLE_PREFIX + "%",))
+        for row in cur.fetchall():
+            for rel in row.values():
+                if rel:
+                    try: os.unlink(os.path.join(upload_dir, rel))
+                    except OSError: pass
+        cur.execute("DELETE FROM course_reviews WHERE title LIKE %s", (BENCH_TITLE_PREFIX + "%",))
+        cur.execute("DELETE FROM review_categories WHERE slug = %s", (BENCH_CATEGORY_SLUG,))
+        cur.execute("DELETE FROM rent_requests WHERE email LIKE %s", ("%@" + BENCH_EMAIL_DOMAIN,))
+        for table, column in (("orders", "user_id"), ("cart_items", "user_id"), ("users", "username")):
+            cur.execute(f"DELETE FROM {table} WHERE {column} LIKE %s", ("bench\\_%",))
+        cur.execute("DELETE FROM products WHERE pid ~ '^[0-9]+$' AND pid::int >= %s AND pid::int < %s",
+                    (BENCH_PID_BASE, BENCH_PID_BASE + 1000))
+    conn.commit()
+
+
+def seed(conn, rents, reviews, media_per_review, carts):
+    """每張表一條 generate_series 的 INSERT；預設量級在本機約十幾秒（多半花在 trigger 與索引）。"""
+    clean(conn)
+    started = monotonic()
+    with conn.cursor() as cur:
+        # 租借：每個場地每天 RENT_SLOTS_PER_DAY 個互不重疊的 15 分鐘時段，排他約束不會擋
+        cur.execute("""
+            INSERT INTO rent_requests
+              (location, date, time_slot, start_time, end_time, name, phone, email, note, status, submitted_at)
+            SELECT loc, d, to_char(st, 'HH24:MI') || '–' || to_char(st + interval '15 minutes', 'HH24:MI'),
+                   st, st + interval '15 minutes',
+                   '壓測' || i, '0912-345-678', 'r' || i || '@' || %(domain)s, '',
+                   (ARRAY['pending','approved','rejected'])[1 + i %% 3],
+                   NOW() - make_interval(mins => i)
+            FROM (
+                SELECT i,
+                       (%(locs)s::text[])[1 + i %% 2] AS loc,
+                       %(first)s::date + (i / (2 * %(slots)s)) AS d,
+                       time '09:00' + make_interval(mins => 15 * ((i / 2) %% %(slots)s)) AS st
+                FROM generate_series(0, %(n)s - 1) AS i
+            ) s
+        """, {"domain": BENCH_EMAIL_DOMAIN, "locs": list(RENT_LOCATIONS), "first": RENT_FIRST_DAY,
+              "slots": RENT_SLOTS_PER_DAY, "n": rents})
+
+        cur.execute("""
+            INSERT INTO review_categories (name, slug, sort_order) VALUES ('壓測', %s, 999)
+            RETURNING id
+        """, (BENCH_CATEGORY_SLUG,))
+        cat_id = cur.fetchone()["id"]
+        cur.execute("""
+            INSERT INTO course_reviews (category_id, title, event_date, summary, content_html, status, created_at)
+            SELECT %(cat)s, %(prefix)s || '課程回顧第 ' || i || ' 篇',
+                   CURRENT_DATE - i, '這是壓測用的課程回顧摘要，第 ' || i || ' 篇。',
+                   '<p>課程內容與心得分享，第 ' || i || ' 篇。</p>',
+                   CASE WHEN i %% 20 = 0 THEN 'draft' ELSE 'published' END,
+                   NOW() - make_interval(hours => i)
+            FROM generate_series(1, %(n)s) AS i
+        """, {"cat": cat_id, "prefix": BENCH_TITLE_PREFIX, "n": reviews})
+        # 媒體列指向不存在的檔案（size_bytes = 0）：量的是查詢與渲染，不是讀檔
+        cur.execute("""
+            INSERT INTO review_media
+              (review_id, file_path, file_name, mime, size_bytes, sort_order, width, height,
+               derivatives_status, content_sha256)
+            SELECT r.id, 'reviews/bench-' || r.id || '-' || k || '.jpg', 'photo.jpg', 'image/jpeg', 0, k,
+                   1600, 1200, 'none', md5(r.id || '-' || k) || md5(k || '-' || r.id)
+            FROM course_reviews r CROSS JOIN generate_series(0, %(k)s - 1) AS k
+            WHERE r.category_id = %(cat)s
+        """, {"cat": cat_id, "k": media_per_review})
+        cur.execute("""
+            UPDATE course_reviews r SET cover_path = m.file_path
+            FROM review_media m
+            WHERE m.review_id = r.id AND m.sort_order = 0 AND r.category_id = %s
+        """, (cat_id,))
+
+        cur.execute("""
+            INSERT INTO products (pid, name, price)
+            SELECT (%(base)s + i)::text, '壓測商品 ' || i, 100 + i * 10
+            FROM generate_series(0, %(n)s - 1) AS i
+        """, {"base": BENCH_PID_BASE, "n": BENCH_PRODUCTS})
+        cur.execute("""
+            INSERT INTO users (username, password, role)
+            SELECT %(prefix)s || lpad(i::text, 5, '0'), %(pw)s, 'member' FROM generate_series(1, %(n)s) AS i
+            UNION ALL SELECT %(admin)s, %(pw)s, 'admin'
+        """, {"prefix": BENCH_USER_PREFIX, "pw": BENCH_PASSWORD, "n": carts, "admin": BENCH_ADMIN})
+        cur.execute("""
+            INSERT INTO cart_items (user_id, product_id, quantity)
+            SELECT %(prefix)s || lpad(i::text, 5, '0'), (%(base)s + (i * 7 + j) %% %(np)s)::text, 1 + j
+            FROM generate_series(1, %(n)s) AS i CROSS JOIN generate_series(0, 2 + i %% 4) AS j
+        """, {"prefix": BENCH_USER_PREFIX, "base": BENCH_PID_BASE, "np": BENCH_PRODUCTS, "n": carts})
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for table in ("rent_requests", "course_reviews", "review_media", "cart_items", "products", "users"):
+            cur.execute(f"VACUUM ANALYZE {table}")
+    conn.autocommit = False
+    return monotonic() - started
+
+
+def bench_state(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT (SELECT COUNT(*) FROM users WHERE username LIKE %(prefix)s) AS carts,
+                   (SELECT MIN(r.id) FROM course_reviews r JOIN review_categories c ON c.id = r.category_id
+                     WHERE c.slug = %(slug)s) AS review_id,
+                   (SELECT MAX(date) FROM rent_requests WHERE email LIKE %(email)s) AS last_day
+        """, {"prefix": BENCH_USER_PREFIX + "%", "slug": BENCH_CATEGORY_SLUG, "email": "%@" + BENCH_EMAIL_DOMAIN})
+        state = cur.fetchone()
+    conn.rollback()
+    if not state["carts"] or not state["review_id"]:
+        sys.exit("沒有壓測資料，請先執行：python benchmarks/harness.py seed")
+    return state
+
+
+# ===== 請求 =====
+def _jpeg_bytes(width=1600, height=1200):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (random.randrange(256), 120, 80)).save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def build_requests(route, state, rng):
+    """回傳 (method, path, form, files, user)；user 為 None 表示未登入，"admin" 表示後台帳號。"""
+    days = max(1, (state["last_day"] - RENT_FIRST_DAY).days) if state["last_day"] else 30
+    if route == "index":
+        return "GET", "/", None, None, None
+    if route == "reviews":
+        return "GET", "/reviews", None, None, None
+    if route == "shop":
+        return "GET", "/shop", None, None, "member"
+    if route == "cart":
+        return "GET", "/cart", None, None, "member"
+    if route == "timeslots":
+        d = RENT_FIRST_DAY + timedelta(days=rng.randrange(days))
+        q = urllib.parse.urlencode({"location": rng.choice(RENT_LOCATIONS), "date": d.isoformat()})
+        return "GET", f"/api/rent/timeslots?{q}", None, None, None
+    if route == "rent_calendar":
+        # 月檢視含已駁回：每個場地每天 50 筆壓測申請，一頁約 1750 筆
+        d = RENT_FIRST_DAY + timedelta(days=rng.randrange(days))
+        q = urllib.parse.urlencode({"location": rng.choice(RENT_LOCATIONS), "view": "month",
+                                    "date": d.isoformat(), "rejected": "1"})
+        return "GET", f"/manage_rents/calendar?{q}", None, None, "admin"
+    if route == "rent_post":
+        # 一半落在已排滿的日子（走衝突路徑），一半落在壓測資料之後的空日子（實際寫入）
+        if rng.random() < 0.5:
+            d = RENT_FIRST_DAY + timedelta(days=rng.randrange(days))
+        else:
+            d = (state["last_day"] or RENT_FIRST_DAY) + timedelta(days=1 + rng.randrange(3650))
+        start = 9 * 60 + 15 * rng.randrange(RENT_SLOTS_PER_DAY - 4)
+        end = start + 15 * rng.randint(1, 4)
+        return "POST", "/rent", {
+            "location": rng.choice(RENT_LOCATIONS), "date": d.isoformat(),
+            "start_time": f"{start // 60:02d}:{start % 60:02d}", "end_time": f"{end // 60:02d}:{end % 60:02d}",
+            "name": "壓測", "phone": "0912-345-678", "email": f"p{rng.randrange(10**9)}@{BENCH_EMAIL_DOMAIN}",
+            "note": "",
+        }, None, None
+    if route == "review_upload":
+        return ("POST", f"/admin/reviews/{state['review_id']}/media/upload", {},
+                {"media": (f"bench-{uuid.uuid4().hex[:8]}.jpg", _jpeg_bytes())}, "admin")
+    raise ValueError(route)
+
+
+def _queries_from_headers(headers):
+    m = _server_timing_re.search(headers.get("Server-Timing") or "")
+    return int(m.group(1)) if m else None
+
+
+class ClientDriver:
+    """Flask test client，每個執行緒一個 client（各自的 cookie / session）。"""
+
+    def __init__(self, state):
+        os.environ.setdefault("METRICS_ENABLED", "1")
+        os.environ.setdefault("MAINTENANCE_SCHEDULER", "0")
+        import app as app_module
+        self.app = app_module.app
+        self.state = state
+        self.local = threading.local()
+
+    def _client(self, user):
+        clients = getattr(self.local, "clients", None)
+        if clients is None:
+            clients = self.local.clients = {}
+        key = user or "anon"
+        if key not in clients:
+            c = clients[key] = self.app.test_client()
+            if user:
+                with c.session_transaction() as s:
+                    if user == "admin":
+                        s["username"], s["role"] = BENCH_ADMIN, "admin"
+                    else:
+                        s["username"], s["role"] = f"{BENCH_USER_PREFIX}{random.randint(1, self.state['carts'] - 1):05d}", "member"
+        return clients[key]
+
+    def request(self, method, path, form, files, user):
+        c = self._client(user)
+        data = dict(form or {})
+        for field, (name, blob) in (files or {}).items():
+            data[field] = (io.BytesIO(blob), name)
+        started = perf_counter()
+        resp = c.open(path, method=method, data=data or None,
+                      content_type="multipart/form-data" if files else None)
+        elapsed = perf_counter() - started
+        status, queries = resp.status_code, _queries_from_headers(resp.headers)
+        resp.close()
+        return status, elapsed, queries
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver:
+    """真的打 HTTP：每個執行緒每種身分一組 cookie jar，先 POST /login。"""
+
+    def __init__(self, base_url, state):
+        self.base = base_url.rstrip("/")
+        self.state = state
+        self.local = threading.local()
+
+    def _opener(self, user):
+        openers = getattr(self.local, "openers", None)
+        if openers is None:
+            openers = self.local.openers = {}
+        key = user or "anon"
+        if key not in openers:
+            jar = http.cookiejar.CookieJar()
+            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), _NoRedirect)
+            if user:
+                username = BENCH_ADMIN if user == "admin" else \
+                    f"{BENCH_USER_PREFIX}{random.randint(1, self.state['carts'] - 1):05d}"
+                self._send(opener, "POST", "/login", {"username": username, "password": BENCH_PASSWORD}, None)
+            openers[key] = opener
+        return openers[key]
+
+    def _send(self, opener, method, path, form, files):
+        headers = {}
+        body = None
+        if files:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for k, v in (form or {}).items():
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode())
+            for field, (name, blob) in files.items():
+                parts.append((f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{name}"\r\n'
+                              f'Content-Type: image/jpeg\r\n\r\n').encode() + blob + b"\r\n")
+            parts.append(f"--{boundary}--\r\n".encode())
+            body = b"".join(parts)
+            headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        elif form is not None:
+            body = urllib.parse.urlencode(form).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        req = urllib.request.Request(self.base + path, data=body, headers=headers, method=method)
+        try:
+            with opener.open(req, timeout=60) as resp:
+                resp.read()
+                return resp.status, resp.headers
+        except urllib.error.HTTPError as e:   # 3xx（不跟隨）/ 4xx / 5xx
+            e.read()
+            return e.code, e.headers
+
+    def request(self, method, path, form, files, user):
+        opener = self._opener(user)
+        started = perf_counter()
+        status, headers = self._send(opener, method, path, form, files)
+        return status, perf_counter() - started, _queries_from_headers(headers)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workers, threads):
+    if not shutil.which("gunicorn"):
+        sys.exit("找不到 gunicorn（pip install gunicorn）")
+    port = _free_port()
+    env = dict(os.environ, METRICS_ENABLED="1", MAINTENANCE_SCHEDULER="0", RUN_MIGRATIONS="0")
+    proc = subprocess.Popen(
+        ["gunicorn", "-w", str(workers), "--threads", str(threads), "-b", f"127.0.0.1:{port}",
+         "--log-level", "warning", "app:app"],
+        cwd=ROOT, env=env)
+    deadline = monotonic() + 30
+    while monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return proc, f"http://127.0.0.1:{port}"
+        except OSError:
+            if proc.poll() is not None:
+                sys.exit("gunicorn 啟動失敗")
+            sleep(0.2)
+    proc.terminate()
+    sys.exit("gunicorn 30 秒內沒有起來")
+
+
+# ===== 執行 =====
+def run_route(driver, route, state, requests, concurrency, warmup, seed_value):
+    rng = random.Random(f"{seed_value}:{route}")
+    jobs = [build_requests(route, state, rng) for _ in range(requests + warmup)]
+    for job in jobs[:warmup]:
+        driver.request(*job)
+    jobs = jobs[warmup:]
+
+    started = perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda j: driver.request(*j), jobs))
+    else:
+        results = [driver.request(*j) for j in jobs]
+    wall = perf_counter() - started
+
+    lat = sorted(r[1] * 1000 for r in results)
+    queries = [r[2] for r in results if r[2] is not None]
+    statuses = {}
+    for r in results:
+        statuses[str(r[0])] = statuses.get(str(r[0]), 0) + 1
+    rnd = lambda v: None if v is None else round(v, 2)
+    return {
+        "requests": len(results),
+        "errors": sum(n for s, n in statuses.items() if int(s) >= 500),
+        "statuses": statuses,
+        "p50_ms": rnd(percentile(lat, 50)), "p95_ms": rnd(percentile(lat, 95)),
+        "p99_ms": rnd(percentile(lat, 99)), "mean_ms": rnd(sum(lat) / len(lat)) if lat else None,
+        "max_ms": rnd(lat[-1]) if lat else None,
+        "throughput_rps": rnd(len(results) / wall) if wall else None,
+        "queries_per_request": rnd(sum(queries) / len(queries)) if queries else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def print_report(results, baseline=None):
+    cols = ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "queries_per_request")
+    print(f"{'route':<14}" + "".join(f"{c:>22}" for c in cols) + f"{'errors':>8}")
+    for route, r in results["routes"].items():
+        cells = []
+        for c in cols:
+            v = r.get(c)
+            cell = "-" if v is None else f"{v:.1f}"
+            old = ((baseline or {}).get("routes", {}).get(route) or {}).get(c)
+            if v is not None and old:
+                cell += f" ({(v - old) / old * 100:+.0f}%)"
+            cells.append(f"{cell:>22}")
+        print(f"{route:<14}" + "".join(cells) + f"{r['errors']:>8}")
+
+
+def cmd_run(args):
+    conn = connect()
+    state = bench_state(conn)
+    conn.close()
+    routes = args.routes.split(",") if args.routes else list(ROUTES)
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        sys.exit(f"未知的路由：{', '.join(sorted(unknown))}（可用：{', '.join(ROUTES)}）")
+
+    proc = None
+    if args.mode == "client":
+        driver = ClientDriver(state)
+    elif args.mode == "gunicorn":
+        proc, url = start_gunicorn(args.workers, args.threads)
+        driver = HttpDriver(url, state)
+    else:
+        if not args.url:
+            sys.exit("--mode http 需要 --url")
+        driver = HttpDriver(args.url, state)
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(), "mode": args.mode, "url": args.url,
+            "workers": args.workers if args.mode == "gunicorn" else None,
+            "concurrency": args.concurrency, "requests": args.requests, "warmup": args.warmup,
+            "seed": args.seed, "python": platform.python_version(),
+        },
+        "routes": {},
+    }
+    try:
+        for route in routes:
+            n = max(1, args.requests // 5) if route == "review_upload" else args.requests
+            results["routes"][route] = run_route(driver, route, state, n, args.concurrency,
+                                                 args.warmup, args.seed)
+            print(f"  {route}: done", file=sys.stderr)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+    print_report(results, baseline)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, ensure_ascii=False, indent=2)
+        print(f"saved {args.out}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="熱門路由壓測")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("seed", help="灌壓測資料（會先清掉舊的壓測資料）")
+    p.add_argument("--rents", type=int, default=100_000)
+    p.add_argument("--reviews", type=int, default=10_000)
+    p.add_argument("--media-per-review", type=int, default=3)
+    p.add_argument("--carts", type=int, default=2000)
+
+    sub.add_parser("clean", help="刪除所有壓測資料")
+
+    p = sub.add_parser("run", help="執行壓測")
+    p.add_argument("--mode", choices=("client", "gunicorn", "http"), default="client")
+    p.add_argument("--url", help="--mode http 的目標，例如 http://127.0.0.1:8000")
+    p.add_argument("-w", "--workers", type=int, default=4, help="--mode gunicorn 的 worker 數")
+    p.add_argument("--threads", type=int, default=4, help="--mode gunicorn 每個 worker 的執行緒數")
+    p.add_argument("--routes", help=f"逗號分隔，預設全部：{','.join(ROUTES)}")
+    p.add_argument("-n", "--requests", type=int, default=200, help="每個路由的請求數（上傳為 1/5）")
+    p.add_argument("-c", "--concurrency", type=int, default=1)
+    p.add_argument("--warmup", type=int, default=10)
+    p.add_argument("--seed", type=int, default=1, help="亂數種子（同一個種子打同一批請求）")
+    p.add_argument("--out", help="結果存成 JSON")
+    p.add_argument("--compare", help="拿之前存的 JSON 來比較")
+
+    args = ap.parse_args()
+    if args.cmd == "seed":
+        conn = connect()
+        took = seed(conn, args.rents, args.reviews, args.media_per_review, args.carts)
+        conn.close()
+        print(f"seeded in {took:.1f}s")
+    elif args.cmd == "clean":
+        conn = connect()
+        clean(conn)
+        conn.close()
+        print("cleaned")
+    else:
+        cmd_run(args)
+
+
+if __name__ == "__main__":
+    main()
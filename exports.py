@@ -0,0 +1,284 @@
+# exports.py
+# 租借申請（CSV / ICS）、聯絡訊息與訂單（CSV）的串流匯出，給 app.py 的 /admin/export/... 與命令列共用。
+# 用具名（server-side）cursor，每次只從 PostgreSQL 抓 EXPORT_ITERSIZE 筆、邊讀邊產生文字，
+# 記憶體不隨筆數成長；開頭（CSV 標題列 / VCALENDAR 表頭）在查詢之前就先送出。
+#
+#   python exports.py rents --format ics --location 府前教室 --from 2026-01-01 --to 2026-12-31 -o rents.ics
+#   python exports.py contacts --from 2026-01-01 > contacts.csv
+#   python exports.py orders --status paid > orders.csv
+#
+# 獨立成小模組、只依賴 psycopg2：命令列匯出不必把整個 Flask app（連線池、背景排程）帶起來。
+import argparse
+import csv
+import io
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+EXPORT_ITERSIZE = int(os.environ.get("EXPORT_ITERSIZE", 2000))
+EXPORT_FLUSH_ROWS = 500          # 每累積幾列送出一段
+EXPORT_TZ = timezone(timedelta(hours=8))  # Asia/Taipei
+
+EXPORT_FORMATS = {
+    "rents": ("csv", "ics"),
+    "contacts": ("csv",),
+    "orders": ("csv",),
+}
+EXPORT_STATUSES = {
+    "rents": ("pending", "approved", "rejected", "expired"),
+    "orders": ("placed", "paid", "cancelled"),
+}
+RENT_LOCATIONS = ("府前教室", "西門教室")   # 命令列用的預設；app.py 會傳入 LOCATION_ALBUMS
+
+
+def parse_export_filters(kind, fmt, args, locations=RENT_LOCATIONS) -> dict:
+    """
+    從 query string / 命令列取篩選條件：date_from、date_to（YYYY-MM-DD，含當天）、location（租借）、status（租借 / 訂單）。
+    不合理的值丟 ValueError（訊息可以直接給使用者看）。
+    """
+    if kind not in EXPORT_FORMATS:
+        raise ValueError(f"不支援的匯出項目：{kind}")
+    if fmt not in EXPORT_FORMATS[kind]:
+        raise ValueError(f"{kind} 不支援 {fmt} 格式")
+    filters = {}
+    for key in ("date_from", "date_to"):
+        value = (args.get(key) or "").strip()
+        if value:
+            try:
+                filters[key] = datetime.strptime(value, "%Y-%m-%d").date()
+            except ValueError:
+                raise ValueError(f"日期格式錯誤：{value[:20]}（請用 YYYY-MM-DD）")
+    location = (args.get("location") or "").strip()
+    if location:
+        if kind != "rents" or location not in locations:
+            raise ValueError("場地不正確")
+        filters["location"] = location
+    status = (args.get("status") or "").strip()
+    if status:
+        if status not in EXPORT_STATUSES.get(kind, ()):
+            raise ValueError("狀態不正確")
+        filters["status"] = status
+    return filters
+
+
+def export_filename(kind, fmt, filters) -> str:
+    parts = [kind] + [filters[k].strftime("%Y%m%d") for k in ("date_from", "date_to") if k in filters]
+    return "-".join(parts) + "." + fmt
+
+
+# ===== 查詢 =====
+def _rents_query(filters):
+    """租借申請含已封存的（UNION ALL），兩邊都走 (date, start_time, id) 索引（migration 14）合併排序。"""
+    where, params = [], {}
+    if "date_from" in filters:
+        where.append("date >= %(date_from)s"); params["date_from"] = filters["date_from"]
+    if "date_to" in filters:
+        where.append("date <= %(date_to)s"); params["date_to"] = filters["date_to"]
+    if "location" in filters:
+        where.append("location = %(location)s"); params["location"] = filters["location"]
+    if "status" in filters:
+        where.append("status = %(status)s"); params["status"] = filters["status"]
+    cond = " AND ".join(where) or "TRUE"
+    cols = "id, location, date, start_time, end_time, time_slot, name, phone, email, note, status, submitted_at"
+    # 條件寫在 UNION ALL 外層：兩邊各自沒有 WHERE 才會被攤平成 append rel，
+    # 條件照樣推進兩邊，ORDER BY 也才能用兩邊的索引做 Merge Append
+    sql = f"""
+        SELECT * FROM (
+            SELECT {cols}, FALSE AS archived FROM rent_requests
+            UNION ALL
+            SELECT {cols}, TRUE FROM rent_requests_archive
+        ) AS r
+        WHERE {cond}
+        ORDER BY date, start_time, id
+    """
+    return sql, params
+
+
+def _contacts_query(filters):
+    where, params = [], {}
+    if "date_from" in filters:
+        where.append("submitted_at >= %(date_from)s"); params["date_from"] = filters["date_from"]
+    if "date_to" in filters:
+        where.append("submitted_at < %(date_to)s"); params["date_to"] = filters["date_to"] + timedelta(days=1)
+    sql = f"""
+        SELECT id, submitted_at, name, email, message
+        FROM contact_messages
+        WHERE {" AND ".join(where) or "TRUE"}
+        ORDER BY submitted_at, id
+    """
+    return sql, params
+
+
+def _orders_query(filters):
+    """一列一個訂單品項；日期以台北時間的下單日計。"""
+    where, params = [], {}
+    if "date_from" in filters:
+        where.append("o.created_at >= %(date_from)s")
+        params["date_from"] = datetime.combine(filters["date_from"], datetime.min.time(), EXPORT_TZ)
+    if "date_to" in filters:
+        where.append("o.created_at < %(date_to)s")
+        params["date_to"] = datetime.combine(filters["date_to"] + timedelta(days=1), datetime.min.time(), EXPORT_TZ)
+    if "status" in filters:
+        where.append("o.status = %(status)s"); params["status"] = filters["status"]
+    sql = f"""
+        SELECT o.id, o.created_at AT TIME ZONE 'Asia/Taipei', o.user_id, o.status, o.item_count, o.total,
+               oi.product_id, oi.name, oi.unit_price, oi.quantity, oi.unit_price * oi.quantity
+        FROM orders o
+        LEFT JOIN order_items oi ON oi.order_id = o.id
+        WHERE {" AND ".join(where) or "TRUE"}
+        ORDER BY o.created_at, o.id, oi.product_id
+    """
+    return sql, params
+
+
+_QUERIES = {"rents": _rents_query, "contacts": _contacts_query, "orders": _orders_query}
+
+_CSV_HEADERS = {
+    "rents": ["id", "location", "date", "start_time", "end_time", "time_slot", "name", "phone", "email",
+              "note", "status", "submitted_at", "archived"],
+    "contacts": ["id", "submitted_at", "name", "email", "message"],
+    "orders": ["order_id", "created_at", "user_id", "status", "item_count", "order_total",
+               "product_id", "product_name", "unit_price", "quantity", "line_total"],
+}
+
+
+def _iter_rows(conn, kind, filters, itersize):
+    """具名 cursor：DECLARE 之後每次 FETCH itersize 筆；呼叫端負責交易與連線的收尾。"""
+    sql, params = _QUERIES[kind](filters)
+    with conn.cursor(name=f"export_{kind}", cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.itersize = itersize
+        cur.execute(sql, params)
+        yield from cur
+
+
+# ===== CSV =====
+def _csv_cell(value):
+    """時間轉字串；使用者輸入的文字若以 = + - @ 開頭，前面加 ' 避免被試算表當公式執行。"""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return "'" + value if value[:1] in ("=", "+", "-", "@", "\t", "\r") else value
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def stream_csv(conn, kind, filters, itersize=EXPORT_ITERSIZE):
+    """逐段產生 CSV 文字（UTF-8 BOM 開頭，Excel 打開中文才不會亂碼）。"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(_CSV_HEADERS[kind])
+    yield "\ufeff" + buf.getvalue()
+    buf.seek(0); buf.truncate()
+
+    n = 0
+    for row in _iter_rows(conn, kind, filters, itersize):
+        writer.writerow([_csv_cell(v) for v in row])
+        n += 1
+        if n % EXPORT_FLUSH_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+# ===== iCalendar（RFC 5545）=====
+_ICS_STATUS = {"approved": "CONFIRMED", "pending": "TENTATIVE"}   # 其餘（rejected / expired）為 CANCELLED
+
+
+def _ics_text(value) -> str:
+    return (str(value or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n").replace("\r", "\\n"))
+
+
+def _ics_fold(line: str) -> str:
+    """每行最多 75 個位元組（UTF-8），超過的以 CRLF + 空白接續，不切斷多位元組字元。"""
+    if len(line.encode("utf-8")) <= 75:
+        return line + "\r\n"
+    out, cur, size = [], [], 0
+    for ch in line:
+        n = len(ch.encode("utf-8"))
+        if size + n > (75 if not out else 74):
+            out.append("".join(cur)); cur, size = [], 0
+        cur.append(ch); size += n
+    out.append("".join(cur))
+    return "\r\n ".join(out) + "\r\n"
+
+
+def stream_ics(conn, filters, itersize=EXPORT_ITERSIZE, uid_domain="rent.invalid"):
+    """租借申請轉成 VEVENT；時間用 TZID=Asia/Taipei（台灣沒有日光節約，VTIMEZONE 固定 +0800）。"""
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    yield "".join(_ics_fold(l) for l in (
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//rent//export//ZH-TW", "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:場地租借", "X-WR-TIMEZONE:Asia/Taipei",
+        "BEGIN:VTIMEZONE", "TZID:Asia/Taipei", "BEGIN:STANDARD", "DTSTART:19700101T000000",
+        "TZOFFSETFROM:+0800", "TZOFFSETTO:+0800", "TZNAME:CST", "END:STANDARD", "END:VTIMEZONE",
+    ))
+
+    chunk, n = [], 0
+    for (rid, location, d, start_t, end_t, time_slot, name, phone, email, note,
+         status, _submitted_at, _archived) in _iter_rows(conn, "rents", filters, itersize):
+        if start_t and end_t:
+            times = (f"DTSTART;TZID=Asia/Taipei:{d:%Y%m%d}T{start_t:%H%M%S}",
+                     f"DTEND;TZID=Asia/Taipei:{d:%Y%m%d}T{end_t:%H%M%S}")
+        else:   # 只有文字時段的舊資料：當成整天
+            times = (f"DTSTART;VALUE=DATE:{d:%Y%m%d}", f"DTEND;VALUE=DATE:{d + timedelta(days=1):%Y%m%d}")
+        desc = f"申請人：{name}\n電話：{phone or ''}\nEmail：{email or ''}\n時段：{time_slot or ''}"
+        if note:
+            desc += f"\n備註：{note}"
+        for line in ("BEGIN:VEVENT", f"UID:rent-{rid}@{uid_domain}", f"DTSTAMP:{stamp}", *times,
+                     f"SUMMARY:{_ics_text(f'{location}｜{name}')}", f"LOCATION:{_ics_text(location)}",
+                     f"DESCRIPTION:{_ics_text(desc)}", f"STATUS:{_ICS_STATUS.get(status, 'CANCELLED')}",
+                     "END:VEVENT"):
+            chunk.append(_ics_fold(line))
+        n += 1
+        if n % EXPORT_FLUSH_ROWS == 0:
+            yield "".join(chunk); chunk = []
+    chunk.append("END:VCALENDAR\r\n")
+    yield "".join(chunk)
+
+
+def stream_export(conn, kind, fmt, filters, itersize=EXPORT_ITERSIZE, uid_domain="rent.invalid"):
+    """依格式回傳逐段產生文字的 generator；uid_domain 只用在 ICS 的 UID。"""
+    if fmt == "ics":
+        return stream_ics(conn, filters, itersize, uid_domain)
+    return stream_csv(conn, kind, filters, itersize)
+
+
+# ===== 命令列 =====
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="匯出租借申請 / 聯絡訊息 / 訂單")
+    ap.add_argument("kind", choices=sorted(EXPORT_FORMATS))
+    ap.add_argument("--format", default="csv", choices=("csv", "ics"))
+    ap.add_argument("--from", dest="date_from", help="YYYY-MM-DD（含）")
+    ap.add_argument("--to", dest="date_to", help="YYYY-MM-DD（含）")
+    ap.add_argument("--location")
+    ap.add_argument("--status")
+    ap.add_argument("--itersize", type=int, default=EXPORT_ITERSIZE)
+    ap.add_argument("-o", "--output", help="輸出檔案（預設 stdout）")
+    args = ap.parse_args(argv)
+
+    try:
+        filters = parse_export_filters(args.kind, args.format, vars(args))
+    except ValueError as e:
+        ap.error(str(e))
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        for chunk in stream_export(conn, args.kind, args.format, filters, args.itersize):
+            out.write(chunk)
+        out.flush()
+    finally:
+        conn.rollback()
+        conn.close()
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import os
+
+# gunicorn 預設會讀取工作目錄下的 gunicorn.conf.py
+
+def on_starting(server):
+    # master 啟動時跑一次 migration（worker fork 之前），view 可直接假設 schema 已存在
+    if os.environ.get("RUN_MIGRATIONS", "1") == "1":
+        from init_db import run_migrations
+        run_migrations()
+        # 沒有 btree_gist 時，新場地的排他約束也在這裡補上（場地清單在 app 裡）
+        from app import ensure_rent_location_constraints
+        ensure_rent_location_constraints()
+
+def post_worker_init(worker):
+    # 每個 worker 啟動背景排程；實際只有搶到 advisory lock 的那個會執行工作
+    from app import start_maintenance_scheduler
+    start_maintenance_scheduler()
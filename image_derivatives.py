@@ -0,0 +1,63 @@
+# image_derivatives.py
+# 回顧媒體的縮圖 / WEBP 產生器，給 app.py 的 ProcessPoolExecutor 用。
+# 獨立成小模組、只依賴 Pillow：worker process 以 spawn 啟動時只會 import 這支，
+# 不會把整個 Flask app（連線池、背景執行緒）帶進子行程。
+from pathlib import Path
+from time import perf_counter
+
+from PIL import Image
+
+
+def resize_fit_width(img: Image.Image, width: int) -> Image.Image:
+    if img.width <= width:
+        return img.copy()
+    ratio = width / float(img.width)
+    new_h = max(1, int(img.height * ratio))
+    return img.resize((width, new_h), Image.LANCZOS)
+
+
+def build_derivatives(orig_path: str, thumb_sizes, jpeg_quality: int,
+                      webp_quality: int, webp_method: int) -> dict:
+    """
+    讀原圖，產生 <stem>.<w>w.jpg 縮圖與 <stem>.webp，檔案放在原圖同一個資料夾。
+    回傳 {"width", "height", "thumbs": {w: 檔名}, "webp": 檔名, "seconds": 耗時}；失敗直接丟例外。
+    """
+    started = perf_counter()
+    orig = Path(orig_path)
+    out = {"thumbs": {}}
+    with Image.open(orig) as img:
+        img.load()
+        out["width"], out["height"] = img.size
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGB")
+
+        # 縮圖（JPG 不支援透明，一律轉 RGB）
+        rgb = img.convert("RGB") if img.mode == "RGBA" else img
+        for w in thumb_sizes:
+            tpath = orig.with_name(f"{orig.stem}.{w}w.jpg")
+            resize_fit_width(rgb, w).save(tpath, "JPEG", quality=jpeg_quality, optimize=True)
+            out["thumbs"][w] = tpath.name
+
+        # 原尺寸 WEBP
+        webp_path = orig.with_suffix(".webp")
+        img.save(webp_path, "WEBP", quality=webp_quality, method=webp_method)
+        out["webp"] = webp_path.name
+    out["seconds"] = perf_counter() - started
+    return out
+
+
+def build_variant(src_path: str, dest_path: str, width, pil_format: str, quality: int,
+                  webp_method: int = 4) -> None:
+    """產生單一尺寸 / 格式的衍生圖（/u/ 圖片變體服務用）；width 為 None 表示原尺寸。"""
+    with Image.open(src_path) as img:
+        img.load()
+        if pil_format == "JPEG":
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        if width:
+            img = resize_fit_width(img, width)
+        if pil_format == "WEBP":
+            img.save(dest_path, "WEBP", quality=quality, method=webp_method)
+        else:
+            img.save(dest_path, "JPEG", quality=quality, optimize=True, progressive=True)
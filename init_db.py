@@ -1,4 +1,5 @@
 import os
+import hashlib
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
@@ -6,291 +7,907 @@ import traceback
 
 load_dotenv()
 
+# ===== 資料庫 schema 版本化遷移 =====
+# 每個 migration 只執行一次，執行過的版本記在 schema_migrations；
+# 部署或啟動時跑一次（python init_db.py / flask --app app migrate / gunicorn.conf.py），
+# request 內不再做任何 DDL。要改 schema 就在最後一個 migration 後面加一個新版本號的 @migration，
+# 不要修改已經上線的 migration。
+
+# 多個 process 同時啟動時，用 advisory lock 讓 migration 排隊執行
+MIGRATION_LOCK_KEY = 717_0001
+
 def get_db_connection():
     return psycopg2.connect(
         os.environ["DATABASE_URL"],
         cursor_factory=RealDictCursor
     )
 
-def init_db():
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
+MIGRATIONS = []  # [(version, name, fn(cur))]
 
-        # ========== users ==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password TEXT NOT NULL,
-            role TEXT DEFAULT 'member'
-        );
-        """)
+class MigrationConflict(Exception):
+    """舊資料需要人工處理才能套用 migration（訊息說明要做什麼），處理完重新執行即可。"""
 
-        # ========== products ==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS products (
-            pid TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            price INTEGER NOT NULL
-        );
-        """)
+def migration(version: int, name: str):
+    def decorator(fn):
+        assert all(v != version for v, _n, _f in MIGRATIONS), f"migration {version} 重複"
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return decorator
 
-        # ========== rent_requests ==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS rent_requests (
-            id SERIAL PRIMARY KEY,
-            location TEXT NOT NULL,
-            date DATE NOT NULL,
-            time_slot TEXT NOT NULL,
-            name TEXT NOT NULL,
-            phone TEXT NOT NULL,
-            email TEXT,
-            note TEXT,
-            submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT DEFAULT 'pending'
-        );
-        """)
-        # 這兩行是保險，已存在就不會新增
-        cur.execute("ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS email TEXT;")
-        cur.execute("ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'pending';")
-        # >>> 新增：自由起訖時間欄位（若不存在就加）
-        cur.execute("ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS start_time TIME;")
-        cur.execute("ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS end_time   TIME;")
-
-        # >>> 新增：把舊的 time_slot（09:00-12:00 / 09:00–12:00）回填到新欄位
+
+@migration(1, "baseline")
+def m0001_baseline(cur):
+    """原本 init_db.py + app.py 裡各 ensure_*() 的內容（全部可重複執行，既有資料庫也能直接套用）。"""
+
+    # ========== users ==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        password TEXT NOT NULL,
+        role TEXT DEFAULT 'member'
+    );
+    """)
+
+    # ========== products ==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS products (
+        pid TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        price INTEGER NOT NULL
+    );
+    """)
+
+    # ========== rent_requests ==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS rent_requests (
+        id SERIAL PRIMARY KEY,
+        location TEXT NOT NULL,
+        date DATE NOT NULL,
+        time_slot TEXT NOT NULL,
+        name TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        email TEXT,
+        note TEXT,
+        submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status TEXT DEFAULT 'pending'
+    );
+    """)
+    # 這兩行是保險，已存在就不會新增
+    cur.execute("ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS email TEXT;")
+    cur.execute("ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'pending';")
+    # >>> 新增：自由起訖時間欄位（若不存在就加）
+    cur.execute("ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS start_time TIME;")
+    cur.execute("ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS end_time   TIME;")
+
+    # >>> 新增：把舊的 time_slot（09:00-12:00 / 09:00–12:00）回填到新欄位
+    cur.execute("""
+        UPDATE rent_requests
+        SET start_time = split_part(replace(time_slot,'–','-'), '-', 1)::time,
+            end_time   = split_part(replace(time_slot,'–','-'), '-', 2)::time
+        WHERE time_slot IS NOT NULL
+          AND (start_time IS NULL OR end_time IS NULL);
+    """)
+
+    # >>> 建索引：之後查詢撞時段會更快
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rent_loc_date ON rent_requests(location, date);")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_rent_loc_date_time ON rent_requests(location, date, start_time, end_time);")
+
+    # ========== cart_items ==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS cart_items (
+        id SERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        product_id TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        UNIQUE (user_id, product_id),
+        FOREIGN KEY (user_id) REFERENCES users(username),
+        FOREIGN KEY (product_id) REFERENCES products(pid)
+    );
+    """)
+
+    # ========== about_page ==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS about_page (
+        id SERIAL PRIMARY KEY,
+        content TEXT NOT NULL DEFAULT ''
+    );
+    """)
+    # 初始 about_page（若沒有任何資料）
+    # app 一律讀寫 id=1 這一列，所以固定用 id=1
+    cur.execute("SELECT COUNT(*) AS count FROM about_page;")
+    if (cur.fetchone()["count"] or 0) == 0:
         cur.execute("""
-            UPDATE rent_requests
-            SET start_time = split_part(replace(time_slot,'–','-'), '-', 1)::time,
-                end_time   = split_part(replace(time_slot,'–','-'), '-', 2)::time
-            WHERE time_slot IS NOT NULL
-              AND (start_time IS NULL OR end_time IS NULL);
-        """)
+            INSERT INTO about_page (id, content) VALUES (1, %s)
+        """, ("""
+            <h1>關於精油工會</h1>
+            <p>我們致力於推廣芳香療法、精油教育與應用，連結產業與社會，創造健康永續生活。</p>
+            <ul><li>（這是初始內容，之後可在後台編輯頁修改）</li></ul>
+        """,))
+
+    # 舊資料若沒有 id=1（app 以前的 ensure_about_row 會補），這裡補上
+    cur.execute("INSERT INTO about_page (id, content) VALUES (1, '') ON CONFLICT (id) DO NOTHING;")
+
+    # ========== downloads ==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS downloads (
+        id SERIAL PRIMARY KEY,
+        title TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        original_name TEXT NOT NULL,
+        mime TEXT,
+        size_bigint BIGINT,
+        uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    # app 端只寫 filename/title；舊版 app 建的表則沒有後面三欄，兩邊對齊
+    cur.execute("ALTER TABLE downloads ADD COLUMN IF NOT EXISTS original_name TEXT;")
+    cur.execute("ALTER TABLE downloads ADD COLUMN IF NOT EXISTS mime TEXT;")
+    cur.execute("ALTER TABLE downloads ADD COLUMN IF NOT EXISTS size_bigint BIGINT;")
+    cur.execute("ALTER TABLE downloads ALTER COLUMN original_name DROP NOT NULL;")
+
+    # ========== banners（首頁輪播）==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS banners (
+        id SERIAL PRIMARY KEY,
+        img TEXT NOT NULL,
+        title TEXT,
+        subtitle TEXT,
+        link TEXT,
+        badge TEXT,
+        sort_order INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_banners_sort ON banners(sort_order, id);")
+
+    # ========== contact_messages ==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS contact_messages (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        email TEXT NOT NULL,
+        message TEXT NOT NULL,
+        submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
 
-        # >>> 建索引：之後查詢撞時段會更快
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_rent_loc_date ON rent_requests(location, date);")
+    # ========== news ==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS news (
+        id BIGSERIAL PRIMARY KEY,
+        title TEXT NOT NULL,
+        content TEXT,
+        link TEXT,
+        publish_date DATE NOT NULL DEFAULT CURRENT_DATE,
+        is_pinned BOOLEAN NOT NULL DEFAULT FALSE,
+        is_visible BOOLEAN NOT NULL DEFAULT TRUE,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+    # 自動更新 news.updated_at（僅在不存在觸發器時建立）
+    cur.execute("""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_news_updated_at') THEN
+            CREATE OR REPLACE FUNCTION set_news_updated_at() RETURNS trigger AS $f$
+            BEGIN
+                NEW.updated_at := NOW();
+                RETURN NEW;
+            END;
+            $f$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER trg_news_updated_at
+            BEFORE UPDATE ON news
+            FOR EACH ROW
+            EXECUTE FUNCTION set_news_updated_at();
+        END IF;
+    END$$;
+    """)
+
+    # ========== courses（課程專區，若你保留 /courses）==========
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS courses (
+        id SERIAL PRIMARY KEY,
+        title TEXT NOT NULL,
+        description TEXT,
+        dm_file TEXT,
+        signup_link TEXT,
+        pinned BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_courses_created_at ON courses(created_at DESC);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_courses_pinned ON courses(pinned);")
+
+    # ========== 課程回顧（唯一、乾淨版）==========
+    # 分類表
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS review_categories (
+        id SERIAL PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        slug TEXT UNIQUE NOT NULL,
+        sort_order INTEGER DEFAULT 0
+    );
+    """)
+    # 主文表
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS course_reviews (
+        id SERIAL PRIMARY KEY,
+        category_id INTEGER NOT NULL REFERENCES review_categories(id) ON DELETE RESTRICT,
+        title TEXT NOT NULL,
+        event_date DATE,
+        cover_path TEXT,
+        summary TEXT,
+        content_html TEXT,
+        status TEXT DEFAULT 'published',   -- published | draft
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    # 媒體表（沿用你現有的 size_bytes）
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS review_media (
+        id SERIAL PRIMARY KEY,
+        review_id INTEGER NOT NULL REFERENCES course_reviews(id) ON DELETE CASCADE,
+        file_path TEXT NOT NULL,              -- uploads/reviews/<review_id>/<uuid>.<ext>
+        file_name TEXT,                       -- 原始檔名
+        mime TEXT NOT NULL,                   -- image/jpeg / video/mp4 ...
+        size_bytes BIGINT,                    -- 檔案大小
+        sort_order INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    # 補齊新欄位（若已存在就略過）
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS width INT;")
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS height INT;")
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_480 TEXT;")
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_960 TEXT;")
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_webp TEXT;")
+
+    # 索引
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_review_media_review ON review_media(review_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_review_media_sort ON review_media(review_id, sort_order, created_at, id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_category ON course_reviews(category_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_status ON course_reviews(status);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_date ON course_reviews((COALESCE(event_date, created_at)));")
+
+    # --- 先把 sort_order 去重，避免等下 UNIQUE INDEX 建不成功 ---
+    cur.execute("""
+    WITH ranked AS (
+      SELECT id,
+             review_id,
+             ROW_NUMBER() OVER (
+               PARTITION BY review_id
+               ORDER BY COALESCE(sort_order, 0), created_at, id
+             ) - 1 AS rn
+      FROM review_media
+    ),
+    upd AS (
+      UPDATE review_media m
+      SET sort_order = r.rn
+      FROM ranked r
+      WHERE m.id = r.id AND COALESCE(m.sort_order, -1) <> r.rn
+      RETURNING 1
+    )
+    SELECT COUNT(*) FROM upd;
+    """)
+
+    # 建立唯一索引（不再用 DO $$ 包）
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_review_media_order ON review_media(review_id, sort_order);")
+
+    # 舊表相容：如有 review_photos 且 review_media 為空，搬一次
+    cur.execute("""
+    DO $$
+    BEGIN
+      IF to_regclass('public.review_photos') IS NOT NULL THEN
+        IF NOT EXISTS (SELECT 1 FROM review_media) THEN
+          INSERT INTO review_media (review_id, file_path, file_name, mime, sort_order, created_at)
+          SELECT review_id,
+                 image_path,
+                 caption,
+                 'image/*'::text,
+                 COALESCE(sort_order, 0),
+                 NOW()
+          FROM review_photos;
+        END IF;
+      END IF;
+    END$$;
+    """)
+
+    # 預設塞一個分類（若沒有任何分類）
+    cur.execute("SELECT COUNT(*) AS ximen FROM review_categories;")
+    if (cur.fetchone()["ximen"] or 0) == 0:
         cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_rent_loc_date_time ON rent_requests(location, date, start_time, end_time);")
+            "INSERT INTO review_categories (name, slug, sort_order) VALUES (%s,%s,%s);",
+            ("一般課程", "general", 0)
+        )
 
-        # ========== cart_items ==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS cart_items (
-            id SERIAL PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            product_id TEXT NOT NULL,
-            quantity INTEGER NOT NULL,
-            UNIQUE (user_id, product_id),
-            FOREIGN KEY (user_id) REFERENCES users(username),
-            FOREIGN KEY (product_id) REFERENCES products(pid)
-        );
-        """)
 
-        # ========== about_page ==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS about_page (
-            id SERIAL PRIMARY KEY,
-            content TEXT NOT NULL DEFAULT ''
-        );
-        """)
-        # 初始 about_page（若沒有任何資料）
-        cur.execute("SELECT COUNT(*) AS count FROM about_page;")
-        if (cur.fetchone()["count"] or 0) == 0:
-            cur.execute("""
-                INSERT INTO about_page (content) VALUES (%s)
-            """, ("""
-                <h1>關於精油工會</h1>
-                <p>我們致力於推廣芳香療法、精油教育與應用，連結產業與社會，創造健康永續生活。</p>
-                <ul><li>（這是初始內容，之後可在後台編輯頁修改）</li></ul>
-            """,))
-
-        # ========== downloads ==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS downloads (
-            id SERIAL PRIMARY KEY,
-            title TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            original_name TEXT NOT NULL,
-            mime TEXT,
-            size_bigint BIGINT,
-            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        """)
+@migration(2, "cache_versions")
+def m0002_cache_versions(cur):
+    """快取版本號：資料異動時由 trigger 遞增並 NOTIFY，app 端各 process 的快取據此失效。"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS cache_versions (
+        name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 1,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+    # 通用 trigger：版本名稱由 TG_ARGV[0] 指定，NOTIFY payload 為 "<name>:<version>"
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION bump_cache_version() RETURNS trigger AS $f$
+    DECLARE
+        v BIGINT;
+    BEGIN
+        INSERT INTO cache_versions (name) VALUES (TG_ARGV[0])
+        ON CONFLICT (name) DO UPDATE
+            SET version = cache_versions.version + 1, updated_at = NOW()
+        RETURNING version INTO v;
+        PERFORM pg_notify('cache_versions', TG_ARGV[0] || ':' || v);
+        RETURN NULL;
+    END;
+    $f$ LANGUAGE plpgsql;
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS trg_products_cache_version ON products;")
+    cur.execute("""
+    CREATE TRIGGER trg_products_cache_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON products
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_version('products');
+    """)
+    cur.execute("INSERT INTO cache_versions (name) VALUES ('products') ON CONFLICT (name) DO NOTHING;")
 
-        # ========== contact_messages ==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS contact_messages (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL,
-            email TEXT NOT NULL,
-            message TEXT NOT NULL,
-            submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
+
+@migration(3, "rent_availability")
+def m0003_rent_availability(cur):
+    """場地可借時段：只含有效申請的 (location, date) 部分索引 + 每個場地一個快取版本號。"""
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_rent_active_loc_date
+    ON rent_requests(location, date) INCLUDE (start_time, end_time)
+    WHERE status IN ('pending', 'approved');
+    """)
+    # 版本名稱為 "rent:<location>"；用 transition table 做成 statement-level，
+    # 批次改狀態/封存時每個場地只遞增一次
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION bump_rent_cache_versions() RETURNS trigger AS $f$
+    DECLARE
+        loc TEXT;
+        v BIGINT;
+        locs TEXT[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            SELECT array_agg(DISTINCT location) INTO locs FROM new_rows;
+        ELSIF TG_OP = 'DELETE' THEN
+            SELECT array_agg(DISTINCT location) INTO locs FROM old_rows;
+        ELSE
+            SELECT array_agg(DISTINCT location) INTO locs
+            FROM (SELECT location FROM new_rows UNION SELECT location FROM old_rows) x;
+        END IF;
+        FOREACH loc IN ARRAY COALESCE(locs, '{}') LOOP
+            INSERT INTO cache_versions (name) VALUES ('rent:' || loc)
+            ON CONFLICT (name) DO UPDATE
+                SET version = cache_versions.version + 1, updated_at = NOW()
+            RETURNING version INTO v;
+            PERFORM pg_notify('cache_versions', 'rent:' || loc || ':' || v);
+        END LOOP;
+        RETURN NULL;
+    END;
+    $f$ LANGUAGE plpgsql;
+    """)
+    # transition table 的 trigger 只能對應單一事件，所以分三個
+    for event, refs in (("INSERT", "NEW TABLE AS new_rows"),
+                        ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+                        ("DELETE", "OLD TABLE AS old_rows")):
+        name = f"trg_rent_cache_version_{event.lower()}"
+        cur.execute(f"DROP TRIGGER IF EXISTS {name} ON rent_requests;")
+        cur.execute(f"""
+        CREATE TRIGGER {name}
+        AFTER {event} ON rent_requests
+        REFERENCING {refs}
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_rent_cache_versions();
         """)
 
-        # ========== news ==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS news (
-            id BIGSERIAL PRIMARY KEY,
-            title TEXT NOT NULL,
-            content TEXT,
-            link TEXT,
-            publish_date DATE NOT NULL DEFAULT CURRENT_DATE,
-            is_pinned BOOLEAN NOT NULL DEFAULT FALSE,
-            is_visible BOOLEAN NOT NULL DEFAULT TRUE,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        );
+
+@migration(4, "rent_requests_archive")
+def m0004_rent_requests_archive(cur):
+    """已結束的租借申請由背景排程分批搬到 rent_requests_archive。"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS rent_requests_archive (
+        id INTEGER PRIMARY KEY,
+        location TEXT NOT NULL,
+        date DATE NOT NULL,
+        time_slot TEXT,
+        start_time TIME,
+        end_time TIME,
+        name TEXT,
+        phone TEXT,
+        email TEXT,
+        note TEXT,
+        submitted_at TIMESTAMP,
+        status TEXT,                 -- approved / rejected / expired（過期仍未審核）
+        archived_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rent_archive_loc_date ON rent_requests_archive(location, date);")
+    # 排程用：依日期找出已結束的申請
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rent_date ON rent_requests(date);")
+
+
+@migration(5, "rent_requests_keyset")
+def m0005_rent_requests_keyset(cur):
+    """後台租借列表以 (submitted_at, id) 做 keyset 分頁。"""
+    cur.execute("UPDATE rent_requests SET submitted_at = NOW() WHERE submitted_at IS NULL;")
+    cur.execute("ALTER TABLE rent_requests ALTER COLUMN submitted_at SET NOT NULL;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rent_submitted ON rent_requests(submitted_at DESC, id DESC);")
+
+
+@migration(6, "review_media_derivatives")
+def m0006_review_media_derivatives(cur):
+    """
+    回顧圖片的縮圖 / WEBP 改由背景工作產生：review_media 本身就是工作佇列。
+      derivatives_status: none（非圖片）| pending | processing | ready | failed
+    """
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS derivatives_status TEXT NOT NULL DEFAULT 'none';")
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS derivatives_attempts INT NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS derivatives_error TEXT;")
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS derivatives_claimed_at TIMESTAMPTZ;")
+    cur.execute("""
+    UPDATE review_media
+    SET derivatives_status = CASE
+          WHEN file_path_480 IS NOT NULL THEN 'ready'
+          WHEN mime LIKE 'image/%' THEN 'pending'
+          ELSE 'none'
+        END;
+    """)
+    cur.execute("""
+    ALTER TABLE review_media
+      ADD CONSTRAINT review_media_derivatives_status_check
+      CHECK (derivatives_status IN ('none', 'pending', 'processing', 'ready', 'failed'));
+    """)
+    # 佇列只掃待處理的列
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_review_media_derivatives_queue
+      ON review_media(id) WHERE derivatives_status IN ('pending', 'processing');
+    """)
+
+
+@migration(7, "review_media_content_hash")
+def m0007_review_media_content_hash(cur):
+    """上傳時邊收邊算的 SHA-256（舊資料為 NULL）。"""
+    cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS content_sha256 TEXT;")
+
+
+@migration(8, "page_cache_versions")
+def m0008_page_cache_versions(cur):
+    """公開頁面快取的版本號：banners / about / courses / reviews 任何異動都遞增並 NOTIFY。"""
+    for table, name in [
+        ("banners", "banners"),
+        ("about_page", "about"),
+        ("courses", "courses"),
+        ("course_reviews", "reviews"),
+        ("review_media", "reviews"),
+        ("review_categories", "reviews"),
+    ]:
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_cache_version ON {table};")
+        cur.execute(f"""
+        CREATE TRIGGER trg_{table}_cache_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_version('{name}');
         """)
-        # 自動更新 news.updated_at（僅在不存在觸發器時建立）
-        cur.execute("""
-        DO $$
-        BEGIN
-            IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_news_updated_at') THEN
-                CREATE OR REPLACE FUNCTION set_news_updated_at() RETURNS trigger AS $f$
-                BEGIN
-                    NEW.updated_at := NOW();
-                    RETURN NEW;
-                END;
-                $f$ LANGUAGE plpgsql;
-
-                CREATE TRIGGER trg_news_updated_at
-                BEFORE UPDATE ON news
-                FOR EACH ROW
-                EXECUTE FUNCTION set_news_updated_at();
+    cur.execute("""
+    INSERT INTO cache_versions (name)
+    VALUES ('banners'), ('about'), ('courses'), ('reviews')
+    ON CONFLICT (name) DO NOTHING;
+    """)
+
+
+@migration(9, "full_text_search")
+def m0009_full_text_search(cur):
+    """
+    站內搜尋：course_reviews / courses / downloads 各一個 search_tsv（GIN 索引），由 trigger 維護。
+    中文沒有空白斷詞，cjk_bigrams() 把連續的中日韓字切成重疊的兩字詞（「課程回顧」→ 課程 程回 回顧），
+    英數字保留成整個字；文件和查詢都走同一個函式，再用 'simple' 設定建 tsvector / tsquery。
+    """
+    # 字元範圍：㐀-䶿 = U+3400–4DBF（擴充 A）、一-鿿 = U+4E00–9FFF（基本區）、豈-﫿 = U+F900–FAFF（相容字）
+    cur.execute(r"""
+    CREATE OR REPLACE FUNCTION cjk_bigrams(src TEXT) RETURNS TEXT AS $f$
+    DECLARE
+        tok TEXT;
+        out TEXT[] := '{}';
+        i INT;
+    BEGIN
+        IF src IS NULL THEN
+            RETURN '';
+        END IF;
+        FOR tok IN
+            SELECT m[1] FROM regexp_matches(lower(src), '([㐀-䶿一-鿿豈-﫿]+|[a-z0-9]+)', 'g') AS m
+        LOOP
+            IF tok ~ '^[a-z0-9]' OR length(tok) = 1 THEN
+                out := out || tok;
+            ELSE
+                FOR i IN 1 .. length(tok) - 1 LOOP
+                    out := out || substr(tok, i, 2);
+                END LOOP;
             END IF;
-        END$$;
-        """)
+        END LOOP;
+        RETURN array_to_string(out, ' ');
+    END;
+    $f$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+    """)
+    # 查詢字串 → tsquery（AND）；單一個中文字、英數字都當前綴比對，邊打邊搜也找得到
+    cur.execute(r"""
+    CREATE OR REPLACE FUNCTION cjk_tsquery(q TEXT) RETURNS tsquery AS $f$
+        SELECT CASE WHEN count(*) = 0 THEN NULL
+                    ELSE to_tsquery('simple', string_agg(
+                        CASE WHEN length(t) = 1 OR t ~ '^[a-z0-9]' THEN t || ':*' ELSE t END, ' & '))
+               END
+        FROM unnest(string_to_array(nullif(cjk_bigrams(q), ''), ' ')) AS t;
+    $f$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+    """)
+    cur.execute(r"""
+    CREATE OR REPLACE FUNCTION strip_html(src TEXT) RETURNS TEXT AS $f$
+        SELECT regexp_replace(
+                 replace(regexp_replace(coalesce(src, ''), '<[^>]*>', ' ', 'g'), '&nbsp;', ' '),
+                 '\s+', ' ', 'g');
+    $f$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+    """)
 
-        # ========== courses（課程專區，若你保留 /courses）==========
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS courses (
-            id SERIAL PRIMARY KEY,
-            title TEXT NOT NULL,
-            description TEXT,
-            dm_file TEXT,
-            signup_link TEXT,
-            pinned BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_courses_created_at ON courses(created_at DESC);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_courses_pinned ON courses(pinned);")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION course_reviews_search_tsv() RETURNS trigger AS $f$
+    BEGIN
+        NEW.search_tsv :=
+            setweight(to_tsvector('simple', cjk_bigrams(NEW.title)), 'A') ||
+            setweight(to_tsvector('simple', cjk_bigrams(NEW.summary)), 'B') ||
+            setweight(to_tsvector('simple', cjk_bigrams(strip_html(NEW.content_html))), 'C');
+        RETURN NEW;
+    END;
+    $f$ LANGUAGE plpgsql;
+    """)
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION courses_search_tsv() RETURNS trigger AS $f$
+    BEGIN
+        NEW.search_tsv :=
+            setweight(to_tsvector('simple', cjk_bigrams(NEW.title)), 'A') ||
+            setweight(to_tsvector('simple', cjk_bigrams(NEW.description)), 'B');
+        RETURN NEW;
+    END;
+    $f$ LANGUAGE plpgsql;
+    """)
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION downloads_search_tsv() RETURNS trigger AS $f$
+    BEGIN
+        NEW.search_tsv := setweight(to_tsvector('simple', cjk_bigrams(NEW.title)), 'A');
+        RETURN NEW;
+    END;
+    $f$ LANGUAGE plpgsql;
+    """)
 
-        # ========== 課程回顧（唯一、乾淨版）==========
-        # 分類表
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS review_categories (
-            id SERIAL PRIMARY KEY,
-            name TEXT UNIQUE NOT NULL,
-            slug TEXT UNIQUE NOT NULL,
-            sort_order INTEGER DEFAULT 0
-        );
-        """)
-        # 主文表
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS course_reviews (
-            id SERIAL PRIMARY KEY,
-            category_id INTEGER NOT NULL REFERENCES review_categories(id) ON DELETE RESTRICT,
-            title TEXT NOT NULL,
-            event_date DATE,
-            cover_path TEXT,
-            summary TEXT,
-            content_html TEXT,
-            status TEXT DEFAULT 'published',   -- published | draft
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        """)
-        # 媒體表（沿用你現有的 size_bytes）
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS review_media (
-            id SERIAL PRIMARY KEY,
-            review_id INTEGER NOT NULL REFERENCES course_reviews(id) ON DELETE CASCADE,
-            file_path TEXT NOT NULL,              -- uploads/reviews/<review_id>/<uuid>.<ext>
-            file_name TEXT,                       -- 原始檔名
-            mime TEXT NOT NULL,                   -- image/jpeg / video/mp4 ...
-            size_bytes BIGINT,                    -- 檔案大小
-            sort_order INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        """)
-        # 補齊新欄位（若已存在就略過）
-        cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS width INT;")
-        cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS height INT;")
-        cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_480 TEXT;")
-        cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_960 TEXT;")
-        cur.execute("ALTER TABLE review_media ADD COLUMN IF NOT EXISTS file_path_webp TEXT;")
-
-        # 索引
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_review_media_review ON review_media(review_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_review_media_sort ON review_media(review_id, sort_order, created_at, id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_category ON course_reviews(category_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_status ON course_reviews(status);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_date ON course_reviews((COALESCE(event_date, created_at)));")
-
-        # --- 先把 sort_order 去重，避免等下 UNIQUE INDEX 建不成功 ---
-        cur.execute("""
-        WITH ranked AS (
-          SELECT id,
-                 review_id,
-                 ROW_NUMBER() OVER (
-                   PARTITION BY review_id
-                   ORDER BY COALESCE(sort_order, 0), created_at, id
-                 ) - 1 AS rn
-          FROM review_media
-        ),
-        upd AS (
-          UPDATE review_media m
-          SET sort_order = r.rn
-          FROM ranked r
-          WHERE m.id = r.id AND COALESCE(m.sort_order, -1) <> r.rn
-          RETURNING 1
-        )
-        SELECT COUNT(*) FROM upd;
+    for table, cols in [
+        ("course_reviews", "title, summary, content_html"),
+        ("courses", "title, description"),
+        ("downloads", "title"),
+    ]:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_tsv tsvector;")
+        cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_search_tsv ON {table};")
+        cur.execute(f"""
+        CREATE TRIGGER trg_{table}_search_tsv
+        BEFORE INSERT OR UPDATE OF {cols} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {table}_search_tsv();
         """)
+        # 既有資料：更新一次 title 觸發 trigger 算出 search_tsv
+        cur.execute(f"UPDATE {table} SET title = title;")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_search ON {table} USING GIN (search_tsv);")
 
-        # 建立唯一索引（不再用 DO $$ 包）
-        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_review_media_order ON review_media(review_id, sort_order);")
 
-        # 舊表相容：如有 review_photos 且 review_media 為空，搬一次
-        cur.execute("""
-        DO $$
-        BEGIN
-          IF to_regclass('public.review_photos') IS NOT NULL THEN
-            IF NOT EXISTS (SELECT 1 FROM review_media) THEN
-              INSERT INTO review_media (review_id, file_path, file_name, mime, sort_order, created_at)
-              SELECT review_id,
-                     image_path,
-                     caption,
-                     'image/*'::text,
-                     COALESCE(sort_order, 0),
-                     NOW()
-              FROM review_photos;
-            END IF;
-          END IF;
-        END$$;
+@migration(10, "course_reviews_published_keyset")
+def m0010_course_reviews_published_keyset(cur):
+    """前台 /reviews：只看 published，依 (COALESCE(event_date, created_at), id) 做 keyset 分頁（全部 / 單一分類）。"""
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_course_reviews_published_sort
+      ON course_reviews ((COALESCE(event_date, created_at)) DESC, id DESC)
+      WHERE status = 'published';
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_course_reviews_published_cat_sort
+      ON course_reviews (category_id, (COALESCE(event_date, created_at)) DESC, id DESC)
+      WHERE status = 'published';
+    """)
+
+
+@migration(11, "orders")
+def m0011_orders(cur):
+    """
+    訂單：結帳時把 cart_items 在同一個交易裡轉成 orders / order_items。
+      products.stock: NULL = 不限量；有值時下單會扣庫存（CHECK 保證不會賣超）
+      orders (user_id, idempotency_key) 唯一：重複送出同一張結帳單只會成立一筆訂單
+      order_items 保存下單當下的名稱與單價，不對 products 設外鍵（商品刪了訂單仍在）
+    """
+    cur.execute("ALTER TABLE products ADD COLUMN IF NOT EXISTS stock INTEGER;")
+    cur.execute("ALTER TABLE products DROP CONSTRAINT IF EXISTS products_stock_check;")
+    cur.execute("ALTER TABLE products ADD CONSTRAINT products_stock_check CHECK (stock IS NULL OR stock >= 0);")
+    # 扣庫存不該讓商品目錄快取（與所有人的購物車徽章）失效：只有目錄欄位變動才遞增版本號
+    cur.execute("DROP TRIGGER IF EXISTS trg_products_cache_version ON products;")
+    cur.execute("""
+    CREATE TRIGGER trg_products_cache_version
+    AFTER INSERT OR UPDATE OF pid, name, price OR DELETE OR TRUNCATE ON products
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_cache_version('products');
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL REFERENCES users(username),
+        idempotency_key TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'placed'
+            CHECK (status IN ('placed', 'paid', 'cancelled')),
+        item_count INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        UNIQUE (user_id, idempotency_key)
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at DESC, id DESC);")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS order_items (
+        order_id BIGINT NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+        product_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        unit_price INTEGER NOT NULL,
+        quantity INTEGER NOT NULL CHECK (quantity > 0),
+        PRIMARY KEY (order_id, product_id)
+    );
+    """)
+
+
+@migration(12, "mail_outbox")
+def m0012_mail_outbox(cur):
+    """
+    寄信佇列：請求只負責寫入（與業務資料同一個交易），背景工作認領後批次寄出。
+      status: pending → sending → sent；失敗退回 pending 並延後 next_attempt_at（指數退避），
+              次數用完或永久性錯誤（5xx、收件人被拒）進 dead（死信，保留待人工處理）
+    """
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS mail_outbox (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL DEFAULT '',
+        recipients TEXT[] NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        reply_to TEXT,
+        status TEXT NOT NULL DEFAULT 'pending'
+            CHECK (status IN ('pending', 'sending', 'sent', 'dead')),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        claimed_at TIMESTAMPTZ,
+        last_error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        sent_at TIMESTAMPTZ
+    );
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_mail_outbox_queue
+      ON mail_outbox (next_attempt_at, id)
+      WHERE status IN ('pending', 'sending');
+    """)
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_mail_outbox_sent
+      ON mail_outbox (sent_at)
+      WHERE status = 'sent';
+    """)
+
+
+RENT_ACTIVE = "status IN ('pending', 'approved')"
+RENT_OVERLAP_CONSTRAINT = "excl_rent_overlap"
+
+def rent_overlap_constraint_name(location: str) -> str:
+    """沒有 btree_gist 時，每個場地一條部分排他約束的名稱（app 也用它檢查場地有沒有約束）。"""
+    return RENT_OVERLAP_CONSTRAINT + "_" + hashlib.md5(location.encode()).hexdigest()[:8]
+
+def ensure_rent_overlap_constraints(cur, locations) -> list:
+    """
+    替還沒有排他約束的場地補上部分約束，回傳這次新增的場地。
+    已有全場地共用的 excl_rent_overlap（btree_gist）就什麼都不做。
+    gunicorn 啟動時與 flask --app app migrate 都會用 app 的場地清單呼叫（app.ensure_rent_location_constraints）。
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_KEY,))
+    cur.execute("""
+    SELECT conname FROM pg_constraint
+    WHERE conrelid = 'rent_requests'::regclass AND conname LIKE 'excl\\_rent\\_overlap%'
+    """)
+    existing = {r["conname"] for r in cur.fetchall()}
+    if RENT_OVERLAP_CONSTRAINT in existing:
+        return []
+    added = []
+    for loc in sorted(set(locations)):
+        name = rent_overlap_constraint_name(loc)
+        if name in existing:
+            continue
+        cur.execute(f"""
+        ALTER TABLE rent_requests ADD CONSTRAINT {name}
+          EXCLUDE USING gist (during WITH &&) WHERE ({RENT_ACTIVE} AND location = %s);
+        """, (loc,))
+        added.append(loc)
+    return added
+
+@migration(13, "rent_booking_exclusion")
+def m0013_rent_booking_exclusion(cur):
+    """
+    租借防重疊改由資料庫保證：
+      during：依 date + start_time / end_time（台北時間）算出的 tstzrange，stored generated column；
+              只有 time_slot、沒有起訖時間（或起訖顛倒）的舊資料是 NULL，不受排他約束限制
+      excl_rent_overlap：同場地、有效（pending / approved）申請的 during 不得重疊（GiST 排他約束）
+    既有的有效申請若彼此重疊或起訖顛倒，migration 不替管理員做決定：列出清單後中止（MigrationConflict），
+    到後台駁回 / 修正後重新部署即可。
+    時間順序 / 15 分鐘刻度 / 狀態值的 CHECK 先以 NOT VALID 加上（新資料立即生效），舊資料驗證得過才 VALIDATE。
+    """
+    # 1) 既有資料檢查：逐個 (場地, 日期) 依「已核准優先 → 先送出優先」找出跟前面申請重疊的
+    cur.execute(f"""
+    SELECT id, location, date, start_time, end_time, status
+    FROM rent_requests
+    WHERE {RENT_ACTIVE} AND start_time IS NOT NULL AND end_time IS NOT NULL
+    ORDER BY location, date, (status = 'approved') DESC, submitted_at, id
+    """)
+    kept, problems = {}, []
+    describe = lambda r: (f"#{r['id']} {r['location']} {r['date']} "
+                          f"{r['start_time']:%H:%M}–{r['end_time']:%H:%M}（{r['status']}）")
+    for r in cur.fetchall():
+        if r["start_time"] > r["end_time"]:
+            problems.append(f"{describe(r)} 起訖時間顛倒")
+            continue
+        spans = kept.setdefault((r["location"], r["date"]), [])
+        clash = next((o for o in spans
+                      if r["start_time"] < o["end_time"] and o["start_time"] < r["end_time"]), None)
+        if clash:
+            problems.append(f"{describe(r)} 與 {describe(clash)} 重疊")
+        else:
+            spans.append(r)
+    if problems:
+        for line in problems:
+            print(f"   ⚠️ {line}")
+        raise MigrationConflict(
+            f"rent_requests 有 {len(problems)} 筆有效申請需要先處理（見上方清單）："
+            "請到後台駁回其中一筆或修正時間（駁回會照常寄通知信），再重新執行 migration")
+
+    cur.execute("""
+    ALTER TABLE rent_requests ADD COLUMN IF NOT EXISTS during tstzrange
+      GENERATED ALWAYS AS (
+        CASE WHEN start_time IS NULL OR end_time IS NULL OR start_time > end_time THEN NULL
+             ELSE tstzrange(timezone('Asia/Taipei', date + start_time),
+                            timezone('Asia/Taipei', date + end_time), '[)')
+        END
+      ) STORED;
+    """)
+
+    # 2) CHECK：先 NOT VALID，再嘗試驗證舊資料
+    checks = {
+        "chk_rent_time_order": "start_time IS NULL OR end_time IS NULL OR start_time < end_time",
+        "chk_rent_time_step15": """start_time IS NULL OR end_time IS NULL OR (
+            EXTRACT(MINUTE FROM start_time)::int % 15 = 0 AND EXTRACT(SECOND FROM start_time) = 0
+            AND EXTRACT(MINUTE FROM end_time)::int % 15 = 0 AND EXTRACT(SECOND FROM end_time) = 0)""",
+        "chk_rent_status": "status IN ('pending', 'approved', 'rejected')",
+    }
+    for name, expr in checks.items():
+        cur.execute(f"ALTER TABLE rent_requests DROP CONSTRAINT IF EXISTS {name};")
+        cur.execute(f"ALTER TABLE rent_requests ADD CONSTRAINT {name} CHECK ({expr}) NOT VALID;")
+        cur.execute("SAVEPOINT validate_check;")
+        try:
+            cur.execute(f"ALTER TABLE rent_requests VALIDATE CONSTRAINT {name};")
+            cur.execute("RELEASE SAVEPOINT validate_check;")
+        except psycopg2.errors.CheckViolation:
+            cur.execute("ROLLBACK TO SAVEPOINT validate_check;")
+            print(f"   ⚠️ {name}：舊資料有不符合的列，約束維持 NOT VALID（只檢查新資料）")
+
+    # 3) 排他約束：優先用 btree_gist（location 的 = 也能進 GiST）；沒有這個 extension 就每個場地一條部分約束
+    cur.execute("SAVEPOINT btree_gist;")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS btree_gist;")
+        cur.execute("RELEASE SAVEPOINT btree_gist;")
+        has_btree_gist = True
+    except psycopg2.Error:
+        cur.execute("ROLLBACK TO SAVEPOINT btree_gist;")
+        has_btree_gist = False
+
+    cur.execute("ALTER TABLE rent_requests DROP CONSTRAINT IF EXISTS excl_rent_overlap;")
+    if has_btree_gist:
+        cur.execute(f"""
+        ALTER TABLE rent_requests ADD CONSTRAINT excl_rent_overlap
+          EXCLUDE USING gist (location WITH =, during WITH &&) WHERE ({RENT_ACTIVE});
         """)
+    else:
+        # 這裡只看得到已有資料的場地；其餘場地由 ensure_rent_overlap_constraints 補，
+        # 補上之前 app 會拒絕該場地的申請（app.require_rent_overlap_guard）
+        cur.execute("SELECT DISTINCT location FROM rent_requests;")
+        added = ensure_rent_overlap_constraints(cur, [r["location"] for r in cur.fetchall()])
+        print(f"   ⚠️ 沒有 btree_gist，改為每個場地一條排他約束（{len(added)} 個場地；其餘場地在 app 啟動時補上）")
 
-        # 預設塞一個分類（若沒有任何分類）
-        cur.execute("SELECT COUNT(*) AS ximen FROM review_categories;")
-        if (cur.fetchone()["ximen"] or 0) == 0:
-            cur.execute(
-                "INSERT INTO review_categories (name, slug, sort_order) VALUES (%s,%s,%s);",
-                ("一般課程", "general", 0)
-            )
 
-        conn.commit()
-        print("✅ 資料表已建立／更新完成（含課程回顧三表）")
 
-    except Exception as e:
-        conn.rollback()
-        traceback.print_exc()
+@migration(14, "export_indexes")
+def m0014_export_indexes(cur):
+    """
+    匯出（exports.py）依日期區間掃資料，補上跟 ORDER BY 一致的索引讓具名 cursor 照順序邊讀邊送、不必先排序；
+    租借是線上表 UNION ALL 封存表，兩邊同一組索引才能合併成 Merge Append。
+    """
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_contact_messages_submitted ON contact_messages (submitted_at, id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rent_requests_export ON rent_requests (date, start_time, id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rent_archive_export ON rent_requests_archive (date, start_time, id);")
+
+@migration(15, "upload_content_hashes")
+def m0015_upload_content_hashes(cur):
+    """
+    上傳檔的內容雜湊一律存資料庫（/u/ 網址的 ?v=）：review_media 已有 content_sha256，這裡補上封面與 DM 的欄位，
+    以及 /u/ 依路徑查雜湊用的索引。舊資料的雜湊由 app 的排程工作 upload_content_hashes 背景補算。
+    """
+    cur.execute("ALTER TABLE course_reviews ADD COLUMN IF NOT EXISTS cover_sha256 TEXT;")
+    cur.execute("ALTER TABLE courses ADD COLUMN IF NOT EXISTS dm_sha256 TEXT;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_review_media_file_path ON review_media (file_path);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_course_reviews_cover_path ON course_reviews (cover_path);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_courses_dm_file ON courses (dm_file);")
+
+def applied_versions(cur) -> set:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+    cur.execute("SELECT version FROM schema_migrations;")
+    return {r["version"] for r in cur.fetchall()}
+
+def run_migrations(conn=None, verbose=True) -> list:
+    """套用所有尚未執行的 migration，回傳這次套用的版本號。每個版本一個交易。"""
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    done = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_KEY,))
+        conn.commit()
         try:
-            print("\n[PG ERROR]", getattr(e, "pgerror", ""))
-            print(getattr(e, "diag", ""))
-        except:
-            pass
-        raise
+            with conn.cursor() as cur:
+                applied = applied_versions(cur)
+            conn.commit()
+
+            for version, name, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+                if version in applied:
+                    continue
+                try:
+                    with conn.cursor() as cur:
+                        fn(cur)
+                        cur.execute(
+                            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                            (version, name)
+                        )
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    traceback.print_exc()
+                    try:
+                        print(f"\n[PG ERROR] migration {version} ({name})", getattr(e, "pgerror", ""))
+                        print(getattr(e, "diag", ""))
+                    except:
+                        pass
+                    raise
+                done.append(version)
+                if verbose:
+                    print(f"✅ migration {version:04d} {name} 已套用")
+        finally:
+            if not conn.closed:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_KEY,))
+                conn.commit()
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
+    if verbose and not done:
+        print("✅ 資料庫 schema 已是最新版本")
+    return done
+
+def init_db():
+    """相容舊用法：等同 run_migrations()。"""
+    return run_migrations()
 
 if __name__ == "__main__":
     init_db()